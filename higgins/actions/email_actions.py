@@ -1,8 +1,9 @@
 from copy import deepcopy
 from pprint import PrettyPrinter
 import time
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional
 
+from higgins import const
 from higgins.actions import Action, ActionParam, ActionParamSpec, ActionResult
 from higgins.actions import contact_actions
 from higgins.automation.google import gmail
@@ -140,6 +141,7 @@ class SearchEmail(EmailAction):
             "labels": ActionParamSpec(name="labels", question=""),
             "exact_phrase": ActionParamSpec(name="exact_phrase", question=""),
             "newer_than": ActionParamSpec(name="newer_than", question=""),
+            "thread_id": ActionParamSpec(name="thread_id", question=""),
         }
 
     def clarify(self, prompt_fn: Callable) -> List[str]:
@@ -160,12 +162,48 @@ class SearchEmail(EmailAction):
             if sender_info is not None:
                 self.params["sender"].value = sender_info.email
 
+    def search_local(self) -> Optional[List[Dict]]:
+        """Answer sender/thread/date queries from the local store's indexes.
+
+        Returns None if the query needs Gmail (unread, labels, subject, etc.).
+        """
+        values = {k: p.value for k, p in self.params.items() if p.value is not None}
+        if not values or set(values) - set(LOCAL_SEARCH_PARAMS):
+            return None
+        sender = values.get("sender")
+        if sender is not None and not is_sender_address_or_domain(sender):
+            return None
+        if "sender" not in values and "thread_id" not in values:
+            return None
+        return email_utils.search_local_emails(
+            sender=sender,
+            thread_id=values.get("thread_id"),
+            newer_than=values.get("newer_than"),
+            dataset_dir=const.EMAIL_DATASET_DIR,
+        )
+
     def run(self):
         query = action_params_to_query(self.params)
-        emails = gmail.search_emails(query_dicts=[query])
+        emails = self.search_local()
+        is_thread = "thread_id" in self.params and self.params["thread_id"].value
+        newer_than = self.params["newer_than"].value
+        after = email_utils.get_newer_than_timestamp(newer_than) if newer_than else 0.0
+        if emails is not None and (
+            is_thread or gmail.is_synced(after, dataset_dir=const.EMAIL_DATASET_DIR)
+        ):
+            # Threads are only indexed locally, and a synced store has every
+            # email in the window it covers
+            source = "local"
+        elif emails:
+            # The store only holds saved emails, add the ones it's missing
+            source = "local and gmail"
+            emails = merge_emails(emails, gmail.search_emails(query_dicts=[query]))
+        else:
+            source = "gmail"
+            emails = gmail.search_emails(query_dicts=[query])
         reply_handler = "SearchEmailReplyHandler" if len(emails) > 0 else None
         return ActionResult(
-            action_text=f"Found {len(emails)} emails using query {query}.",
+            action_text=f"Found {len(emails)} {source} emails using query {query}.",
             reply_text=email_utils.get_email_list_preview(emails) if emails else None,
             data=emails,
             reply_handler_classname=reply_handler,
@@ -253,6 +291,28 @@ class AnswerEmailQuestion(EmailAction):
         )
 
 
+# Params that the local store's sender, thread and date indexes can answer
+LOCAL_SEARCH_PARAMS = ["sender", "thread_id", "newer_than"]
+
+
+def is_sender_address_or_domain(sender: str) -> bool:
+    sender = sender.strip().lstrip("@")
+    return email_utils.is_valid_email(sender) or (
+        "." in sender and " " not in sender and "@" not in sender
+    )
+
+
+def merge_emails(local_emails: List[Dict], gmail_emails: List[Dict]) -> List[Dict]:
+    """Gmail results in Gmail's order, using the local copy of stored ones.
+
+    Local emails Gmail didn't return are appended.
+    """
+    local_by_google_id = {e["google_id"]: e for e in local_emails if e.get("google_id")}
+    merged = [local_by_google_id.pop(e["google_id"], e) for e in gmail_emails]
+    seen = {e["google_id"] for e in gmail_emails}
+    return merged + [e for e in local_emails if e.get("google_id") not in seen]
+
+
 def action_params_to_query(params: Dict[str, ActionParam]) -> List[Dict]:
     query = {}
     if params["recipient"].value is not None:
@@ -0,0 +1,122 @@
+"""Offline full-text search over the local email store.
+
+Keeps a `fulltext.FullTextIndex` of the emails in the email store, with the
+same _id and _source fields as the Elasticsearch `email` index, so results can
+be used wherever Elasticsearch hits are:
+
+    python higgins_cli.py index-email-fulltext
+    python higgins_cli.py search-email --source fulltext --subject "flight confirmation"
+"""
+
+import sys
+import time
+from typing import Dict, List
+
+from higgins import const
+from higgins.automation.email import email_store
+from higgins.database import fulltext
+
+# Same fields as the Email document in email_model.py
+SOURCE_FIELDS = [
+    "email_id", "google_id", "thread_id", "sender", "sender_name", "sender_address",
+    "recipient", "date", "subject", "plain", "preview", "label_ids",
+]
+DEFAULT_FIELDS = ["subject^2", "plain"]
+EMAIL_INDEX = "email"
+# Merge segments once incremental updates have written this many
+MAX_SEGMENTS = 10
+
+_indexes = {}
+
+
+def get_email_index(index_path: str = const.FULLTEXT_INDEX_PATH) -> fulltext.FullTextIndex:
+    if index_path not in _indexes:
+        _indexes[index_path] = fulltext.FullTextIndex(
+            index_path, fields=["subject", "plain"], name=EMAIL_INDEX
+        )
+    return _indexes[index_path]
+
+
+def email_to_source(email: Dict) -> Dict:
+    return {field: email.get(field) for field in SOURCE_FIELDS}
+
+
+def update_email_index(
+    dataset_dir: str = const.EMAIL_DATASET_DIR,
+    index_path: str = const.FULLTEXT_INDEX_PATH,
+    optimize: bool = False,
+) -> Dict:
+    """Index new and changed emails of the email store, and drop deleted ones."""
+    index = get_email_index(index_path)
+    emails = []
+    if email_store.dataset_exists(dataset_dir):
+        emails = email_store.get_email_store(dataset_dir).iter_emails(lazy=True)
+    stats = {"added": 0, "unchanged": 0, "deleted": 0}
+    doc_ids = set()
+    for email in emails:
+        doc_id = email.get("google_id") or email["email_id"]
+        doc_ids.add(doc_id)
+        added = index.add(doc_id, email_to_source(email))
+        stats["added" if added else "unchanged"] += 1
+    for (doc_id,) in index.conn.execute("SELECT doc_id FROM docs").fetchall():
+        if doc_id not in doc_ids:
+            index.delete(doc_id)
+            stats["deleted"] += 1
+    index.commit()
+    num_segments = index.conn.execute(
+        "SELECT COUNT(DISTINCT segment) FROM postings"
+    ).fetchone()[0]
+    if optimize or num_segments > MAX_SEGMENTS:
+        index.optimize()
+    return stats
+
+
+def search_emails(
+    query: str,
+    fields: List[str] = DEFAULT_FIELDS,
+    limit: int = fulltext.QUERY_LIMIT,
+    index_path: str = const.FULLTEXT_INDEX_PATH,
+) -> List[Dict]:
+    """Emails matching `query`, best match first, with their BM25 score in `_score`."""
+    hits = fulltext.search_query_string(
+        query, fields, client=get_email_index(index_path), stop=limit
+    )
+    return [{**hit.to_dict(), "_score": hit.meta.score} for hit in hits]
+
+
+def benchmark(num_emails: int = 100000, num_queries: int = 200, vocab_size: int = 50000):
+    """Index a synthetic corpus with Zipf-distributed words and time top-10 queries."""
+    import tempfile
+
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    vocab = np.array([f"w{i}" for i in range(vocab_size)])
+
+    def sample_words(n):
+        return vocab[np.minimum(rng.zipf(1.2, n), vocab_size) - 1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = fulltext.FullTextIndex(f"{tmp}/fulltext.db")
+        start = time.time()
+        for i in range(num_emails):
+            email = {
+                "email_id": str(i),
+                "subject": " ".join(sample_words(8)),
+                "plain": " ".join(sample_words(150)),
+            }
+            index.add(str(i), email_to_source(email))
+        index.optimize()
+        print(f"Indexed {num_emails} emails in {time.time() - start:.1f}s")
+        queries = [" ".join(sample_words(3)) for _ in range(num_queries)]
+        start = time.time()
+        for query in queries:
+            fulltext.search_query_string(query, DEFAULT_FIELDS, client=index, stop=10)
+        elapsed = time.time() - start
+        print(f"{elapsed / num_queries * 1000:.2f} ms/query (top 10, {num_queries} queries)")
+        index.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -1,10 +1,11 @@
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Iterable, Tuple
 
-from elasticsearch_dsl import Document, Date, Integer, Keyword, Text, connections
+from elasticsearch import helpers
+from elasticsearch_dsl import Document, Date, Integer, Keyword, Text
 
-
-connections.create_connection(hosts=["localhost"], timeout=20)
+# Configures the shared client, which is only created on first use
+from higgins.database import elastic
 
 
 class Email(Document):
@@ -32,12 +33,50 @@ class Email(Document):
             "number_of_shards": 1,
         }
 
-    def save(self, **kwargs):
+    def update_stats(self):
         self.line_count = len(self.plain.split())
-        self.chart_count = len(self.plain)
+        self.char_count = len(self.plain)
+
+    def save(self, **kwargs):
+        self.update_stats()
         return super().save(**kwargs)
 
 
+def bulk_save(
+    emails: Iterable[Email],
+    chunk_size: int = 500,
+    thread_count: int = 4,
+    client=None,
+) -> Tuple[int, int]:
+    """Index emails with parallel bulk requests instead of one `save()` each.
+
+    Emails are consumed lazily, so `emails` can be a generator of converted
+    messages. Returns the number of emails indexed and failed.
+    """
+    client = client or elastic.get_client()
+
+    def actions():
+        for email in emails:
+            email.update_stats()
+            email.full_clean()
+            yield email.to_dict(include_meta=True, skip_empty=True)
+
+    success, failed = 0, 0
+    for ok, info in helpers.parallel_bulk(
+        client,
+        actions(),
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        raise_on_error=False,
+    ):
+        if ok:
+            success += 1
+        else:
+            failed += 1
+            print(f"Failed to index email: {info}")
+    return success, failed
+
+
 def from_gmail_dict(email: Dict):
     return Email(
         meta={"id": email["google_id"]},
@@ -57,9 +96,6 @@ def from_gmail_dict(email: Dict):
 
 
 if __name__ == "__main__":
-    # Define a default Elasticsearch client
-    connections.create_connection(hosts=["localhost"])
-
     # create the mappings in elasticsearch
     Email.init()
 
@@ -82,4 +118,4 @@ if __name__ == "__main__":
     # print(email)
 
     # Display cluster health
-    print(connections.get_connection().cluster.health())
+    print(elastic.get_client().cluster.health())
@@ -0,0 +1,1075 @@
+"""Storage backends for the local email dataset.
+
+DirEmailStore is the original layout, one directory per email:
+    {dataset_dir}/{email_id}/metadata.json
+    {dataset_dir}/{email_id}/body.plain
+    {dataset_dir}/{email_id}/body.html
+    {dataset_dir}/{email_id}/body.md
+    {dataset_dir}/{email_id}/model_labels.json
+
+SQLiteEmailStore packs every email into a single {dataset_dir}/emails.db file,
+so loading or searching emails doesn't open several files per email.
+
+Use `get_email_store` to get the store for a dataset directory. Existing
+directory datasets keep using DirEmailStore until they are migrated with
+`migrate_dir_to_sqlite` (or `python higgins_cli.py migrate-email-store`).
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from email.utils import parseaddr
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import dateutil.parser
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EMAIL_DB_NAME = "emails.db"
+BODY_CODECS = ["none", "gzip", "zstd"]
+DEFAULT_BODY_CODEC = "zstd" if zstandard is not None else "gzip"
+ZSTD_LEVEL = 10
+ZSTD_DICT_SIZE = 112640
+EXCLUDE_METADATA_FIELDS = ["plain", "html", "attachments"]
+
+
+def dateconverter(o):
+    if isinstance(o, datetime):
+        return o.__str__()
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def format_write_stats(stats: Counter) -> str:
+    """Summarize the write counters kept in `store.stats`."""
+    mb = 1024 * 1024
+    text = f"Wrote {stats['written']} emails ({stats['bytes_written'] / mb:.2f} MB)"
+    if stats["skipped"]:
+        text += (
+            f", skipped {stats['skipped']} unchanged emails "
+            f"({stats['bytes_skipped'] / mb:.2f} MB)"
+        )
+    if stats["html_deduped"]:
+        text += (
+            f", stored {stats['html_deduped']} duplicate HTML bodies once "
+            f"({stats['bytes_deduped'] / mb:.2f} MB)"
+        )
+    return text
+
+
+def get_date_ts(date) -> Optional[float]:
+    """Convert an email date (datetime or its string form) into a unix timestamp."""
+    if date is None:
+        return None
+    if isinstance(date, (int, float)):
+        return float(date)
+    if not isinstance(date, datetime):
+        try:
+            date = dateutil.parser.parse(str(date), fuzzy=True)
+        except (ValueError, OverflowError):
+            return None
+    return date.timestamp()
+
+
+def get_sender_fields(email: Dict) -> Dict:
+    """Return the normalized sender_address and sender_domain of an email."""
+    address = email.get("sender_address")
+    if not address and email.get("sender"):
+        address = parseaddr(email["sender"])[1]
+    address = address.lower() if address else None
+    domain = address.rsplit("@", 1)[1] if address and "@" in address else None
+    return {"sender_address": address, "sender_domain": domain}
+
+
+def match_sender(email: Dict, sender: str) -> bool:
+    """True if `sender` (an address, domain or @domain) matches the email's sender."""
+    fields = get_sender_fields(email)
+    sender = sender.lower()
+    if "@" in sender.lstrip("@"):
+        return fields["sender_address"] == sender
+    return fields["sender_domain"] == sender.lstrip("@")
+
+
+def get_categories(labels: Optional[Dict]) -> List[str]:
+    return sorted(set((labels or {}).get("categories") or []))
+
+
+def get_metadata(email_id: str, email: Dict) -> Dict:
+    metadata = {k: v for k, v in email.items() if k not in EXCLUDE_METADATA_FIELDS}
+    metadata["email_id"] = email_id
+    return metadata
+
+
+class LazyEmail(dict):
+    """Email dict whose body fields are only read when first accessed.
+
+    Metadata is loaded up front, `load_field(name)` is called the first time one
+    of `lazy_fields` is read. Iterating over the email (keys(), items(), dict(),
+    json.dumps, etc.) loads every remaining field.
+    """
+
+    def __init__(
+        self, metadata: Dict, load_field: Callable[[str], Any], lazy_fields: List[str]
+    ):
+        super().__init__(metadata)
+        self._load_field = load_field
+        self._lazy_fields = [f for f in lazy_fields if f not in metadata]
+
+    def _load(self, key) -> bool:
+        if key not in self._lazy_fields:
+            return False
+        self._lazy_fields.remove(key)
+        super().__setitem__(key, self._load_field(key))
+        return True
+
+    def load_all(self) -> "LazyEmail":
+        for key in list(self._lazy_fields):
+            self._load(key)
+        return self
+
+    def __missing__(self, key):
+        if self._load(key):
+            return super().__getitem__(key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._lazy_fields or super().__contains__(key)
+
+    def __setitem__(self, key, value):
+        if key in self._lazy_fields:
+            self._lazy_fields.remove(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._load(key)
+        super().__delitem__(key)
+
+    def __eq__(self, other):
+        return dict.__eq__(self.load_all(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return super().__len__() + len(self._lazy_fields)
+
+    def __repr__(self):
+        return dict.__repr__(self.load_all())
+
+    def __reduce__(self):
+        # Loaders hold file handles/connections, so pickle as a plain dict
+        return (dict, (dict(self.items()),))
+
+    def get(self, key, default=None):
+        self._load(key)
+        return super().get(key, default)
+
+    def pop(self, key, *args):
+        self._load(key)
+        return super().pop(key, *args)
+
+    def setdefault(self, key, default=None):
+        self._load(key)
+        return super().setdefault(key, default)
+
+    def keys(self):
+        self.load_all()
+        return super().keys()
+
+    def values(self):
+        self.load_all()
+        return super().values()
+
+    def items(self):
+        self.load_all()
+        return super().items()
+
+    def copy(self):
+        return dict(self.items())
+
+
+DIR_FIELD_FILES = {
+    "plain": "body.plain",
+    "html": "body.html",
+    "model_labels": "model_labels.json",
+}
+
+
+def write_file_atomic(path: Path, text: str):
+    # Write to a temp file and rename, so readers never see a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, prefix=".tmp-")
+    try:
+        os.chmod(tmp_path, 0o644)  # mkstemp creates files readable by the owner only
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_file_if_exists(path: Path) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class DirEmailStore:
+    """One directory per email (legacy layout).
+
+    Only files whose content changed are rewritten, and saving an unchanged
+    email is skipped. Bodies are neither compressed nor deduplicated.
+    """
+
+    def __init__(self, dataset_dir: str):
+        self.dataset_dir = dataset_dir
+        self.stats = Counter()
+
+    @contextmanager
+    def transaction(self):
+        # Each file is replaced atomically, there is nothing to group
+        yield
+
+    def save(self, email_id: str, email: Dict, labels: Dict = None) -> Path:
+        email_dir = Path(self.dataset_dir, email_id)
+        files = {
+            "metadata.json": json.dumps(
+                get_metadata(email_id, email), indent=2, default=dateconverter
+            )
+        }
+        body_files = [("plain", "body.plain"), ("html", "body.html"), ("markdown", "body.md")]
+        for field, name in body_files:
+            if bool(email.get(field)):
+                files[name] = email[field]
+        if labels is not None:
+            files["model_labels.json"] = json.dumps(labels, indent=2)
+
+        # Bodies that aren't given keep their existing file, like labels
+        changed = {
+            name: text
+            for name, text in files.items()
+            if read_file_if_exists(Path(email_dir, name)) != text
+        }
+        if not changed:
+            self.stats["skipped"] += 1
+            self.stats["bytes_skipped"] += sum(len(text) for text in files.values())
+            return email_dir
+
+        print(f"Saving email to: {email_dir}")
+        email_dir.mkdir(parents=True, exist_ok=True)
+        for name, text in changed.items():
+            write_file_atomic(Path(email_dir, name), text)
+
+        self.stats["written"] += 1
+        self.stats["bytes_written"] += sum(len(text) for text in changed.values())
+        return email_dir
+
+    def load_field(self, email_dir: str, field: str) -> Any:
+        path = Path(email_dir, DIR_FIELD_FILES[field])
+        if not path.exists():
+            return None
+        if field == "model_labels":
+            return json.load(open(path))
+        with open(path) as f:
+            return f.read()
+
+    def load_dir(self, email_dir: str, lazy: bool = False) -> Dict:
+        metadata = json.load(open(Path(email_dir, "metadata.json")))
+        email = LazyEmail(
+            metadata, lambda field: self.load_field(email_dir, field), DIR_FIELD_FILES
+        )
+        return email if lazy else dict(email.items())
+
+    def load(self, email_id: str, lazy: bool = False) -> Dict:
+        return self.load_dir(Path(self.dataset_dir, email_id), lazy=lazy)
+
+    def email_ids(self) -> List[str]:
+        return [
+            f.name
+            for f in Path(self.dataset_dir).iterdir()
+            if Path(f, "metadata.json").exists()
+        ]
+
+    def iter_emails(self, lazy: bool = False) -> Iterator[Dict]:
+        for email_id in self.email_ids():
+            yield self.load(email_id, lazy=lazy)
+
+    def search(
+        self,
+        categories: List[str] = (),
+        match_all: bool = True,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        sender: Optional[str] = None,
+        thread_id: Optional[str] = None,
+    ) -> List[str]:
+        """Return ids of matching emails, oldest first (see SQLiteEmailStore.search).
+
+        The directory layout has no indexes, so every email is loaded.
+        """
+        categories = set(categories)
+        if not categories and not match_all:
+            return []
+        matches = []
+        for email in self.iter_emails(lazy=True):
+            date_ts = get_date_ts(email.get("date"))
+            if after is not None and (date_ts is None or date_ts < after):
+                continue
+            if before is not None and (date_ts is None or date_ts >= before):
+                continue
+            if sender is not None and not match_sender(email, sender):
+                continue
+            if thread_id is not None and email.get("thread_id") != thread_id:
+                continue
+            found = categories & set(get_categories(email["model_labels"]))
+            if (match_all and found == categories) or (not match_all and found):
+                matches.append((date_ts or 0, email["email_id"]))
+        return [email_id for _, email_id in sorted(matches)]
+
+    def find_by_google_id(self, google_id: str) -> List[str]:
+        return self.email_ids_by_google_id().get(google_id, [])
+
+    def email_ids_by_google_id(self) -> Dict[str, List[str]]:
+        email_ids = {}
+        for email_id in self.email_ids():
+            metadata = json.load(open(Path(self.dataset_dir, email_id, "metadata.json")))
+            email_ids.setdefault(metadata.get("google_id"), []).append(email_id)
+        return email_ids
+
+    def update(self, email_id: str, updates: Dict) -> None:
+        metadata_path = Path(self.dataset_dir, email_id, "metadata.json")
+        metadata = json.load(open(metadata_path))
+        metadata.update(updates)
+        json.dump(metadata, open(metadata_path, "w"), indent=2, default=dateconverter)
+
+    def delete(self, email_id: str) -> None:
+        shutil.rmtree(Path(self.dataset_dir, email_id), ignore_errors=True)
+
+
+def _execute_script(conn, script: str):
+    # executescript() would commit the migration's transaction halfway
+    for statement in script.split(";"):
+        if statement.strip():
+            conn.execute(statement)
+
+
+def _add_label_index(conn):
+    _execute_script(
+        conn,
+        """
+        ALTER TABLE emails ADD COLUMN date_ts REAL;
+        CREATE TABLE email_categories (
+            category TEXT NOT NULL,
+            email_id TEXT NOT NULL REFERENCES emails (email_id) ON DELETE CASCADE,
+            PRIMARY KEY (category, email_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX email_categories_email_id ON email_categories (email_id);
+        """
+    )
+    rows = conn.execute("SELECT email_id, metadata, model_labels FROM emails").fetchall()
+    for email_id, metadata, model_labels in rows:
+        conn.execute(
+            "UPDATE emails SET date_ts = ? WHERE email_id = ?",
+            (get_date_ts(json.loads(metadata).get("date")), email_id),
+        )
+        labels = json.loads(model_labels) if model_labels else None
+        conn.executemany(
+            "INSERT INTO email_categories VALUES (?, ?)",
+            [(category, email_id) for category in get_categories(labels)],
+        )
+
+
+def _add_content_addressing(conn):
+    # HTML bodies move to `blobs`, keyed by their sha256, the old html column
+    # is left empty
+    _execute_script(
+        conn,
+        """
+        ALTER TABLE emails ADD COLUMN digest TEXT;
+        ALTER TABLE emails ADD COLUMN html_digest TEXT;
+        CREATE TABLE blobs (digest TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE INDEX emails_html_digest ON emails (html_digest);
+        """,
+    )
+    rows = conn.execute(
+        "SELECT email_id, metadata, plain, html, markdown FROM emails"
+    ).fetchall()
+    for email_id, metadata, plain, html, markdown in rows:
+        html_digest = hash_text(html) if html else None
+        if html_digest:
+            conn.execute(
+                "INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)",
+                (html_digest, html),
+            )
+        conn.execute(
+            "UPDATE emails SET digest = ?, html_digest = ?, html = NULL WHERE email_id = ?",
+            (get_row_digest(metadata, plain, html_digest, markdown), html_digest, email_id),
+        )
+
+
+def _backfill_sender_fields(conn):
+    rows = conn.execute(
+        "SELECT email_id, metadata FROM emails WHERE sender_address IS NULL"
+    ).fetchall()
+    for email_id, metadata in rows:
+        metadata = json.loads(metadata)
+        conn.execute(
+            "UPDATE emails SET sender_address = :sender_address, "
+            "sender_domain = :sender_domain WHERE email_id = :email_id",
+            {**get_sender_fields(metadata), "email_id": email_id},
+        )
+
+
+def _add_sender_index(conn):
+    _execute_script(
+        conn,
+        """
+        ALTER TABLE emails ADD COLUMN sender_address TEXT;
+        ALTER TABLE emails ADD COLUMN sender_domain TEXT;
+        ALTER TABLE emails ADD COLUMN thread_id TEXT;
+        UPDATE emails SET thread_id = json_extract(metadata, '$.thread_id');
+        CREATE INDEX emails_sender_address ON emails (sender_address, date_ts);
+        CREATE INDEX emails_sender_domain ON emails (sender_domain, date_ts);
+        CREATE INDEX emails_thread_id ON emails (thread_id, date_ts);
+        """,
+    )
+    # Same normalization as `save`, which falls back to parsing the sender
+    _backfill_sender_fields(conn)
+
+
+def get_row_digest(
+    metadata: str, plain: Optional[str], html_digest: Optional[str], markdown: Optional[str]
+) -> str:
+    return hash_text(json.dumps([metadata, plain, html_digest, markdown]))
+
+
+# Each entry upgrades the database schema by one version (PRAGMA user_version),
+# either a SQL script or a function taking the connection
+SQLITE_MIGRATIONS = [
+    """
+    CREATE TABLE emails (
+        email_id TEXT PRIMARY KEY,
+        google_id TEXT,
+        metadata TEXT NOT NULL,
+        plain TEXT,
+        html TEXT,
+        markdown TEXT,
+        model_labels TEXT
+    );
+    CREATE INDEX emails_google_id ON emails (google_id);
+    """,
+    _add_label_index,
+    _add_content_addressing,
+    """
+    CREATE TABLE zstd_dicts (dict_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+    ALTER TABLE blobs ADD COLUMN codec TEXT NOT NULL DEFAULT 'none';
+    ALTER TABLE blobs ADD COLUMN dict_id INTEGER REFERENCES zstd_dicts (dict_id);
+    """,
+    "CREATE INDEX emails_date_ts ON emails (date_ts)",
+    _add_sender_index,
+    # Databases created by the first version of the previous migration only
+    # took sender_address from the metadata, not from the sender header
+    _backfill_sender_fields,
+]
+
+
+SQLITE_LAZY_FIELDS = ["plain", "html", "markdown"]
+
+
+class SQLiteEmailStore:
+    """All emails packed into a single SQLite database file.
+
+    Saving an email whose content matches the stored digest is skipped, and
+    HTML bodies are content-addressed so identical ones (newsletters, receipts)
+    are stored once, compressed with `codec` ("none", "gzip" or "zstd"). Bodies
+    are decompressed transparently on load, whatever codec they were written
+    with. Plain text and markdown bodies are stored in the emails table as is,
+    neither compressed nor deduplicated. Write counters are kept in `stats`.
+    """
+
+    def __init__(self, dataset_dir: str, codec: str = DEFAULT_BODY_CODEC):
+        self.dataset_dir = dataset_dir
+        self.set_codec(codec)
+        self.stats = Counter()
+        self._zstd_cache = threading.local()
+        Path(dataset_dir).mkdir(parents=True, exist_ok=True)
+        self.db_path = Path(dataset_dir, EMAIL_DB_NAME)
+        self.conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.lock = threading.RLock()
+        self._migrate()
+        self.dict_id = self.conn.execute("SELECT MAX(dict_id) FROM zstd_dicts").fetchone()[0]
+
+    def set_codec(self, codec: str):
+        """Compress bodies written from now on with `codec`."""
+        assert codec in BODY_CODECS, f"codec must be one of {BODY_CODECS}"
+        if codec == "zstd" and zstandard is None:
+            raise ImportError("The zstd codec requires `pip install zstandard`")
+        self.codec = codec
+
+    def _migrate(self):
+        with self.lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, step in enumerate(SQLITE_MIGRATIONS[version:], start=version + 1):
+                with self.transaction():
+                    if callable(step):
+                        step(self.conn)
+                    else:
+                        _execute_script(self.conn, step)
+                    self.conn.execute(f"PRAGMA user_version = {i}")
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one transaction (nested calls join the outer one)."""
+        with self.lock:
+            if self.conn.in_transaction:
+                yield
+                return
+            self.conn.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def save(self, email_id: str, email: Dict, labels: Dict = None) -> Path:
+        # Markdown lives in its own column rather than inside the metadata
+        metadata = get_metadata(email_id, email)
+        metadata.pop("markdown", None)
+        html = email.get("html") or None
+        row = {
+            "email_id": email_id,
+            "google_id": email.get("google_id"),
+            "metadata": json.dumps(metadata, default=dateconverter),
+            "plain": email.get("plain") or None,
+            "html_digest": hash_text(html) if html else None,
+            "markdown": email.get("markdown") or None,
+            "model_labels": json.dumps(labels) if labels is not None else None,
+            "date_ts": get_date_ts(email.get("date")),
+            "thread_id": email.get("thread_id"),
+            **get_sender_fields(email),
+        }
+        row["digest"] = get_row_digest(
+            row["metadata"], row["plain"], row["html_digest"], row["markdown"]
+        )
+        row_size = sum(
+            len(row[k] or "") for k in ["metadata", "plain", "markdown", "model_labels"]
+        )
+        with self.transaction():
+            existing = self.conn.execute(
+                "SELECT digest, html_digest, model_labels FROM emails WHERE email_id = ?",
+                (email_id,),
+            ).fetchone()
+            if (
+                existing is not None
+                and existing[0] == row["digest"]
+                and (labels is None or row["model_labels"] == existing[2])
+            ):
+                self.stats["skipped"] += 1
+                self.stats["bytes_skipped"] += row_size + len(html or "")
+                return self.db_path
+
+            if html:
+                blob = self.conn.execute(
+                    "SELECT length(data) FROM blobs WHERE digest = ?", (row["html_digest"],)
+                ).fetchone()
+                if blob is None:
+                    data, codec, dict_id = self.encode_body(html)
+                    self.conn.execute(
+                        "INSERT INTO blobs (digest, data, codec, dict_id) VALUES (?, ?, ?, ?)",
+                        (row["html_digest"], data, codec, dict_id),
+                    )
+                    row_size += len(data)
+                else:
+                    self.stats["html_deduped"] += 1
+                    self.stats["bytes_deduped"] += blob[0]
+
+            # Like the directory layout, existing labels are kept if none are given
+            self.conn.execute(
+                """
+                INSERT INTO emails (
+                    email_id, google_id, metadata, plain, html_digest, markdown,
+                    model_labels, date_ts, digest, sender_address, sender_domain,
+                    thread_id
+                )
+                VALUES (
+                    :email_id, :google_id, :metadata, :plain, :html_digest, :markdown,
+                    :model_labels, :date_ts, :digest, :sender_address, :sender_domain,
+                    :thread_id
+                )
+                ON CONFLICT (email_id) DO UPDATE SET
+                    google_id = excluded.google_id,
+                    metadata = excluded.metadata,
+                    plain = excluded.plain,
+                    html_digest = excluded.html_digest,
+                    markdown = excluded.markdown,
+                    model_labels = COALESCE(excluded.model_labels, model_labels),
+                    date_ts = excluded.date_ts,
+                    sender_address = excluded.sender_address,
+                    sender_domain = excluded.sender_domain,
+                    thread_id = excluded.thread_id,
+                    digest = excluded.digest
+                """,
+                row,
+            )
+            if existing is not None and existing[1] != row["html_digest"]:
+                self._delete_unused_blob(existing[1])
+            if labels is not None:
+                self.conn.execute(
+                    "DELETE FROM email_categories WHERE email_id = ?", (email_id,)
+                )
+                self.conn.executemany(
+                    "INSERT INTO email_categories VALUES (?, ?)",
+                    [(category, email_id) for category in get_categories(labels)],
+                )
+            self.stats["written"] += 1
+            self.stats["bytes_written"] += row_size
+        return self.db_path
+
+    def _delete_unused_blob(self, digest: Optional[str]):
+        if digest is not None:
+            self.conn.execute(
+                """
+                DELETE FROM blobs WHERE digest = ?
+                AND NOT EXISTS (SELECT 1 FROM emails WHERE html_digest = ?)
+                """,
+                (digest, digest),
+            )
+
+    def _zstd(self, kind: str, dict_id: Optional[int]):
+        # (De)compressors are reused, they aren't thread safe so keep one per thread
+        if not hasattr(self._zstd_cache, "codecs"):
+            self._zstd_cache.codecs = {}
+        cache = self._zstd_cache.codecs
+        if (kind, dict_id) not in cache:
+            kwargs = {}
+            if dict_id is not None:
+                with self.lock:
+                    row = self.conn.execute(
+                        "SELECT data FROM zstd_dicts WHERE dict_id = ?", (dict_id,)
+                    ).fetchone()
+                kwargs["dict_data"] = zstandard.ZstdCompressionDict(row[0])
+            if kind == "compressor":
+                cache[(kind, dict_id)] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, **kwargs)
+            else:
+                cache[(kind, dict_id)] = zstandard.ZstdDecompressor(**kwargs)
+        return cache[(kind, dict_id)]
+
+    def encode_body(self, text: str) -> Tuple[Any, str, Optional[int]]:
+        """Compress a body with the store's codec, returns (data, codec, dict_id)."""
+        if self.codec == "none":
+            return text, "none", None
+        data = text.encode("utf-8")
+        if self.codec == "gzip":
+            return gzip.compress(data, compresslevel=6, mtime=0), "gzip", None
+        return self._zstd("compressor", self.dict_id).compress(data), "zstd", self.dict_id
+
+    def decode_body(self, data: Any, codec: str, dict_id: Optional[int]) -> str:
+        if codec == "none":
+            return data
+        if codec == "gzip":
+            return gzip.decompress(data).decode("utf-8")
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed emails requires `pip install zstandard`")
+        return self._zstd("decompressor", dict_id).decompress(data).decode("utf-8")
+
+    def train_zstd_dictionary(
+        self, dict_size: int = ZSTD_DICT_SIZE, max_samples: int = 2000
+    ) -> int:
+        """Train a zstd dictionary on stored HTML bodies and use it for new writes.
+
+        Email HTML (inline CSS, templates) is very repetitive across messages, so
+        a shared dictionary compresses individual bodies much better. Call
+        `recompress` afterwards to apply it to existing bodies.
+        """
+        # zstd recommends ~100x the dictionary size of samples, more is just slower
+        max_sample_bytes = 100 * dict_size
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT data, codec, dict_id FROM blobs ORDER BY random() LIMIT ?",
+                (max_samples,),
+            ).fetchall()
+            if not rows:
+                raise ValueError("There are no stored HTML bodies to train a dictionary on")
+            samples, sample_bytes = [], 0
+            for row in rows:
+                sample = self.decode_body(*row).encode("utf-8")[: 10 * dict_size]
+                samples.append(sample)
+                sample_bytes += len(sample)
+                if sample_bytes > max_sample_bytes:
+                    break
+            zstd_dict = zstandard.train_dictionary(dict_size, samples, level=ZSTD_LEVEL)
+            cursor = self.conn.execute(
+                "INSERT INTO zstd_dicts (data) VALUES (?)", (zstd_dict.as_bytes(),)
+            )
+            self.dict_id = cursor.lastrowid
+        return self.dict_id
+
+    def recompress(self) -> Tuple[int, int]:
+        """Rewrite every stored body with the current codec and dictionary.
+
+        Returns the total size of the bodies before and after.
+        """
+        size_before, size_after = 0, 0
+        with self.transaction():
+            rows = self.conn.execute(
+                "SELECT digest, data, codec, dict_id FROM blobs"
+            ).fetchall()
+            for digest, *blob in rows:
+                data, codec, dict_id = self.encode_body(self.decode_body(*blob))
+                self.conn.execute(
+                    "UPDATE blobs SET data = ?, codec = ?, dict_id = ? WHERE digest = ?",
+                    (data, codec, dict_id, digest),
+                )
+                size_before += len(blob[0])
+                size_after += len(data)
+            self.conn.execute(
+                """
+                DELETE FROM zstd_dicts WHERE dict_id IS NOT ?
+                AND dict_id NOT IN (SELECT dict_id FROM blobs WHERE dict_id IS NOT NULL)
+                """,
+                (self.dict_id,),
+            )
+        return size_before, size_after
+
+    def _select(self, lazy: bool) -> str:
+        columns = "emails.email_id, metadata, model_labels"
+        if lazy:
+            return f"SELECT {columns} FROM emails"
+        return (
+            f"SELECT {columns}, plain, markdown, blobs.data, blobs.codec, blobs.dict_id "
+            "FROM emails LEFT JOIN blobs ON blobs.digest = emails.html_digest"
+        )
+
+    def _row_to_email(self, row, lazy: bool = False) -> Dict:
+        email_id, metadata, model_labels, *bodies = row
+        email = json.loads(metadata)
+        if lazy:
+            email = LazyEmail(
+                email,
+                lambda field: self.load_field(email_id, field),
+                SQLITE_LAZY_FIELDS,
+            )
+        else:
+            plain, markdown, *html_blob = bodies
+            email["plain"] = plain
+            email["html"] = self.decode_body(*html_blob) if html_blob[0] else None
+            email["markdown"] = markdown
+        email["model_labels"] = json.loads(model_labels) if model_labels else None
+        return email
+
+    def load_field(self, email_id: str, field: str) -> Any:
+        assert field in SQLITE_LAZY_FIELDS, f"{field} is not a body field"
+        with self.lock:
+            if field == "html":
+                row = self.conn.execute(
+                    """
+                    SELECT blobs.data, blobs.codec, blobs.dict_id
+                    FROM emails JOIN blobs ON blobs.digest = emails.html_digest
+                    WHERE email_id = ?
+                    """,
+                    (email_id,),
+                ).fetchone()
+                return self.decode_body(*row) if row else None
+            row = self.conn.execute(
+                f"SELECT {field} FROM emails WHERE email_id = ?", (email_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def load(self, email_id: str, lazy: bool = False) -> Dict:
+        with self.lock:
+            row = self.conn.execute(
+                f"{self._select(lazy)} WHERE emails.email_id = ?", (email_id,)
+            ).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Email {email_id} not found in {self.db_path}")
+        return self._row_to_email(row, lazy=lazy)
+
+    def email_ids(self) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT email_id FROM emails ORDER BY rowid")
+            return [row[0] for row in rows]
+
+    def iter_emails(self, lazy: bool = False) -> Iterator[Dict]:
+        with self.lock:
+            rows = self.conn.execute(
+                f"{self._select(lazy)} ORDER BY emails.rowid"
+            ).fetchall()
+        for row in rows:
+            yield self._row_to_email(row, lazy=lazy)
+
+    def search(
+        self,
+        categories: List[str] = (),
+        match_all: bool = True,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        sender: Optional[str] = None,
+        thread_id: Optional[str] = None,
+    ) -> List[str]:
+        """Return ids of matching emails, oldest first.
+
+        Uses the indexes only, no email is loaded.
+
+        Args:
+            categories: Model label categories, matched through email_categories
+            match_all: If true emails need all `categories`, otherwise any of them
+            after: Unix timestamp, only emails sent at or after it
+            before: Unix timestamp, only emails sent before it
+            sender: Sender address (colin@gather.town) or domain (gather.town)
+            thread_id: Gmail thread id
+        """
+        categories = sorted(set(categories))
+        if not categories and not match_all:
+            return []
+        conditions, params = [], []
+        if sender is not None:
+            sender = sender.lower()
+            if "@" in sender.lstrip("@"):
+                conditions.append("sender_address = ?")
+            else:
+                conditions.append("sender_domain = ?")
+                sender = sender.lstrip("@")
+            params.append(sender)
+        if thread_id is not None:
+            conditions.append("thread_id = ?")
+            params.append(thread_id)
+        if categories and (conditions or after is not None or before is not None):
+            # Walk the indexed range and probe email_categories per email
+            probe = (
+                "EXISTS (SELECT 1 FROM email_categories AS c "
+                "WHERE c.email_id = emails.email_id AND c.category = ?)"
+            )
+            operator = " AND " if match_all else " OR "
+            conditions.append("(" + operator.join([probe] * len(categories)) + ")")
+            params += categories
+        elif categories:
+            operator = " INTERSECT " if match_all else " UNION "
+            matches = operator.join(
+                ["SELECT email_id FROM email_categories WHERE category = ?"]
+                * len(categories)
+            )
+            conditions.append(f"email_id IN ({matches})")
+            params += categories
+        # Range scan on the date (or sender/thread, date) index: O(log n + k)
+        if after is not None:
+            conditions.append("date_ts >= ?")
+            params.append(after)
+        if before is not None:
+            conditions.append("date_ts < ?")
+            params.append(before)
+        query = "SELECT email_id FROM emails"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            rows = self.conn.execute(f"{query} ORDER BY date_ts, rowid", params)
+            return [row[0] for row in rows]
+
+    def find_by_google_id(self, google_id: str) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT email_id FROM emails WHERE google_id = ?", (google_id,)
+            )
+            return [row[0] for row in rows]
+
+    def email_ids_by_google_id(self) -> Dict[str, List[str]]:
+        email_ids = {}
+        with self.lock:
+            rows = self.conn.execute("SELECT google_id, email_id FROM emails")
+            for google_id, email_id in rows:
+                email_ids.setdefault(google_id, []).append(email_id)
+        return email_ids
+
+    def update(self, email_id: str, updates: Dict) -> None:
+        with self.transaction():
+            metadata, plain, html_digest, markdown = self.conn.execute(
+                "SELECT metadata, plain, html_digest, markdown FROM emails "
+                "WHERE email_id = ?",
+                (email_id,),
+            ).fetchone()
+            metadata = json.loads(metadata)
+            metadata.update(updates)
+            metadata = json.dumps(metadata, default=dateconverter)
+            self.conn.execute(
+                "UPDATE emails SET metadata = ?, digest = ? WHERE email_id = ?",
+                (
+                    metadata,
+                    get_row_digest(metadata, plain, html_digest, markdown),
+                    email_id,
+                ),
+            )
+
+    def delete(self, email_id: str) -> None:
+        with self.transaction():
+            row = self.conn.execute(
+                "SELECT html_digest FROM emails WHERE email_id = ?", (email_id,)
+            ).fetchone()
+            self.conn.execute("DELETE FROM emails WHERE email_id = ?", (email_id,))
+            if row is not None:
+                self._delete_unused_blob(row[0])
+
+    def close(self):
+        self.conn.close()
+
+
+_stores = {}
+
+
+def is_legacy_dataset(dataset_dir: str) -> bool:
+    """True if `dataset_dir` holds per-email directories and no emails.db."""
+    path = Path(dataset_dir)
+    return (
+        not Path(path, EMAIL_DB_NAME).exists()
+        and path.is_dir()
+        and any(Path(f, "metadata.json").exists() for f in path.iterdir())
+    )
+
+
+def dataset_exists(dataset_dir: str) -> bool:
+    """True if emails have been saved to `dataset_dir`, in either layout.
+
+    Read-only callers check this first, since `get_email_store` creates an
+    empty emails.db for a new dataset.
+    """
+    return Path(dataset_dir, EMAIL_DB_NAME).exists() or is_legacy_dataset(dataset_dir)
+
+
+def get_email_store(dataset_dir: str):
+    """Return the email store for a dataset directory.
+
+    Directories holding legacy per-email directories (and no emails.db) use
+    DirEmailStore, everything else uses SQLiteEmailStore.
+    """
+    key = str(Path(dataset_dir).resolve())
+    if key not in _stores:
+        if is_legacy_dataset(dataset_dir):
+            print(
+                f"WARNING: {dataset_dir} uses the legacy directory-per-email layout. "
+                "Searches load every email and HTML bodies aren't compressed or "
+                "deduplicated, run `python higgins_cli.py migrate-email-store` "
+                "to move it into emails.db."
+            )
+            _stores[key] = DirEmailStore(dataset_dir)
+        else:
+            _stores[key] = SQLiteEmailStore(dataset_dir)
+    return _stores[key]
+
+
+def migrate_dir_to_sqlite(dataset_dir: str, remove_dirs: bool = False) -> int:
+    """Copy a directory-per-email dataset into emails.db in the same directory.
+
+    Returns the number of emails migrated. The email directories are deleted
+    afterwards if `remove_dirs` is set.
+    """
+    source = DirEmailStore(dataset_dir)
+    target = SQLiteEmailStore(dataset_dir)
+    email_ids = source.email_ids()
+    with target.transaction():
+        for email_id in email_ids:
+            email = source.load(email_id)
+            target.save(email_id, email, email.pop("model_labels"))
+    if remove_dirs:
+        for email_id in email_ids:
+            source.delete(email_id)
+    _stores[str(Path(dataset_dir).resolve())] = target
+    return len(email_ids)
+
+
+def generate_email_corpus(num_emails: int, num_senders: int = 20, seed: int = 0):
+    """Yield synthetic marketing-style emails (large inline-CSS HTML) for benchmarking."""
+    rng = random.Random(seed)
+    words = "sale offer new free shipping limited deal exclusive member today save".split()
+    templates = []
+    for s in range(num_senders):
+        rules = "\n".join(
+            f".c{s}-{i} {{ color: #{rng.randrange(16**6):06x}; padding: {rng.randrange(20)}px; "
+            f"font-family: Helvetica, Arial, sans-serif; font-size: {rng.randrange(10, 30)}px; "
+            f"line-height: 1.{rng.randrange(10)}; margin: 0 auto; max-width: 600px; }}"
+            for i in range(300)
+        )
+        templates.append(f"<html><head><style>{rules}</style></head><body>$rows</body></html>")
+    for i in range(num_emails):
+        sender = i % num_senders
+        rows = "".join(
+            f'<tr><td class="c{sender}-{rng.randrange(300)}" style="border: 1px solid #eee">'
+            f'<a href="https://click.example.com/{rng.getrandbits(64):016x}">'
+            f"{' '.join(rng.choices(words, k=8))}</a> ${rng.randrange(5, 500)}.99</td></tr>"
+            for _ in range(40)
+        )
+        yield {
+            "sender": f"news@brand{sender}.com",
+            "recipient": "me@example.com",
+            "subject": f"Deals {i}",
+            "date": datetime(2021, 1, 1 + i % 28),
+            "plain": f"Deals {i}",
+            "html": templates[sender].replace("$rows", f"<table>{rows}</table>"),
+        }
+
+
+def benchmark_codecs(num_emails: int = 2000, num_loads: int = 500):
+    """Report compression ratio and load latency of each body codec."""
+    emails = list(generate_email_corpus(num_emails))
+    raw_bytes = sum(len(e["html"].encode("utf-8")) for e in emails)
+    print(f"{num_emails} emails, {raw_bytes / 1024 / 1024:.1f} MB of HTML")
+
+    codecs = [("none", False), ("gzip", False)]
+    if zstandard is not None:
+        codecs += [("zstd", False), ("zstd", True)]
+    for codec, train_dict in codecs:
+        with tempfile.TemporaryDirectory() as dataset_dir:
+            store = SQLiteEmailStore(dataset_dir, codec=codec)
+            start = time.time()
+            with store.transaction():
+                for i, email in enumerate(emails):
+                    store.save(str(i), email)
+            if train_dict:
+                store.train_zstd_dictionary()
+                store.recompress()
+            write_secs = time.time() - start
+            stored_bytes = store.conn.execute(
+                "SELECT SUM(length(data)) FROM blobs"
+            ).fetchone()[0]
+
+            email_ids = random.Random(0).sample(range(num_emails), num_loads)
+            start = time.time()
+            for email_id in email_ids:
+                store.load(str(email_id))
+            load_ms = (time.time() - start) / num_loads * 1000
+            store.close()
+        name = codec + (" + dictionary" if train_dict else "")
+        print(
+            f"{name}: ratio {raw_bytes / stored_bytes:.1f}x, "
+            f"{stored_bytes / 1024 / 1024:.1f} MB stored, "
+            f"write {write_secs:.1f}s, load {load_ms:.2f} ms/email"
+        )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark_codecs()
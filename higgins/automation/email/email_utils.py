@@ -2,7 +2,6 @@ from datetime import datetime
 import email
 import hashlib
 from html2text import HTML2Text
-import json
 import mistletoe
 from pathlib import Path
 import re
@@ -13,12 +12,23 @@ from typing import Dict, List, Tuple, Union
 from bs4 import BeautifulSoup
 
 from higgins.automation.email import email_model
-from higgins.nlp import html2plain
-
-
-def dateconverter(o):
-    if isinstance(o, datetime):
-        return o.__str__()
+from higgins.automation.email.email_store import (
+    DirEmailStore,
+    dataset_exists,
+    dateconverter,  # noqa: F401
+    get_date_ts,
+    get_email_store,
+)
+from higgins.nlp import html_cache
+
+# Gmail's month/year are calendar based, these approximate them locally
+NEWER_THAN_UNIT_SECONDS = {
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+    "year": 365 * 86400,
+}
 
 
 def is_valid_email(email):
@@ -173,8 +183,8 @@ def parse_html_v4(html):
 
 
 def parse_email_html(html: str) -> dict:
-    # Minify HTML, Simplify HTML, Convert To Text
-    return html2plain.parse_html(html)
+    # Simplified HTML, plain text and markdown from a single parse, cached by digest
+    return html_cache.convert_html(html)
 
 
 def get_body_stats(body):
@@ -195,7 +205,7 @@ def save_email(
 ) -> str:
     # Google has a unique identifier, but for now..
     email_id = hash_email(email)
-    _ = save_email_to_dir(email_id, email, dataset_dir, labels)
+    _ = get_email_store(dataset_dir).save(email_id, email, labels)
     if include_elastic:
         _ = save_email_to_elastic(email)
     return email_id
@@ -214,32 +224,53 @@ def normalize_email_address(email_in):
 
 
 def load_email(
-    email_id: str = None, email_dir: str = None, dataset_dir: str = "data/emails"
+    email_id: str = None,
+    email_dir: str = None,
+    dataset_dir: str = "data/emails",
+    lazy: bool = False,
 ) -> Dict:
-    if email_dir is None:
-        assert email_id is not None, "must provide email_id or email_dir"
-        email_dir = Path(dataset_dir, email_id)
-    email = json.load(open(Path(email_dir, "metadata.json")))
-    email.update({"plain": None, "html": None, "model_labels": None})
-    plain_path = Path(email_dir, "body.plain")
-    if plain_path.exists():
-        with open(plain_path) as f:
-            email["plain"] = f.read()
-
-    html_path = Path(email_dir, "body.html")
-    if html_path.exists():
-        with open(html_path) as f:
-            email["html"] = f.read()
-
-    labels_path = Path(email_dir, "model_labels.json")
-    if labels_path.exists():
-        email["model_labels"] = json.load(open(labels_path))
+    """Load a locally stored email.
+
+    If `lazy` is set, body fields (plain, html, ...) are read when first accessed.
+    """
+    if email_dir is not None:
+        return DirEmailStore(Path(email_dir).parent).load_dir(email_dir, lazy=lazy)
+    assert email_id is not None, "must provide email_id or email_dir"
+    if not dataset_exists(dataset_dir):
+        raise FileNotFoundError(f"Email {email_id} not found, {dataset_dir} has no emails")
+    return get_email_store(dataset_dir).load(email_id, lazy=lazy)
+
+
+def get_local_email_ids_by_google_id(
+    dataset_dir: str = "data/emails",
+) -> Dict[str, List[str]]:
+    """Map Gmail ids to the ids of locally stored emails."""
+    if not dataset_exists(dataset_dir):
+        return {}
+    return get_email_store(dataset_dir).email_ids_by_google_id()
+
+
+def update_local_email(
+    email_id: str, updates: Dict, dataset_dir: str = "data/emails"
+) -> None:
+    """Update metadata fields (e.g. label_ids) of a locally stored email."""
+    get_email_store(dataset_dir).update(email_id, updates)
 
-    return email
+
+def delete_local_email(email_id: str, dataset_dir: str = "data/emails") -> None:
+    get_email_store(dataset_dir).delete(email_id)
 
 
 def search_local_emails(
-    categories: List[str], match_all: bool = True, dataset_dir: str = "data/emails"
+    categories: List[str] = (),
+    match_all: bool = True,
+    dataset_dir: str = "data/emails",
+    lazy: bool = True,
+    newer_than: Union[Tuple[int, str], str] = None,
+    after: Union[datetime, str, float] = None,
+    before: Union[datetime, str, float] = None,
+    sender: str = None,
+    thread_id: str = None,
 ) -> List[Dict]:
     """Search local database of emails.
 
@@ -247,17 +278,33 @@ def search_local_emails(
         categories: List of categories to include in query (e.g. flights, personal)
         match_all: If true, all categories in `categories` must be present in emails.
             If false, a match will occur if any category is present.
+        lazy: If true, email bodies are only read when first accessed.
+        newer_than: Only emails from the last (num, unit), e.g. (3, "day") or "3 days"
+        after: Only emails sent at or after this date (datetime, string or timestamp)
+        before: Only emails sent before this date
+        sender: Only emails from this address (colin@gather.town) or domain (gather.town)
+        thread_id: Only emails in this Gmail thread
+
+    Returns:
+        Matching emails, oldest first
     """
-    email_dirs = [f for f in Path(dataset_dir).iterdir() if f.is_dir()]
-    emails = []
-    for email_dir in email_dirs:
-        email = load_email(email_dir=email_dir, dataset_dir=dataset_dir)
-        matches = set(categories) & set(email["model_labels"]["categories"])
-        if match_all:
-            if len(matches) == len(categories):  # match all
-                emails.append(email)
-        elif len(matches) > 0:  # match any
-            emails.append(email)
+    if not dataset_exists(dataset_dir):
+        print(f"No emails saved in {dataset_dir}")
+        return []
+    after = get_date_ts(after)
+    if newer_than is not None:
+        cutoff = get_newer_than_timestamp(newer_than)
+        after = cutoff if after is None else max(after, cutoff)
+    store = get_email_store(dataset_dir)
+    email_ids = store.search(
+        categories,
+        match_all=match_all,
+        after=after,
+        before=get_date_ts(before),
+        sender=sender,
+        thread_id=thread_id,
+    )
+    emails = [store.load(email_id, lazy=lazy) for email_id in email_ids]
     print(f"search returned {len(emails)}")
     return emails
 
@@ -267,6 +314,9 @@ def save_email_to_dir(
 ) -> str:
     """Save email body and metadata to email dataset directory.
 
+    This is the legacy directory-per-email layout, `save_email` writes to
+    whichever store `get_email_store` picks for `dataset_dir`.
+
     Args:
         email: dictionary of email body and metadata (from google)
         dataset_dir: root directory of email dataset
@@ -275,62 +325,43 @@ def save_email_to_dir(
     Returns
         Email directory path
 
-    Steps:
-    1. Hash the parameters into a unique string (perhaps add salt)
-        hash = subject, sender, recipient, date, body, cc, bcc?
-    2. Create a directory named `{email_dir}/{email_hash}`
-    3. Save the email data to the directory as follows:
-        body.plain
-        body.html  <-- optional
-        metadata.json
-            sender: str  <--ensure valid email? Include name?
-            recipient: str  <--ensure valid email? Include name?
-            subject: str
-            labels: List[str]
-            google_id: str
-        edits.txt  <-- optional
-            FEEDBACK
-                blah blah blah
-            REVISED_EMAIL
-                blah blah blah
-        labels.json <-- optional
-            summary: str
-            categories: List[str]
-            question_answer: Tuple[str, str]
+    Layout:
+        {dataset_dir}/{email_id}/
+            body.plain
+            body.html  <-- optional
+            body.md  <-- optional
+            metadata.json
+                sender: str
+                recipient: str
+                subject: str
+                labels: List[str]
+                google_id: str
+            model_labels.json <-- optional
+                summary: str
+                categories: List[str]
+                question_answer: Tuple[str, str]
     """
-    email_dir = Path(dataset_dir, email_id)
-    email_dir.mkdir(parents=True, exist_ok=True)  # danger, may overwrite
-
-    print(f"Saving email to: {email_dir}")
-
-    exclude_fields = ["plain", "html", "attachments"]
-    metadata = {k: v for k, v in email.items() if k not in exclude_fields}
-    metadata["email_id"] = email_id
-    # metadata["date"] = metadata["date"].isoformat()
-
-    json.dump(
-        metadata,
-        open(Path(email_dir, "metadata.json"), "w"),
-        indent=2,
-        default=dateconverter,
-    )
+    return DirEmailStore(dataset_dir).save(email_id, email, labels)
 
-    if bool(email.get("plain")):
-        with open(Path(email_dir, "body.plain"), "w") as f:
-            f.write(email["plain"])
 
-    if bool(email.get("html")):
-        with open(Path(email_dir, "body.html"), "w") as f:
-            f.write(email["html"])
+def parse_newer_than_param(param: Union[Tuple[int, str], str]) -> Tuple[int, str]:
+    """Parse (1, "day"), "1 day" or "1,day" into (num, unit)."""
+    if isinstance(param, str):
+        if "," in param:
+            num, unit = param.replace(" ", "").split(",")
+        else:
+            num, unit = param.split()
+    else:
+        num, unit = param
+    num = int(num)
 
-    if bool(email.get("markdown")):
-        with open(Path(email_dir, "body.md"), "w") as f:
-            f.write(email["markdown"])
+    if unit[-1] == "s":
+        unit = unit[:-1]
 
-    if labels is not None:
-        json.dump(labels, open(Path(email_dir, "model_labels.json"), "w"), indent=2)
+    if unit not in NEWER_THAN_UNIT_SECONDS:
+        raise Exception(f"`newer_than` unit '{unit}' not supported.")
 
-    return email_dir
+    return num, unit
 
 
 def format_newer_than_param(param: Union[Tuple[int, str], str]) -> Tuple:
@@ -343,18 +374,7 @@ def format_newer_than_param(param: Union[Tuple[int, str], str]) -> Tuple:
         Tuple of field_name, field_value
     """
     field_name = "newer_than"
-    if isinstance(param, str):
-        if "," in param:
-            num, unit = param.replace(" ", "").split(",")
-        else:
-            num, unit = param.split()
-        num = int(num)
-
-    if unit[-1] == "s":
-        unit = unit[:-1]
-
-    if unit not in ["hour", "day", "month", "week", "year"]:
-        raise Exception(f"`newer_than` unit '{unit}' not supported.")
+    num, unit = parse_newer_than_param(param)
 
     if unit == "week":
         field_value = num * 7, "day"
@@ -367,6 +387,12 @@ def format_newer_than_param(param: Union[Tuple[int, str], str]) -> Tuple:
     return field_name, field_value
 
 
+def get_newer_than_timestamp(param: Union[Tuple[int, str], str]) -> float:
+    """Convert a newer_than parameter into the unix timestamp it starts from."""
+    num, unit = parse_newer_than_param(param)
+    return time.time() - num * NEWER_THAN_UNIT_SECONDS[unit]
+
+
 def hash_email(email: Dict) -> str:
     hash_input = ""
     hash_input += f"{email['sender']}"
@@ -1,5 +1,4 @@
-from tornado.httpclient import HTTPClient, HTTPRequest
-from tornado.ioloop import IOLoop
+from tornado.httpclient import HTTPClient, HTTPClientError, HTTPRequest
 import tornado.options
 import json
 import time
@@ -11,6 +10,16 @@ import quopri
 import chardet
 from bs4 import BeautifulSoup
 import logging
+import multiprocessing
+import bisect
+import collections
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+
+from higgins.automation.email.mbox_reader import MBoxIndex
+from higgins.database import elastic
 
 http_client = HTTPClient()
 
@@ -64,82 +73,223 @@ def create_index():
             "number_of_replicas": 0,
         },
         "mappings": {
-            "email": {
-                "_source": {"enabled": True},
-                "properties": {
-                    "from": {"type": "string", "index": "not_analyzed"},
-                    "return-path": {"type": "string", "index": "not_analyzed"},
-                    "delivered-to": {"type": "string", "index": "not_analyzed"},
-                    "message-id": {"type": "string", "index": "not_analyzed"},
-                    "to": {"type": "string", "index": "not_analyzed"},
-                    "date_ts": {"type": "date"},
-                },
-            }
+            "_source": {"enabled": True},
+            "properties": {
+                "from": {"type": "keyword"},
+                "return-path": {"type": "keyword"},
+                "delivered-to": {"type": "keyword"},
+                "message-id": {"type": "keyword"},
+                "to": {"type": "keyword"},
+                "date_ts": {"type": "date"},
+            },
         },
-        "refresh": True,
     }
 
     body = json.dumps(schema)
     url = "%s/%s" % (tornado.options.options.es_url, tornado.options.options.index_name)
+    request = HTTPRequest(
+        url,
+        method="PUT",
+        body=body,
+        request_timeout=240,
+        headers={"Content-Type": "application/json"},
+    )
     try:
-        request = HTTPRequest(
-            url,
-            method="PUT",
-            body=body,
-            request_timeout=240,
-            headers={"Content-Type": "application/json"},
-        )
         response = http_client.fetch(request)
         logging.info("Create index done   %s" % response.body)
-    except:
-        pass
-
-
-total_uploaded = 0
-
-
-def upload_batch(upload_data):
-    if tornado.options.options.dry_run:
-        logging.info("Dry run, not uploading")
-        return
-    upload_data_txt = ""
-    for item in upload_data:
+    except HTTPClientError as e:
+        error = json.loads(e.response.body)["error"] if e.response else {}
+        if error.get("type") != "resource_already_exists_exception":
+            raise
+        logging.info("Index %s already exists" % tornado.options.options.index_name)
+
+
+class BulkSink:
+    """Streams documents to the Elasticsearch `_bulk` endpoint.
+
+    Documents are encoded as NDJSON into a reusable byte buffer, which is sent
+    once it reaches `max_bytes` (or `max_docs`). Up to `max_in_flight` bulk
+    requests run concurrently on background threads and `add` blocks while
+    all of them are busy. Items rejected with a retryable status in the
+    per-item `errors` response are resent on their own, with backoff, as are
+    whole requests that fail with a retryable status or a connection error.
+
+    `add` and `flush` return a Future for each request sent, which resolves
+    to the set of acknowledged document ids. Acknowledged and failed
+    documents are counted in `total_uploaded` and `total_failed`. Documents
+    that can't be encoded as JSON are never sent, they count as failed and
+    their ids are kept in `unencodable`.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Tornado reports connection errors and timeouts as HTTP 599
+    REQUEST_RETRY_STATUSES = RETRY_STATUSES | {599}
+
+    def __init__(
+        self,
+        es_url,
+        index_name,
+        max_bytes=5 * 1024 * 1024,
+        max_docs=DEFAULT_BATCH_SIZE,
+        max_in_flight=2,
+        max_retries=3,
+        dry_run=False,
+    ):
+        self.url = es_url + "/_bulk"
+        self.index_name = index_name
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.max_retries = max_retries
+        self.dry_run = dry_run
+        self.total_uploaded = 0
+        self.total_failed = 0
+        self.unencodable = set()
+        self._buffer = bytearray()
+        self._ids = []
+        self._spans = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def add(self, item):
         cmd = {
             "index": {
-                "_index": tornado.options.options.index_name,
+                "_index": self.index_name,
                 "_type": "email",
                 "_id": item["message-id"],
             }
         }
         try:
-            json_cmd = json.dumps(cmd) + "\n"
-            json_item = json.dumps(item) + "\n"
-        except:
-            logging.warn(
+            line = (json.dumps(cmd) + "\n" + json.dumps(item) + "\n").encode("utf-8")
+        except Exception:
+            logging.warning(
                 "Skipping mail with message id %s because of exception converting to JSON (invalid characters?)."
                 % item["message-id"]
             )
-            continue
-        upload_data_txt += json_cmd
-        upload_data_txt += json_item
+            self.unencodable.add(item["message-id"])
+            with self._lock:
+                self.total_failed += 1
+            return None
+        start = len(self._buffer)
+        self._buffer += line
+        self._ids.append(item["message-id"])
+        self._spans.append((start, len(self._buffer)))
+        if len(self._buffer) >= self.max_bytes or len(self._ids) >= self.max_docs:
+            return self.flush()
+        return None
 
-    request = HTTPRequest(
-        tornado.options.options.es_url + "/_bulk",
-        method="POST",
-        body=upload_data_txt,
-        request_timeout=240,
-        headers={"Content-Type": "application/json"},
-    )
-    response = http_client.fetch(request)
-    result = json.loads(response.body)
+    def flush(self):
+        if not self._ids:
+            return None
+        body, ids, spans = bytes(self._buffer), self._ids, self._spans
+        del self._buffer[:]
+        self._ids, self._spans = [], []
+        if self.dry_run:
+            logging.info("Dry run, not uploading")
+            future = Future()
+            future.set_result(None)
+            return future
+        self._slots.acquire()  # backpressure
+        try:
+            return self._executor.submit(self._send, body, ids, spans)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        for client in self._clients:
+            client.close()
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = HTTPClient()
+            with self._lock:
+                self._clients.append(self._local.client)
+        return self._local.client
+
+    def _post(self, body):
+        request = HTTPRequest(
+            self.url,
+            method="POST",
+            body=body,
+            request_timeout=240,
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        return json.loads(self._client().fetch(request).body)
 
-    global total_uploaded
-    total_uploaded += len(upload_data)
-    res_txt = "OK" if not result["errors"] else "FAILED"
-    logging.info(
-        "Upload: %s - upload took: %4dms, total messages uploaded: %6d"
-        % (res_txt, result["took"], total_uploaded)
-    )
+    def _send(self, body, ids, spans):
+        try:
+            acked = set()
+            for attempt in range(self.max_retries + 1):
+                if attempt > 0:
+                    time.sleep(min(2 ** (attempt - 1), 30))
+                try:
+                    result = self._post(body)
+                except (HTTPClientError, OSError) as e:
+                    code = getattr(e, "code", 599)
+                    if code not in self.REQUEST_RETRY_STATUSES or attempt == self.max_retries:
+                        raise
+                    logging.warning("Bulk request failed (%s), retrying" % e)
+                    continue
+
+                retry, uploaded, failed = [], 0, 0
+                for i, response in enumerate(result["items"]):
+                    action = next(iter(response.values()))
+                    status = action.get("status", 500)
+                    if status < 300:
+                        acked.add(ids[i])
+                        uploaded += 1
+                    elif status in self.RETRY_STATUSES:
+                        retry.append(i)
+                    else:
+                        failed += 1
+                        logging.warning(
+                            "Failed to index %s: %s" % (ids[i], action.get("error"))
+                        )
+                if retry and attempt == self.max_retries:
+                    logging.warning("Giving up on %d rejected items" % len(retry))
+                    failed += len(retry)
+
+                with self._lock:
+                    self.total_uploaded += uploaded
+                    self.total_failed += failed
+                    res_txt = "OK" if not result["errors"] else "FAILED"
+                    logging.info(
+                        "Upload: %s - upload took: %4dms, total messages uploaded: %6d, "
+                        "failed: %d"
+                        % (res_txt, result["took"], self.total_uploaded, self.total_failed)
+                    )
+                if not retry or attempt == self.max_retries:
+                    break
+
+                # Resend only the rejected items
+                logging.warning("Retrying %d rejected items" % len(retry))
+                retry_spans = []
+                offset = 0
+                for i in retry:
+                    length = spans[i][1] - spans[i][0]
+                    retry_spans.append((offset, offset + length))
+                    offset += length
+                body = b"".join(body[spans[i][0] : spans[i][1]] for i in retry)
+                ids = [ids[i] for i in retry]
+                spans = retry_spans
+            return acked
+        finally:
+            self._slots.release()
+
+
+def commit_completed(checkpoint, index, batches, stalled=False, wait=False, skipped=()):
+    """Commit checkpoint progress for bulk requests that finished, in mbox order."""
+    while batches and (wait or batches[0][0].done()):
+        future, pending = batches.popleft()
+        stalled = commit_progress(
+            checkpoint, index, pending, future.result(), stalled, skipped
+        )
+    return stalled
 
 
 def normalize_email(email_in):
@@ -221,46 +371,310 @@ def convert_msg_to_json(msg):
     return result
 
 
+_worker_mbox = None
+
+
+def init_worker(infile, option_values):
+    # Options are defined under __main__, which spawned workers don't run
+    for name, value in option_values.items():
+        if name in tornado.options.options:
+            setattr(tornado.options.options, name, value)
+        else:
+            tornado.options.define(name, default=value)
+    global _worker_mbox
+    _worker_mbox = open(infile, "rb")
+
+
+def read_mbox_message(handle, start, stop):
+    handle.seek(start)
+    from_line = handle.readline()
+    msg = mailbox.mboxMessage(handle.read(stop - handle.tell()))
+    msg.set_from(from_line[5:].rstrip(b"\r\n").decode("ascii", "replace"))
+    return msg
+
+
+def convert_message_ranges(ranges, handle=None):
+    """Read and convert a chunk of mbox messages (inside a worker process)."""
+    handle = handle or _worker_mbox
+    items = []
+    for start, stop in ranges:
+        try:
+            msg = read_mbox_message(handle, start, stop)
+            items.append(convert_msg_to_json(msg))
+        except Exception as e:
+            logging.warning("Skipping message at offset %d: %s" % (start, e))
+            items.append(None)
+    return items
+
+
+def iter_converted_mbox(infile, index, positions, workers=1, chunk_size=100):
+    """Convert mbox messages, optionally across a process pool, in mbox order.
+
+    Message boundaries come from the sidecar `MBoxIndex`, so the mbox is only
+    scanned for messages appended since the last run. The parent hands out
+    chunks of byte ranges and workers read their ranges directly from the
+    file, so message bytes are never pickled between processes.
+
+    Yields (position, item) tuples, item is None if the message was skipped.
+    """
+    chunks = [positions[i : i + chunk_size] for i in range(0, len(positions), chunk_size)]
+    logging.info(
+        "Converting %d messages with %d workers" % (len(positions), workers)
+    )
+    ranges = ([index.range(i) for i in chunk] for chunk in chunks)
+    if workers <= 1:
+        with open(infile, "rb") as handle:
+            for chunk, chunk_ranges in zip(chunks, ranges):
+                for item in zip(chunk, convert_message_ranges(chunk_ranges, handle)):
+                    yield item
+        return
+
+    with multiprocessing.Pool(
+        processes=workers,
+        initializer=init_worker,
+        initargs=(infile, tornado.options.options.as_dict()),
+    ) as pool:
+        for chunk, items in zip(chunks, pool.imap(convert_message_ranges, ranges)):
+            for item in zip(chunk, items):
+                yield item
+
+
+def iter_converted_mh(mbox, skip=0):
+    # Skipping on keys to avoid expensive read operations on skipped messages
+    msgkeys = mbox.keys()[skip:]
+    for msgkey in msgkeys:
+        msg = mbox[msgkey]
+        yield None, convert_msg_to_json(msg)
+
+
+def normalize_message_id(message_id):
+    """Unfold a Message-ID header and drop its whitespace, as MBoxIndex does."""
+    if message_id is None:
+        return None
+    return "".join(str(message_id).split())
+
+
+class IngestCheckpoint:
+    """Persistent progress of an mbox import.
+
+    The checkpoint file holds the committed byte offset (every message before
+    it is indexed) and the Message-ID of the message just before it, which is
+    used to detect a re-exported mbox. Message-IDs acknowledged by
+    Elasticsearch are appended to `<checkpoint>.ids`, one per line.
+    Message-IDs are normalized (see `normalize_message_id`) before they are
+    written or looked up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids_path = path + ".ids"
+        self.offset = 0
+        self.last_message_id = None
+        self.message_ids = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.offset = state["offset"]
+            self.last_message_id = normalize_message_id(state["last_message_id"])
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path) as f:
+                self.message_ids = {normalize_message_id(line) for line in f} - {""}
+
+    def __contains__(self, message_id):
+        return normalize_message_id(message_id) in self.message_ids
+
+    def reset(self):
+        for path in [self.path, self.ids_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.offset = 0
+        self.last_message_id = None
+        self.message_ids = set()
+
+    def resume_position(self, index):
+        """Return the index position to resume from, 0 if the mbox changed."""
+        position = bisect.bisect_left(index.offsets, self.offset)
+        if position < len(index) and index.offsets[position] != self.offset:
+            valid = False
+        elif position == len(index) and index.end != self.offset:
+            valid = False
+        else:
+            last_id = index.message_ids[position - 1] if position > 0 else None
+            valid = normalize_message_id(last_id) == self.last_message_id
+        if not valid:
+            logging.warning(
+                "Mbox changed since last checkpoint, skipping indexed messages by Message-ID"
+            )
+            return 0
+        return position
+
+    def commit(self, index, position, message_ids):
+        """Record indexed message ids and that all messages before `position` are done.
+
+        If `position` is None only the message ids are recorded.
+        """
+        new_ids = {normalize_message_id(i) for i in message_ids} - self.message_ids - {""}
+        if new_ids:
+            with open(self.ids_path, "a") as f:
+                f.writelines(message_id + "\n" for message_id in new_ids)
+                f.flush()
+                os.fsync(f.fileno())
+            self.message_ids |= new_ids
+        if position is None:
+            return
+
+        self.offset = index.offsets[position] if position < len(index) else index.end
+        self.last_message_id = (
+            normalize_message_id(index.message_ids[position - 1]) if position > 0 else None
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"offset": self.offset, "last_message_id": self.last_message_id}, f)
+        os.replace(tmp_path, self.path)
+
+
+def commit_progress(checkpoint, index, pending, acked, stalled=False, skipped=()):
+    """Advance the checkpoint up to the first message that was not acknowledged.
+
+    Once a message fails the offset stalls there for the rest of the run, so a
+    restart retries it. Later acknowledged messages are skipped by Message-ID.
+    Messages in `skipped` (e.g. that can't be encoded, so a retry would fail
+    again) don't stall the offset. Returns whether the checkpoint is stalled.
+    """
+    if checkpoint is None or acked is None or not pending:
+        return stalled
+    position = pending[-1][0] + 1
+    for pending_position, item in pending:
+        if item and item["message-id"] not in acked and item["message-id"] not in skipped:
+            position = pending_position
+            break
+    checkpoint.commit(index, None if stalled else position, acked)
+    return stalled or position <= pending[-1][0]
+
+
 def load_from_file():
 
-    if tornado.options.options.init:
-        delete_index()
-    create_index()
+    if not tornado.options.options.dry_run:
+        if tornado.options.options.init:
+            delete_index()
+        create_index()
 
     if tornado.options.options.skip:
         logging.info("Skipping first %d messages" % tornado.options.options.skip)
 
-    upload_data = list()
+    checkpoint = None
+    index = None
 
     if tornado.options.options.infile:
+        infile = tornado.options.options.infile
+        logging.info("Starting import from mbox file %s" % infile)
+        index = MBoxIndex(infile)
+        checkpoint = IngestCheckpoint(
+            tornado.options.options.checkpoint or infile + ".checkpoint"
+        )
+        if tornado.options.options.init:
+            checkpoint.reset()
+
+        start = tornado.options.options.skip
+        if not tornado.options.options.incremental:
+            start = max(start, checkpoint.resume_position(index))
+        # Messages already indexed by an interrupted run or a previous export
+        positions = [
+            i
+            for i in range(start, len(index))
+            if index.message_ids[i] not in checkpoint
+        ]
         logging.info(
-            "Starting import from mbox file %s" % tornado.options.options.infile
+            "Resuming at message %d, %d of %d messages left to index"
+            % (start, len(positions), len(index))
+        )
+        items = iter_converted_mbox(
+            infile, index, positions, workers=tornado.options.options.workers
         )
-        mbox = mailbox.mbox(tornado.options.options.infile)
     else:
         logging.info(
             "Starting import from MH directory %s" % tornado.options.options.indir
         )
+        if tornado.options.options.workers > 1:
+            logging.warning("--workers is only supported for mbox files, using 1")
         mbox = mailbox.MH(tornado.options.options.indir, factory=None, create=False)
+        items = iter_converted_mh(mbox, skip=tornado.options.options.skip)
 
-    # Skipping on keys to avoid expensive read operations on skipped messages
-    msgkeys = mbox.keys()[tornado.options.options.skip :]
-
-    for msgkey in msgkeys:
-        msg = mbox[msgkey]
-        item = convert_msg_to_json(msg)
-
-        if item:
-            upload_data.append(item)
-            if len(upload_data) == tornado.options.options.batch_size:
-                upload_batch(upload_data)
-                upload_data = list()
+    if tornado.options.options.dry_run or not tornado.options.options.bulk_load:
+        index_settings = contextlib.nullcontext()
+    else:
+        index_settings = elastic.bulk_load_mode(
+            elastic.get_client(hosts=[tornado.options.options.es_url]),
+            tornado.options.options.index_name,
+            force_merge=tornado.options.options.force_merge,
+        )
+    with index_settings:
+        stalled = upload_items(items, checkpoint, index)
+    if checkpoint is not None and not stalled and not tornado.options.options.dry_run:
+        # Any messages after the last converted one were skipped as already indexed
+        checkpoint.commit(index, len(index), [])
+
+
+def upload_items(items, checkpoint=None, index=None):
+    """Upload converted items, committing checkpoint progress as batches are acked."""
+    sink = BulkSink(
+        tornado.options.options.es_url,
+        tornado.options.options.index_name,
+        max_bytes=tornado.options.options.bulk_bytes,
+        max_docs=tornado.options.options.batch_size,
+        max_in_flight=tornado.options.options.max_in_flight,
+        dry_run=tornado.options.options.dry_run,
+    )
+    start_time = time.time()
+    total_count = 0
+    pending = list()
+    batches = collections.deque()  # (future, pending) of requests in flight
+    stalled = False
+    try:
+        for position, item in items:
+            total_count += 1
+            pending.append((position, item))
+            future = sink.add(item) if item else None
+            if future is not None:
+                batches.append((future, pending))
+                pending = list()
+                elapsed = time.time() - start_time
+                logging.info(
+                    "Processed %d messages - %.1f messages/sec"
+                    % (total_count, total_count / max(elapsed, 1e-6))
+                )
+            stalled = commit_completed(
+                checkpoint, index, batches, stalled, skipped=sink.unencodable
+            )
 
-    # upload remaining items in `upload_batch`
-    if upload_data:
-        upload_batch(upload_data)
+        # upload remaining items in the buffer
+        future = sink.flush()
+        if future is not None:
+            batches.append((future, pending))
+            pending = list()
+    finally:
+        sink.close()
+    stalled = commit_completed(
+        checkpoint, index, batches, stalled, wait=True, skipped=sink.unencodable
+    )
+    if pending and not tornado.options.options.dry_run:
+        stalled = commit_progress(
+            checkpoint, index, pending, set(), stalled, sink.unencodable
+        )
 
-    logging.info("Import done - total count %d" % len(mbox.keys()))
+    elapsed = time.time() - start_time
+    logging.info(
+        "Import done - total count %d in %.1fs (%.1f messages/sec), "
+        "%d uploaded, %d failed"
+        % (
+            total_count,
+            elapsed,
+            total_count / max(elapsed, 1e-6),
+            sink.total_uploaded,
+            sink.total_failed,
+        )
+    )
+    return stalled
 
 
 if __name__ == "__main__":
@@ -304,11 +718,63 @@ if __name__ == "__main__":
         "batch_size",
         type=int,
         default=DEFAULT_BATCH_SIZE,
-        help="Elasticsearch bulk index batch size",
+        help="Maximum number of messages in an Elasticsearch bulk request",
+    )
+
+    tornado.options.define(
+        "bulk_bytes",
+        type=int,
+        default=5 * 1024 * 1024,
+        help="Maximum size in bytes of an Elasticsearch bulk request",
     )
 
     tornado.options.define(
-        "skip", type=int, default=0, help="Number of messages to skip from mailbox"
+        "max_in_flight",
+        type=int,
+        default=2,
+        help="Number of concurrent Elasticsearch bulk requests",
+    )
+
+    tornado.options.define(
+        "bulk_load",
+        type=bool,
+        default=True,
+        help="Disable refreshes and replicas on the index while importing",
+    )
+
+    tornado.options.define(
+        "force_merge",
+        type=bool,
+        default=False,
+        help="Force merge the index into a single segment after importing",
+    )
+
+    tornado.options.define(
+        "skip",
+        type=int,
+        default=0,
+        help="Number of messages to skip from mailbox (mbox imports resume from --checkpoint)",
+    )
+
+    tornado.options.define(
+        "checkpoint",
+        type=str,
+        default=None,
+        help="Path of the ingestion checkpoint (default: <infile>.checkpoint)",
+    )
+
+    tornado.options.define(
+        "incremental",
+        type=bool,
+        default=False,
+        help="Scan the whole mbox, skipping messages already indexed (e.g. a newer export)",
+    )
+
+    tornado.options.define(
+        "workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse messages (mbox files only)",
     )
 
     tornado.options.define(
@@ -345,6 +811,6 @@ if __name__ == "__main__":
 
     # Exactly one of {infile, indir} must be set
     if bool(tornado.options.options.infile) ^ bool(tornado.options.options.indir):
-        IOLoop.instance().run_sync(load_from_file)
+        load_from_file()
     else:
         tornado.options.print_help()
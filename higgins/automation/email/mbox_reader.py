@@ -4,9 +4,19 @@ http://www.relevantmisc.com/scraping/2020/01/29/processing-mbox/
 
 
 """
+from array import array
+import bisect
+from datetime import timezone
 import email
+from email.parser import BytesHeaderParser
 from email.policy import default
+import email.utils
+import logging
 import mailbox
+import mmap
+import os
+import time
+import weakref
 import bs4
 
 
@@ -25,21 +35,399 @@ def getbody(message):  # getting plain text 'email body'
     return body
 
 
+def scan_messages(handle, offset=0):
+    """Yield (offset, length, message_id) for each message starting at `offset`."""
+    handle.seek(offset)
+    start = None
+    message_id = ""
+    in_header = False
+    in_message_id = False
+    for line in handle:
+        if line.startswith(b'From '):
+            if start is not None:
+                yield start, offset - start, message_id
+            start = offset
+            message_id = ""
+            in_header = True
+            in_message_id = False
+        elif in_header:
+            if line in (b'\n', b'\r\n'):
+                in_header = False
+            elif in_message_id and line[:1] in (b' ', b'\t'):
+                message_id += line.strip().decode('ascii', 'replace')
+            else:
+                in_message_id = line[:11].lower() == b'message-id:'
+                if in_message_id and not message_id:
+                    message_id = line[11:].strip().decode('ascii', 'replace')
+        offset += len(line)
+    if start is not None:
+        yield start, offset - start, message_id
+
+
+class MBoxIndex:
+    """Sidecar index of message offsets, lengths and Message-IDs for an mbox file.
+
+    The index is stored next to the mbox as `<filename>.idx`, one
+    `offset\tlength\tmessage_id` record per line. It is built once and new
+    messages appended to the mbox are appended to the index on `update()`.
+    """
+    def __init__(self, filename, index_path=None):
+        self.filename = filename
+        self.index_path = index_path or str(filename) + '.idx'
+        self.offsets = array('q')
+        self.lengths = array('q')
+        self.message_ids = []
+        self._positions = {}
+        self.update()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.offsets[i], self.lengths[i], self.message_ids[i]
+
+    @property
+    def end(self):
+        if not self.offsets:
+            return 0
+        return self.offsets[-1] + self.lengths[-1]
+
+    def position(self, message_id):
+        """Return the position of a message given its Message-ID, or None."""
+        message_id = message_id.strip()
+        if message_id in self._positions:
+            return self._positions[message_id]
+        return self._positions.get(f"<{message_id.strip('<>')}>")
+
+    def range(self, i):
+        return self.offsets[i], self.offsets[i] + self.lengths[i]
+
+    def _clear(self):
+        self.offsets = array('q')
+        self.lengths = array('q')
+        self.message_ids = []
+        self._positions = {}
+
+    def _add(self, offset, length, message_id):
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.message_ids.append(message_id)
+        if message_id:
+            self._positions.setdefault(message_id, len(self.offsets) - 1)
+
+    def load(self):
+        self._clear()
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path) as f:
+            for line in f:
+                offset, length, message_id = line.rstrip('\n').split('\t', 2)
+                self._add(int(offset), int(length), message_id)
+
+    def is_valid(self):
+        """Check the index still matches the mbox (e.g. it wasn't re-exported)."""
+        if not self.offsets:
+            return True
+        if self.end > os.path.getsize(self.filename):
+            return False
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offsets[-1])
+            return f.read(5) == b'From '
+
+    def update(self):
+        """Load the sidecar index and append any messages added to the mbox."""
+        self.load()
+        if not self.is_valid():
+            self._clear()
+            os.remove(self.index_path)
+
+        if self.end == os.path.getsize(self.filename):
+            return
+
+        # The last indexed message may have been incomplete, so rescan it
+        start = self.offsets[-1] if self.offsets else 0
+        with open(self.filename, 'rb') as f:
+            records = list(scan_messages(f, start))
+
+        if self.offsets and records and records[0][1] != self.lengths[-1]:
+            self.offsets.pop()
+            self.lengths.pop()
+            self.message_ids.pop()
+            mode = 'w'
+            records = list(zip(self.offsets, self.lengths, self.message_ids)) + records
+            self._clear()
+        else:
+            mode = 'a'
+            records = records[1:] if self.offsets else records
+
+        with open(self.index_path, mode) as f:
+            for offset, length, message_id in records:
+                self._add(offset, length, message_id)
+                f.write(f"{offset}\t{length}\t{message_id}\n")
+
+    def shards(self, n):
+        """Split the mbox into at most `n` byte ranges of roughly equal size.
+
+        Range boundaries fall on message starts, so each range can be streamed
+        independently with `MBoxReader.iter_range`.
+        """
+        if not self.offsets:
+            return []
+        bounds = [0]
+        for k in range(1, n):
+            i = bisect.bisect_left(self.offsets, self.end * k // n)
+            if i < len(self.offsets) and self.offsets[i] > bounds[-1]:
+                bounds.append(self.offsets[i])
+        bounds.append(self.end)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_message(data):
+    """Parse raw mbox message bytes or memoryview (starting with the `From ` line)."""
+    data = bytes(data)
+    return email.message_from_bytes(data[data.index(b'\n') + 1:], policy=default)
+
+
+def iter_message_views(buf, start=0, stop=None):
+    """Yield zero-copy memoryview slices of each message in an mmap'd mbox.
+
+    Each slice starts at a `From ` line and ends just past the newline before
+    the next one. `start` must be a message start, e.g. from `MBoxIndex.shards`.
+    """
+    stop = len(buf) if stop is None else stop
+    view = memoryview(buf)
+    try:
+        while start < stop:
+            end = buf.find(b'\nFrom ', start, stop)
+            end = stop if end == -1 else end + 1
+            yield view[start:end]
+            start = end
+    finally:
+        view.release()
+
+
+def read_header_block(data, chunk_size=8192):
+    """Return the raw header block of a message, without its `From ` line.
+
+    Only a prefix of `data` is copied, so message bodies are never touched.
+    """
+    size = chunk_size
+    while True:
+        head = bytes(data[:size])
+        end = head.find(b'\n\n')
+        crlf_end = head.find(b'\n\r\n')
+        if end == -1 or (crlf_end != -1 and crlf_end < end):
+            end = crlf_end
+        if end != -1 or size >= len(data):
+            head = head if end == -1 else head[:end + 1]
+            return head[head.find(b'\n') + 1:]
+        size *= 4
+
+
+class HeaderFilter:
+    """Predicate over message headers, used to skip messages before parsing bodies.
+
+    Args:
+        senders: Addresses (or raw header values) matched against From/Sender
+        recipients: Addresses (or raw header values) matched against
+            To/Cc/Bcc/Delivered-To/Recipient
+        after: Only match messages dated on or after this datetime
+        before: Only match messages dated before this datetime
+        labels: Match if any of these Gmail labels (X-Gmail-Labels) are present
+    """
+    SENDER_HEADERS = ['from', 'sender']
+    RECIPIENT_HEADERS = ['to', 'cc', 'bcc', 'delivered-to', 'recipient']
+
+    def __init__(self, senders=None, recipients=None, after=None, before=None, labels=None):
+        self.senders = self._lower_set(senders)
+        self.recipients = self._lower_set(recipients)
+        self.after = self._utc(after)
+        self.before = self._utc(before)
+        self.labels = self._lower_set(labels)
+
+    @staticmethod
+    def _lower_set(values):
+        if values is None:
+            return None
+        return {v.strip().lower() for v in values}
+
+    @staticmethod
+    def _utc(dt):
+        if dt is not None and dt.tzinfo is None:
+            return dt.replace(tzinfo=timezone.utc)
+        return dt
+
+    @staticmethod
+    def _addresses(headers, names):
+        values = []
+        for name in names:
+            values += [str(v) for v in headers.get_all(name, [])]
+        addresses = {v.strip().lower() for v in values}
+        addresses |= {addr.lower() for _, addr in email.utils.getaddresses(values) if addr}
+        return addresses
+
+    def __call__(self, headers):
+        if self.senders is not None:
+            if not self.senders & self._addresses(headers, self.SENDER_HEADERS):
+                return False
+        if self.recipients is not None:
+            if not self.recipients & self._addresses(headers, self.RECIPIENT_HEADERS):
+                return False
+        if self.labels is not None:
+            labels = str(headers.get('x-gmail-labels', '')).split(',')
+            if not self.labels & self._lower_set(labels):
+                return False
+        if self.after is not None or self.before is not None:
+            try:
+                date = self._utc(email.utils.parsedate_to_datetime(str(headers['date'])))
+            except (TypeError, ValueError):
+                return False
+            if self.after is not None and date < self.after:
+                return False
+            if self.before is not None and date >= self.before:
+                return False
+        return True
+
+
 class MBoxReader:
-    """Stream read very large Mbox file."""
-    def __init__(self, filename):
+    """Stream read very large Mbox file.
+
+    Random access (`reader[i]`, `by_message_id`) and `shards` use a sidecar
+    `MBoxIndex`, which is built on first use.
+
+    With `use_mmap=True` the file is memory mapped and split on `\nFrom `
+    separators with `mmap.find` instead of `readline()`. `iter_raw()` then
+    yields memoryview slices, which are only parsed into `email.message`
+    objects by `parse_message` (or by iterating the reader). Closing the
+    reader releases any slices still held, so copy what outlives it.
+    """
+    def __init__(self, filename, index_path=None, use_mmap=False):
+        self.filename = filename
+        self.index_path = index_path
         self.handle = open(filename, 'rb')
         assert self.handle.readline().startswith(b'From ')
+        self._index = None
+        self._random_handle = None
+        self._mmap = None
+        # Memoryviews of the map and the generators yielding them, released on close
+        self._views = weakref.WeakSet()
+        self._view_iters = weakref.WeakSet()
+        if use_mmap:
+            self._mmap = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._mmap is not None:
+            self._close_mmap()
         self.handle.close()
+        if self._random_handle is not None:
+            self._random_handle.close()
+
+    def _close_mmap(self):
+        # An mmap can't be closed while memoryviews of it exist
+        for view_iter in list(self._view_iters):
+            view_iter.close()
+        for view in list(self._views):
+            try:
+                view.release()
+            except BufferError:
+                pass  # exported, e.g. by np.frombuffer
+        try:
+            self._mmap.close()
+        except BufferError:
+            logging.warning(
+                "Leaving %s memory mapped, buffers exported from message views "
+                "are still in use" % self.filename
+            )
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = MBoxIndex(self.filename, self.index_path)
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_bytes(self, i):
+        if self._mmap is not None:
+            offset, length, _ = self.index[i]
+            with memoryview(self._mmap) as view:
+                data = view[offset:offset + length]
+            self._views.add(data)
+            return data
+        if self._random_handle is None:
+            self._random_handle = open(self.filename, 'rb')
+        offset, length, _ = self.index[i]
+        self._random_handle.seek(offset)
+        return self._random_handle.read(length)
+
+    def __getitem__(self, i):
+        return parse_message(self.read_bytes(i))
+
+    def by_message_id(self, message_id):
+        i = self.index.position(message_id)
+        if i is None:
+            raise KeyError(message_id)
+        return self[i]
+
+    def shards(self, n):
+        return self.index.shards(n)
+
+    def filter(self, senders=None, recipients=None, after=None, before=None,
+               labels=None, limit=None):
+        """Yield parsed messages matching all the given header predicates.
+
+        Only the header block of each message is parsed (see `HeaderFilter`),
+        bodies are decoded for matching messages only.
+        """
+        predicate = HeaderFilter(senders, recipients, after, before, labels)
+        parser = BytesHeaderParser(policy=default)
+        count = 0
+        for data in self.iter_raw():
+            headers = parser.parsebytes(read_header_block(data))
+            if predicate(headers):
+                yield parse_message(data)
+                count += 1
+                if limit is not None and count >= limit:
+                    break
+
+    def iter_range(self, start, stop):
+        """Stream the messages in byte range [start, stop), e.g. one of `shards`."""
+        for data in self.iter_raw(start, stop):
+            yield parse_message(data)
 
     def __iter__(self):
+        if self._mmap is not None:
+            return (parse_message(view) for view in self.iter_raw())
         return iter(self.__next__())
 
+    def iter_raw(self, start=0, stop=None):
+        """Yield unparsed messages in byte range [start, stop)."""
+        if self._mmap is not None:
+            views = iter_message_views(self._mmap, start, stop)
+            self._view_iters.add(views)
+            for view in views:
+                self._views.add(view)
+                yield view
+            return
+        with open(self.filename, 'rb') as f:
+            offset = start
+            f.seek(start)
+            lines = []
+            for line in f:
+                if stop is not None and offset >= stop:
+                    break
+                if line.startswith(b'From ') and lines:
+                    yield b''.join(lines)
+                    lines = []
+                lines.append(line)
+                offset += len(line)
+            if lines:
+                yield b''.join(lines)
+
     def __next__(self):
         lines = []
         while True:
@@ -147,6 +535,12 @@ def strip_footer(text):
 
 
 def get_member_emails(mbox, sender_list, limit=100):
+    if isinstance(mbox, MBoxReader):
+        return list(mbox.filter(
+            senders=sender_list,
+            recipients=["friends@example.com"],
+            limit=None if limit is None else limit + 1,
+        ))
     msgs = []
     for msg in mbox:
         if (msg["sender"] in sender_list and msg["recipient"] is not None and "friends@example.com" == msg["recipient"]):
@@ -174,7 +568,69 @@ def print_msgs(msg_list, f=sys.stdout):
 
 
 
+def generate_mbox(fpath, size_mb):
+    """Write a synthetic mbox of roughly `size_mb` megabytes for benchmarking."""
+    body = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n" * 40
+    with open(fpath, 'w') as f:
+        i = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            f.write(
+                f"From {i}@xxx Mon Jan  1 00:00:00 2021\n"
+                f"Message-ID: <{i}@example.com>\n"
+                f"From: sender{i % 100}@example.com\n"
+                f"To: friends@example.com\n"
+                f"Date: Mon, 1 Jan 2021 00:00:00 +0000\n"
+                f"Subject: Message {i}\n"
+                f"X-Gmail-Labels: Inbox,Category{i % 7}\n\n"
+                f"{body}\n"
+            )
+            i += 1
+
+
+def benchmark_readers(fpath, size_mb=2048):
+    """Compare MB/s of the readline reader against the mmap splitter."""
+    if not os.path.exists(fpath):
+        print(f"Generating {size_mb}MB mbox at {fpath}")
+        generate_mbox(fpath, size_mb)
+    file_mb = os.path.getsize(fpath) / 1024 / 1024
+
+    def run(name, fn):
+        start = time.time()
+        count = fn()
+        elapsed = time.time() - start
+        print(f"{name}: {count} messages, {file_mb / elapsed:.1f} MB/s")
+
+    def readline_parse():
+        with MBoxReader(fpath) as mbox:
+            return sum(1 for _ in mbox)
+
+    def readline_split():
+        with MBoxReader(fpath) as mbox:
+            return sum(1 for _ in mbox.iter_raw())
+
+    def mmap_split():
+        with MBoxReader(fpath, use_mmap=True) as mbox:
+            count = 0
+            for view in mbox.iter_raw():
+                view.release()
+                count += 1
+            return count
+
+    def mmap_parse():
+        with MBoxReader(fpath, use_mmap=True) as mbox:
+            return sum(1 for _ in mbox)
+
+    run("readline + parse", readline_parse)
+    run("readline split", readline_split)
+    run("mmap split", mmap_split)
+    run("mmap split + parse", mmap_parse)
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark_readers("data/benchmark.mbox")
+        sys.exit(0)
+
     fpath = "data/google/Mail/Category Travel.mbox"
     fpath = "data/google/Mail/Sent.mbox"
     # fpath = "data/google/Mail/Inbox.mbox"
@@ -0,0 +1,109 @@
+"""Rebuild the plain text, Markdown and simplified HTML of stored emails.
+
+`gmail.update_local_emails` refetches every email from the Gmail API to rerun
+the HTML preprocessing. This reads the HTML already in the email store instead
+and converts it across a process pool, so a full-corpus rebuild after a
+converter change is a local, CPU-bound job:
+
+    python higgins_cli.py reprocess-email-store --workers 8
+
+Workers read the HTML of their chunk straight from the store, so only email ids
+and conversion outputs are pickled between processes. The parent writes each
+chunk back in one transaction (emails.db) or with atomic file renames
+(directory layout). Emails whose outputs didn't change are skipped by the store.
+"""
+
+import multiprocessing
+import os
+from typing import Dict, List, Optional, Tuple
+
+from higgins.automation.email import email_store
+from higgins.nlp import html_cache, html_converter
+
+_worker_store = None
+_worker_use_cache = True
+# SQLite connections inherited from the parent, kept open so the child never closes them
+_inherited = []
+
+
+def init_worker(dataset_dir: str, use_cache: bool = True, forked: bool = True):
+    global _worker_store, _worker_use_cache
+    if forked:
+        # Connections opened before fork() mustn't be used from the child
+        _inherited.extend([*email_store._stores.values(), html_cache._cache])
+        email_store._stores.clear()
+        html_cache._cache = None
+    _worker_store = email_store.get_email_store(dataset_dir)
+    _worker_use_cache = use_cache
+
+
+def convert_emails(email_ids: List[str]) -> List[Tuple[str, Optional[Dict]]]:
+    """Convert the stored HTML of `email_ids`, outputs are None for emails without HTML."""
+    convert = html_cache.convert_html if _worker_use_cache else html_converter.convert_html
+    results = []
+    for email_id in email_ids:
+        html = _worker_store.load(email_id, lazy=True).get("html")
+        results.append((email_id, convert(html) if html else None))
+    return results
+
+
+def iter_converted_emails(
+    dataset_dir: str,
+    email_ids: List[str],
+    workers: int = 1,
+    chunk_size: int = 100,
+    use_cache: bool = True,
+):
+    """Yield lists of (email_id, outputs) for each chunk of `email_ids`."""
+    chunks = [email_ids[i : i + chunk_size] for i in range(0, len(email_ids), chunk_size)]
+    if workers <= 1:
+        init_worker(dataset_dir, use_cache, forked=False)
+        for chunk in chunks:
+            yield convert_emails(chunk)
+        return
+
+    with multiprocessing.Pool(
+        processes=workers, initializer=init_worker, initargs=(dataset_dir, use_cache)
+    ) as pool:
+        for results in pool.imap(convert_emails, chunks):
+            yield results
+
+
+def reprocess_local_emails(
+    dataset_dir: str = "data/emails",
+    workers: int = None,
+    chunk_size: int = 100,
+    use_cache: bool = True,
+) -> Dict:
+    """Rerun the HTML conversion on every stored email and save changed outputs.
+
+    Returns the store's write stats for the run, plus the number of emails
+    without HTML (left untouched).
+    """
+    from tqdm import tqdm
+
+    workers = workers if workers is not None else os.cpu_count()
+    store = email_store.get_email_store(dataset_dir)
+    stats_before = store.stats.copy()
+    email_ids = store.email_ids()
+    no_html = 0
+    print(f"Reprocessing {len(email_ids)} emails in {dataset_dir} with {workers} workers")
+    with tqdm(total=len(email_ids)) as pbar:
+        for results in iter_converted_emails(
+            dataset_dir, email_ids, workers, chunk_size, use_cache
+        ):
+            with store.transaction():
+                for email_id, outputs in results:
+                    if outputs is None:
+                        no_html += 1
+                        continue
+                    email = store.load(email_id)
+                    labels = email.pop("model_labels", None)
+                    email["html"] = outputs["simplified"] or email["html"]
+                    email["plain"] = outputs["text"]
+                    email["markdown"] = outputs["markdown"]
+                    store.save(email_id, email, labels)
+            pbar.update(len(results))
+    stats = store.stats - stats_before
+    stats["no_html"] = no_html
+    return stats
@@ -10,6 +10,7 @@ from txtai.embeddings import Embeddings
 from txtai.pipeline.extractor import Extractor
 from txtai.pipeline import Similarity
 
+from higgins.database import elastic
 from higgins.nlp.openai.email_questions import rank_strings
 from . import email_utils
 
@@ -21,9 +22,7 @@ SIMILARITY_BATCH_SIZE = 10
 
 def bulk_load_docs():
     # Connect to ES instance
-    es = Elasticsearch(
-        hosts=["http://localhost:9200"], timeout=60, retry_on_timeout=True
-    )
+    es = elastic.get_client()
 
     dataset = []
     # Elasticsearch bulk buffer
@@ -52,7 +51,7 @@ def bulk_load_docs():
 
 
 def get_all(query: Dict):
-    client = Elasticsearch()
+    client = elastic.get_client()
     s = Search(using=client, index="email")
     resp = s.execute()
     print(f"Hits: {resp.hits.total.value}")
@@ -278,9 +277,7 @@ def elasticsearch_dense_vectors():
 
 if __name__ == "__main__":
     # search_elastic_emails({})
-    # es = Elasticsearch(
-    #     hosts=["http://localhost:9200"], timeout=60, retry_on_timeout=True
-    # )
+    # es = elastic.get_client()
     # test_semantic_search(es)
     # test_extractive_qa_verification_codes()
     # test_extractive_qa_flights()
@@ -1,6 +1,7 @@
 """Query, Search, Parse Emails from Gmail.
 
-TODO: Paginate over large requests. Right now it will timeout trying to download 1000s of emails.
+Use `iter_emails` for large queries, it pages through results and downloads
+messages concurrently instead of all at once.
 
 Setup instructions here: https://github.com/jeremyephron/simplegmail
 
@@ -12,19 +13,28 @@ Setup instructions here: https://github.com/jeremyephron/simplegmail
 https://developers.google.com/gmail/api/quickstart/python
 """
 
-from typing import Dict, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import dateutil
 import elasticsearch
-import elasticsearch_dsl
+from elasticsearch import helpers
+from googleapiclient.errors import HttpError
 import pytz
 from simplegmail import Gmail
 from simplegmail.message import Message
 from simplegmail.query import construct_query
 import traceback
 
-from higgins.automation.email import email_model, email_utils
-from higgins.nlp import html2plain
+from higgins import const
+from higgins.automation.email import email_model, email_store, email_utils
+from higgins.database import elastic
+from higgins.nlp import html_cache
 
 
 def send_email(
@@ -116,7 +126,51 @@ def search_emails(
         }
     ]
     """
-
+    return list(iter_emails(query_dicts, limit=limit, include_html=include_html))
+
+
+def iter_message_refs(
+    client: Gmail,
+    query: str,
+    page_size: int = 500,
+    user_id: str = "me",
+    include_spam_trash: bool = False,
+) -> Iterator[Dict]:
+    """Page through the ids of messages matching a Gmail query."""
+    page_token = None
+    while True:
+        response = (
+            client.service.users()
+            .messages()
+            .list(
+                userId=user_id,
+                q=query,
+                maxResults=page_size,
+                pageToken=page_token,
+                includeSpamTrash=include_spam_trash,
+            )
+            .execute()
+        )
+        yield from response.get("messages", [])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+
+def iter_emails(
+    query_dicts: List[Dict],
+    limit: int = None,
+    include_html: bool = False,
+    max_workers: int = 8,
+    page_size: int = 500,
+) -> Iterator[Dict]:
+    """Yield emails matching queries as they are downloaded.
+
+    Message ids are fetched page by page and messages are downloaded by a
+    bounded pool of threads, each with its own Gmail client. Emails are
+    yielded in query order, so callers can start processing before the whole
+    result set is downloaded. See `search_emails` for the query format.
+    """
     print(f"Searching emails with query {query_dicts}")
 
     for dct in query_dicts:
@@ -156,17 +210,59 @@ def search_emails(
     # print(f"User labels: {labels}")
     query = construct_query(*query_dicts)
     print(query)
-    messages = client.get_messages(query=query)
-    print(f"Query returned {len(messages)} messages")
-    emails = []
-    for message in messages[:limit]:
+
+    message_refs = iter_message_refs(client, query, page_size=page_size)
+    if limit is not None:
+        message_refs = itertools.islice(message_refs, limit)
+
+    count = 0
+    for email in fetch_emails(
+        client, message_refs, labels, include_html=include_html, max_workers=max_workers
+    ):
+        count += 1
+        yield email
+    print(f"Query returned {count} messages")
+
+
+def fetch_emails(
+    client: Gmail,
+    message_refs: Iterator[Dict],
+    labels: List,
+    include_html: bool = False,
+    max_workers: int = 8,
+) -> Iterator[Dict]:
+    """Download and convert messages on a bounded thread pool, in order."""
+    local = threading.local()
+
+    def fetch(message_ref):
+        if not hasattr(local, "client"):
+            # httplib2 isn't thread safe, so each thread gets its own client.
+            # simplegmail lists labels for every message, reuse ours instead.
+            local.client = Gmail(_creds=client.creds)
+            local.client.list_labels = lambda user_id="me": labels
         try:
-            email = convert_message_to_dict(message, include_html)
-            emails.append(email)
+            message = local.client._build_message_from_ref(
+                user_id="me", message_ref=message_ref
+            )
+            return convert_message_to_dict(message, include_html)
         except Exception as e:
             print(e)
             print(traceback.format_exc())
-    return emails
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for message_ref in message_refs:
+            futures.append(executor.submit(fetch, message_ref))
+            # Bound the number of downloaded emails waiting to be consumed
+            while futures and (len(futures) > max_workers * 2 or futures[0].done()):
+                email = futures.popleft().result()
+                if email is not None:
+                    yield email
+        while futures:
+            email = futures.popleft().result()
+            if email is not None:
+                yield email
 
 
 def convert_message_to_dict(message: Message, include_html: bool = False) -> Dict:
@@ -190,7 +286,7 @@ def convert_message_to_dict(message: Message, include_html: bool = False) -> Dic
         "markdown": None,
     }
     if bool(message.html):
-        html_extracts = html2plain.parse_html(message.html)
+        html_extracts = html_cache.convert_html(message.html)
         email["html"] = html_extracts["simplified"]
         email["plain"] = html_extracts["text"]
         email["markdown"] = html_extracts["markdown"]
@@ -200,14 +296,10 @@ def convert_message_to_dict(message: Message, include_html: bool = False) -> Dic
 
 
 def extract_plain_text(message: Message) -> str:
-    plain = ""
-    if bool(message.html):
-        # plain = email_utils.parse_html_v2(message.html)
-        plain = email_utils.parse_html_v3(message.html)
-    elif bool(message.plain):
-        plain = message.plain
-    plain = email_utils.clean_email_body(plain)
-    return plain
+    # HTML emails get their plain text from html_cache.convert_html instead
+    if bool(message.html) or not bool(message.plain):
+        return ""
+    return email_utils.clean_email_body(message.plain)
 
 
 def format_terms(terms: Dict) -> Dict:
@@ -219,38 +311,236 @@ def format_terms(terms: Dict) -> Dict:
     return terms
 
 
-def gmail_to_elastic(query: Dict, limit: int = 100):
+def gmail_to_elastic(
+    query: Dict, limit: int = 100, chunk_size: int = 500, thread_count: int = 4
+):
     """Load emails from Gmail API query into Elasticsearch."""
-    messages = search_emails(query_dicts=[query], limit=limit)
+    messages = iter_emails(query_dicts=[query], limit=limit)
     from tqdm import tqdm
 
-    for dct in tqdm(messages):
-        dct["email_id"] = email_utils.hash_email(dct)
-        email = email_model.from_gmail_dict(dct)
-        email.save()
+    def docs():
+        for dct in tqdm(messages):
+            dct["email_id"] = email_utils.hash_email(dct)
+            yield email_model.from_gmail_dict(dct)
+
+    email_model.Email.init()
+    conn = elastic.get_client()
+    with elastic.bulk_load_mode(conn, email_model.Email.Index.name):
+        success, failed = email_model.bulk_save(
+            docs(), chunk_size=chunk_size, thread_count=thread_count, client=conn
+        )
+    print(f"Indexed {success} emails, {failed} failed")
+
+
+def get_history_id(client: Gmail, user_id: str = "me") -> str:
+    return client.service.users().getProfile(userId=user_id).execute()["historyId"]
+
+
+def get_history_changes(
+    client: Gmail, start_history_id: str, user_id: str = "me"
+) -> Tuple[Dict[str, str], str]:
+    """Return net message changes since a history id, and the latest history id.
+
+    Changes map Gmail message ids to "added", "deleted" or "relabeled".
+    Raises HttpError 404 if `start_history_id` has expired.
+    """
+    changes = {}
+    page_token = None
+    while True:
+        response = (
+            client.service.users()
+            .history()
+            .list(userId=user_id, startHistoryId=start_history_id, pageToken=page_token)
+            .execute()
+        )
+        for record in response.get("history", []):
+            for change in record.get("messagesAdded", []):
+                changes[change["message"]["id"]] = "added"
+            for change in record.get("messagesDeleted", []):
+                changes[change["message"]["id"]] = "deleted"
+            for key in ["labelsAdded", "labelsRemoved"]:
+                for change in record.get(key, []):
+                    changes.setdefault(change["message"]["id"], "relabeled")
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return changes, response["historyId"]
+
+
+def get_label_names(
+    client: Gmail, google_id: str, labels: List, user_id: str = "me"
+) -> List[str]:
+    message = (
+        client.service.users()
+        .messages()
+        .get(userId=user_id, id=google_id, format="minimal")
+        .execute()
+    )
+    names = {label.id: label.name for label in labels}
+    return [names.get(label_id, label_id) for label_id in message.get("labelIds", [])]
+
+
+def get_synced_after(query: Dict) -> Optional[float]:
+    """Timestamp from which a full resync of `query` fetches every email.
 
-    # TODO: Add Bulk support
-    # conn = elasticsearch_dsl.connections.get_connection()
-    # elasticsearch.helpers.bulk(conn, (d.to_dict(True) for d in docs))
+    Returns None if the query filters on anything but the date, since the
+    store then only holds some of the emails in that window.
+    """
+    if not query:
+        return 0.0
+    if set(query) != {"newer_than"}:
+        return None
+    return email_utils.get_newer_than_timestamp(query["newer_than"])
+
+
+def is_synced(
+    after: float = 0.0,
+    dataset_dir: str = const.EMAIL_DATASET_DIR,
+    state_path: str = const.GMAIL_SYNC_STATE_PATH,
+) -> bool:
+    """Whether the store in `dataset_dir` has every Gmail email sent since `after`.
+
+    True only if `sync_gmail` keeps that store up to date and its full resync
+    fetched everything from `after` onward.
+    """
+    if not os.path.exists(state_path):
+        return False
+    state = json.load(open(state_path))
+    if state.get("dataset_dir") != os.path.realpath(dataset_dir):
+        return False
+    synced_after = state.get("synced_after")
+    return synced_after is not None and after >= synced_after
+
+
+def sync_gmail(
+    query: Dict = None,
+    dataset_dir: str = const.EMAIL_DATASET_DIR,
+    include_elastic: bool = True,
+    state_path: str = const.GMAIL_SYNC_STATE_PATH,
+):
+    """Sync Gmail into the local email store and Elasticsearch.
+
+    Only messages added, deleted or relabeled since the Gmail historyId saved
+    in `state_path` are fetched. The first run, or a run whose history id has
+    expired, does a full resync of the emails matching `query` and deletes
+    stored emails that are no longer in Gmail. So does a run against a
+    different `dataset_dir` than the last one.
+
+    The state also records the store and the time from which it has every
+    email (see `is_synced`), carried over by incremental syncs.
+    """
+    state = {}
+    if os.path.exists(state_path):
+        state = json.load(open(state_path))
+    dataset_dir_path = os.path.realpath(dataset_dir)
+    # History since the last sync only brings a store that sync wrote up to date
+    same_store = state.get("dataset_dir", dataset_dir_path) == dataset_dir_path
+
+    client = Gmail()
+    labels = client.list_labels()
+    changes = None
+    synced_after = state.get("synced_after")
+    if state.get("history_id") and same_store:
+        try:
+            changes, history_id = get_history_changes(client, state["history_id"])
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("Gmail history id expired, running a full resync")
+
+    if changes is None:
+        # Read the history id first so changes made during the resync aren't missed
+        history_id = get_history_id(client)
+        query = query or {"newer_than": (365, "day")}
+        synced_after = get_synced_after(query)
+        added = iter_emails(query_dicts=[query], include_html=True)
+        # Messages deleted from Gmail since the last sync have no history left.
+        # The resync only covers `query`, so compare with all ids in the mailbox.
+        existing_ids = {
+            ref["id"] for ref in iter_message_refs(client, "", include_spam_trash=True)
+        }
+        local_ids = email_utils.get_local_email_ids_by_google_id(dataset_dir)
+        deleted = [i for i in local_ids if i not in existing_ids]
+        relabeled = {}
+    else:
+        ids = {action: [] for action in ["added", "deleted", "relabeled"]}
+        for google_id, action in changes.items():
+            ids[action].append(google_id)
+        print(
+            f"Syncing {len(ids['added'])} added, {len(ids['deleted'])} deleted "
+            f"and {len(ids['relabeled'])} relabeled emails"
+        )
+        added = fetch_emails(
+            client, ({"id": i} for i in ids["added"]), labels, include_html=True
+        )
+        deleted = ids["deleted"]
+        relabeled = {i: get_label_names(client, i, labels) for i in ids["relabeled"]}
+
+    def save_added():
+        for email in added:
+            email["email_id"] = email_utils.save_email(email, dataset_dir=dataset_dir)
+            yield email
+
+    if include_elastic:
+        email_model.Email.init()
+        conn = elastic.get_client()
+        docs = (email_model.from_gmail_dict(email) for email in save_added())
+        success, failed = email_model.bulk_save(docs, client=conn)
+        print(f"Indexed {success} emails, {failed} failed")
+        index = email_model.Email.Index.name
+        actions = [{"_op_type": "delete", "_index": index, "_id": i} for i in deleted]
+        actions += [
+            {"_op_type": "update", "_index": index, "_id": i, "doc": {"label_ids": names}}
+            for i, names in relabeled.items()
+        ]
+        # Missing documents (e.g. filtered out of the full sync) are ignored
+        helpers.bulk(conn, actions, raise_on_error=False)
+    else:
+        for _ in save_added():
+            pass
+
+    if deleted or relabeled:
+        local_ids = email_utils.get_local_email_ids_by_google_id(dataset_dir)
+        for google_id in deleted:
+            for email_id in local_ids.get(google_id, []):
+                email_utils.delete_local_email(email_id, dataset_dir)
+        for google_id, names in relabeled.items():
+            for email_id in local_ids.get(google_id, []):
+                email_utils.update_local_email(
+                    email_id, {"label_ids": names}, dataset_dir
+                )
+
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    with open(state_path, "w") as f:
+        json.dump(
+            {
+                "history_id": history_id,
+                "dataset_dir": dataset_dir_path,
+                "synced_after": synced_after,
+            },
+            f,
+        )
 
 
-from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
 
 
 def search_elastic_emails(query: Dict):
-    client = Elasticsearch()
+    client = elastic.get_client()
     s = Search(using=client, index="email")
     resp = s.execute()
     print(f"Hits: {resp.hits.total.value}")
 
 
 def update_local_emails():
-    # Update local emails to have new HTML preprocessing
+    # Update local emails to have new HTML preprocessing, refetching them from Gmail.
+    # reprocess_emails.reprocess_local_emails does this offline from the stored HTML.
     emails = email_utils.search_local_emails([], dataset_dir="data/emails")
+    store = email_store.get_email_store("data/emails")
+    stats_before = store.stats.copy()
     for email in emails:
         google_email = get_email(email["google_id"])
         email_utils.save_email(google_email, labels=email.get("model_labels"))
+    print(email_store.format_write_stats(store.stats - stats_before))
 
 
 if __name__ == "__main__":
@@ -18,6 +18,19 @@ DEBUG_MODE = bool(os.getenv("DEBUG_HIGGINS", False))
 # Database
 TINY_DB_PATH = "data/tinydb.json"
 EPISODE_JSONL_PATH = "data/episodes.jsonl"
+EMAIL_DATASET_DIR = "data/emails"
+GMAIL_SYNC_STATE_PATH = "data/gmail_sync.json"
+HTML_CACHE_PATH = "data/html_cache.db"
+HTML_CACHE_MAX_BYTES = 256 * 1024 * 1024
+FULLTEXT_INDEX_PATH = "data/email_fulltext.db"
+VECTOR_INDEX_DIR = "data/vector_index"
+
+# Elasticsearch client (see elastic.get_client), override in .env.secret
+ELASTIC_HOSTS = os.getenv("ELASTIC_HOSTS", "http://localhost:9200").split(",")
+ELASTIC_TIMEOUT = float(os.getenv("ELASTIC_TIMEOUT", "20"))
+ELASTIC_MAX_RETRIES = int(os.getenv("ELASTIC_MAX_RETRIES", "3"))
+# Keep-alive connections per Elasticsearch node
+ELASTIC_POOL_SIZE = int(os.getenv("ELASTIC_POOL_SIZE", "10"))
 
 # Parameter names to exclude for serialization
 AUTOMATION_PARAMS = ["browser", "desktop"]
@@ -13,27 +13,69 @@ Text analysis and full-text search
 https://www.elastic.co/guide/en/elasticsearch/reference/current/analysis.html
 
 """
+from contextlib import contextmanager
+import itertools
 import sys
-from typing import Dict, List
+import threading
+import time
+from typing import Dict, Iterator, List
 
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError, RequestError
 import elasticsearch_dsl
-from elasticsearch_dsl import Search
+from elasticsearch_dsl import Search, connections
 from elasticsearch_dsl.query import MultiMatch
 import pandas as pd
 
+from higgins import const
+
 
 EMAIL_INDEX = "email"
 QUERY_LIMIT = 1000
+# Hits per request when streaming a whole index
+SCAN_PAGE_SIZE = 1000
 SIMILARITY_BATCH_SIZE = 10
 
 
+def get_client_settings(**overrides) -> Dict:
+    """Elasticsearch client arguments from const (ELASTIC_* environment variables)."""
+    settings = {
+        "hosts": const.ELASTIC_HOSTS,
+        "timeout": const.ELASTIC_TIMEOUT,
+        "max_retries": const.ELASTIC_MAX_RETRIES,
+        "retry_on_timeout": True,
+        "maxsize": const.ELASTIC_POOL_SIZE,  # urllib3 keep-alive pool per node
+    }
+    settings.update(overrides)
+    return settings
+
+
+# elasticsearch_dsl creates the default connection lazily, on first use
+connections.configure(default=get_client_settings())
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(hosts: List[str] = None) -> Elasticsearch:
+    """Shared, pooled Elasticsearch client, created on first use.
+
+    The client for const.ELASTIC_HOSTS is also elasticsearch_dsl's default
+    connection, so Documents like email_model.Email share its connection pool.
+    Other `hosts` get one client each.
+    """
+    with _clients_lock:
+        if hosts is None or list(hosts) == const.ELASTIC_HOSTS:
+            return connections.get_connection()
+        key = tuple(hosts)
+        if key not in _clients:
+            _clients[key] = Elasticsearch(**get_client_settings(hosts=list(hosts)))
+        return _clients[key]
+
+
 def bulk_load_docs():
     # Connect to ES instance
-    es = Elasticsearch(
-        hosts=["http://localhost:9200"], timeout=60, retry_on_timeout=True
-    )
+    es = get_client()
 
     dataset = []
     # Elasticsearch bulk buffer
@@ -61,12 +103,196 @@ def bulk_load_docs():
         helpers.bulk(es, buffer)
 
 
-def get_all(client, index, start: int = 0, stop: int = sys.maxsize):
-    s = Search(using=client, index=index)
-    s = s[start:stop]
-    resp = s.execute()
-    print(f"Hits: {resp.hits.total.value}")
-    return resp
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0,
+}
+
+
+def get_doc_count(client: Elasticsearch, index: str) -> int:
+    stats = client.indices.stats(index=index, metric="docs")
+    return stats["_all"]["primaries"]["docs"]["count"]
+
+
+@contextmanager
+def bulk_load_mode(
+    client: Elasticsearch,
+    index: str,
+    force_merge: bool = False,
+    max_num_segments: int = 1,
+):
+    """Tune index settings for a large import and restore them afterwards.
+
+    Refreshes and replicas are disabled during the import. On exit the original
+    settings are restored, the index is refreshed once and optionally force
+    merged. Yields a dict which is filled with import stats on exit, where
+    `docs_per_sec` includes the final refresh/merge, i.e. until the documents
+    are searchable. An index that doesn't exist yet is left untuned.
+
+    Run `python -m higgins.database.elastic benchmark` to compare with an
+    untuned import.
+
+    Example:
+        with bulk_load_mode(client, "email") as stats:
+            helpers.bulk(client, docs)
+        print(stats["docs_per_sec"])
+    """
+    stats = {}
+    if not client.indices.exists(index=index):
+        print(f"Index {index} doesn't exist, importing without bulk load mode")
+        yield stats
+        return
+
+    resp = client.indices.get_settings(
+        index=index, name=list(BULK_LOAD_SETTINGS), flat_settings=True
+    )
+    # Settings left at their default are missing, restoring None resets them
+    original = {
+        name: next(iter(resp.values()))["settings"].get(name)
+        for name in BULK_LOAD_SETTINGS
+    }
+    docs_before = get_doc_count(client, index)
+    stats["docs_before"] = docs_before
+    print(f"Bulk load mode on {index}: {original} -> {BULK_LOAD_SETTINGS}")
+    client.indices.put_settings(index=index, body=BULK_LOAD_SETTINGS)
+    start = time.time()
+    try:
+        yield stats
+    finally:
+        client.indices.put_settings(index=index, body=original)
+        load_secs = time.time() - start
+        client.indices.refresh(index=index)
+        if force_merge:
+            client.indices.forcemerge(
+                index=index, max_num_segments=max_num_segments, request_timeout=3600
+            )
+        total_secs = time.time() - start
+        docs_after = get_doc_count(client, index)
+        stats.update(
+            {
+                "docs_after": docs_after,
+                "load_secs": load_secs,
+                "total_secs": total_secs,
+                "docs_per_sec": (docs_after - docs_before) / max(total_secs, 1e-6),
+            }
+        )
+        print(
+            f"Bulk load of {index} done: {docs_before} -> {docs_after} docs in "
+            f"{total_secs:.1f}s ({load_secs:.1f}s before the final refresh/merge), "
+            f"{stats['docs_per_sec']:.1f} docs/sec"
+        )
+
+
+def benchmark_bulk_load(
+    num_docs: int = 50000, chunk_size: int = 500, hosts: List[str] = None
+):
+    """Bulk indexing throughput with and without `bulk_load_mode`.
+
+    Indexes the same generated emails into two throwaway indices with the
+    default settings (1 replica, 1s refresh interval), one of them tuned.
+    Both times run until the documents are searchable.
+    """
+    import random
+
+    client = get_client(hosts)
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(5000)]
+    docs = [
+        {
+            "subject": " ".join(rng.choices(words, k=8)),
+            "body": " ".join(rng.choices(words, k=300)),
+            "date": 1630000000 + i,
+        }
+        for i in range(num_docs)
+    ]
+
+    rates = {}
+    for mode in ["untuned", "bulk_load_mode"]:
+        index = f"bulk-load-benchmark-{mode.replace('_', '-')}"
+        client.indices.delete(index=index, ignore=404)
+        client.indices.create(index=index, body={"settings": {"number_of_replicas": 1}})
+        actions = ({"_index": index, "_source": doc} for doc in docs)
+        try:
+            if mode == "untuned":
+                start = time.time()
+                helpers.bulk(client, actions, chunk_size=chunk_size)
+                client.indices.refresh(index=index)
+                rates[mode] = num_docs / (time.time() - start)
+            else:
+                with bulk_load_mode(client, index) as stats:
+                    helpers.bulk(client, actions, chunk_size=chunk_size)
+                rates[mode] = stats["docs_per_sec"]
+        finally:
+            client.indices.delete(index=index, ignore=404)
+        print(f"{mode:<15} {rates[mode]:.1f} docs/sec")
+    print(f"bulk_load_mode is {rates['bulk_load_mode'] / rates['untuned']:.2f}x untuned")
+
+
+def iter_all(
+    client: Elasticsearch,
+    index: str,
+    page_size: int = SCAN_PAGE_SIZE,
+    source: List[str] = None,
+    query: Dict = None,
+    keep_alive: str = "2m",
+) -> Iterator[elasticsearch_dsl.response.hit.Hit]:
+    """Stream every document in `index`, one page of `page_size` hits at a time.
+
+    Pages are read from a point in time with `search_after`, sorted on
+    `_shard_doc`, so the walk isn't limited by index.max_result_window (10k)
+    and sees a consistent snapshot of the index. Clusters without point in
+    time support (< 7.10) or without the `_shard_doc` sort (< 7.12) fall back
+    to the scroll API. `source` limits the _source fields returned.
+    """
+    s = Search(using=client)
+    if query is not None:
+        s = s.query(query)
+    if source is not None:
+        s = s.source(source)
+    scroll = s.index(index).params(size=page_size, scroll=keep_alive)
+    try:
+        pit_id = client.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    except (NotFoundError, RequestError):
+        print("Point in time not supported, falling back to scroll")
+        yield from scroll.scan()
+        return
+
+    try:
+        # _shard_doc is the cheapest sort with a unique value per document
+        s = s.sort({"_shard_doc": "asc"}).extra(size=page_size)
+        search_after = None
+        while True:
+            page = s.extra(pit={"id": pit_id, "keep_alive": keep_alive})
+            if search_after is not None:
+                page = page.extra(search_after=search_after)
+            try:
+                resp = page.execute()
+            except RequestError:
+                if search_after is not None:
+                    raise
+                print("_shard_doc sort not supported, falling back to scroll")
+                break
+            pit_id = resp.to_dict().get("pit_id", pit_id)
+            yield from resp.hits
+            if len(resp.hits) < page_size:
+                return
+            search_after = list(resp.hits[-1].meta.sort)
+    finally:
+        client.close_point_in_time(body={"id": pit_id})
+    yield from scroll.scan()
+
+
+def get_all(
+    client,
+    index,
+    start: int = 0,
+    stop: int = sys.maxsize,
+    page_size: int = SCAN_PAGE_SIZE,
+    source: List[str] = None,
+) -> Iterator[elasticsearch_dsl.response.hit.Hit]:
+    """Hits start..stop of `index`, streamed page by page (see `iter_all`)."""
+    hits = iter_all(client, index, page_size=page_size, source=source)
+    return itertools.islice(hits, start, stop)
 
 
 def get_by_id(id_: str, client: Elasticsearch):
@@ -122,7 +348,7 @@ def results_to_df(results: List[Dict], fields: List[str] = None):
 
 
 def example_search():
-    client = Elasticsearch()
+    client = get_client()
     response = client.search(
         index="gmail",
         body={
@@ -147,3 +373,8 @@ def example_search():
 
     for tag in response["aggregations"]["per_tag"]["buckets"]:
         print(tag["key"], tag["max_lines"]["value"])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark_bulk_load(int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
@@ -0,0 +1,285 @@
+"""Asyncio search API over AsyncElasticsearch.
+
+Async versions of the `elastic` search helpers, so independent requests run
+concurrently instead of one after another:
+
+    search_query_string / get_by_id / get_by_ids / msearch
+
+`search_and_rerank` fans out several variants of a query at once and reranks
+the hits of each variant (in a worker thread) as soon as they arrive, so
+retrieval, fetching bodies of the top hits and reranking overlap. Concurrent
+requests are bounded by a semaphore.
+
+Hits are elasticsearch_dsl Hit objects, as returned by the sync API, so they
+work with `elastic.dsl_hit_to_dict`. Run `python -m higgins.database.elastic_async
+benchmark` to compare with the sync API against a local fake Elasticsearch.
+"""
+
+import asyncio
+import sys
+import time
+from typing import Callable, Dict, List
+import weakref
+
+from elasticsearch import AsyncElasticsearch
+import elasticsearch_dsl
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.query import MultiMatch
+from elasticsearch_dsl.response import Response
+
+from higgins.database import elastic
+
+EMAIL_INDEX = elastic.EMAIL_INDEX
+QUERY_LIMIT = elastic.QUERY_LIMIT
+# Requests in flight per search_and_rerank call
+MAX_CONCURRENCY = 8
+
+# aiohttp sessions belong to an event loop, so clients are cached per loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncElasticsearch:
+    """Shared AsyncElasticsearch client of the running event loop.
+
+    Uses the same settings (hosts, timeout, retries, pool size) as
+    `elastic.get_client`.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = AsyncElasticsearch(**elastic.get_client_settings())
+    return _clients[loop]
+
+
+async def close_async_client():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def search_query_string(
+    query_str: str,
+    fields: List,
+    client: AsyncElasticsearch,
+    start: int = 0,
+    stop: int = QUERY_LIMIT,
+    source: List[str] = None,
+) -> List[elasticsearch_dsl.response.hit.Hit]:
+    """Async `elastic.search_query_string`, `source` limits the _source fields."""
+    query = MultiMatch(query=query_str, fields=fields, type="best_fields")
+    s = Search(index=EMAIL_INDEX).query(query)[start:stop]
+    if source is not None:
+        s = s.source(source)
+    resp = await client.search(index=EMAIL_INDEX, body=s.to_dict())
+    return Response(s, resp).hits
+
+
+async def get_by_id(id_: str, client: AsyncElasticsearch) -> Dict:
+    return await client.get(index=EMAIL_INDEX, id=id_)
+
+
+async def get_by_ids(ids: List[str], client: AsyncElasticsearch) -> List[Dict]:
+    """Fetch several documents in one request, missing ones are left out."""
+    if not ids:
+        return []
+    resp = await client.mget(index=EMAIL_INDEX, body={"ids": list(ids)})
+    return [doc for doc in resp["docs"] if doc.get("found")]
+
+
+async def msearch(
+    searches: List[Search], client: AsyncElasticsearch
+) -> List[List[elasticsearch_dsl.response.hit.Hit]]:
+    """Run several searches in one request, returns the hits of each search."""
+    body = []
+    for s in searches:
+        body.append({"index": s._index[0] if s._index else EMAIL_INDEX})
+        body.append(s.to_dict())
+    resp = await client.msearch(body=body)
+    return [Response(s, r).hits for s, r in zip(searches, resp["responses"])]
+
+
+async def search_and_rerank(
+    query: str,
+    query_variants: List[str],
+    fields: List[str],
+    rerank_fn: Callable[[str, List[Dict]], List[float]],
+    client: AsyncElasticsearch,
+    top_k: int = 20,
+    max_concurrency: int = MAX_CONCURRENCY,
+    retrieve_fields: List[str] = None,
+) -> List[Dict]:
+    """Retrieve hits for every query variant concurrently and rerank their union.
+
+    Variants are searched for their `top_k` hits (only `retrieve_fields` of the
+    _source, if given). As each variant returns, the full documents of hits not
+    seen before are fetched and `rerank_fn(query, docs)` scores them in a worker
+    thread while the other variants are still being retrieved.
+
+    Returns ES result dicts (see `elastic.dsl_hit_to_dict`) sorted by rerank
+    score, which replaces `_score`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def retrieve(variant):
+        async with semaphore:
+            return await search_query_string(
+                variant, fields, client, stop=top_k, source=retrieve_fields
+            )
+
+    async def fetch_and_rerank(ids):
+        async with semaphore:
+            docs = await get_by_ids(ids, client)
+        scores = await loop.run_in_executor(
+            None, rerank_fn, query, [doc["_source"] for doc in docs]
+        )
+        return [
+            {**doc, "_type": "_doc", "_score": score} for doc, score in zip(docs, scores)
+        ]
+
+    seen = set()
+    reranks = []
+    for next_hits in asyncio.as_completed([retrieve(v) for v in query_variants]):
+        hits = await next_hits
+        ids = [hit.meta.id for hit in hits if hit.meta.id not in seen]
+        seen.update(ids)
+        if ids:
+            reranks.append(asyncio.ensure_future(fetch_and_rerank(ids)))
+    results = [result for batch in await asyncio.gather(*reranks) for result in batch]
+    return sorted(results, key=lambda r: r["_score"], reverse=True)
+
+
+def search_and_rerank_sync(
+    query: str,
+    query_variants: List[str],
+    fields: List[str],
+    rerank_fn: Callable[[str, List[Dict]], List[float]],
+    client,
+    top_k: int = 20,
+    retrieve_fields: List[str] = None,
+) -> List[Dict]:
+    """The sequential equivalent of `search_and_rerank`, for comparison."""
+    seen = set()
+    results = []
+    for variant in query_variants:
+        s = Search(using=client, index=EMAIL_INDEX)
+        s = s.query(MultiMatch(query=variant, fields=fields, type="best_fields"))[:top_k]
+        if retrieve_fields is not None:
+            s = s.source(retrieve_fields)
+        ids = [hit.meta.id for hit in s.execute() if hit.meta.id not in seen]
+        seen.update(ids)
+        if not ids:
+            continue
+        docs = client.mget(index=EMAIL_INDEX, body={"ids": ids})["docs"]
+        docs = [doc for doc in docs if doc.get("found")]
+        scores = rerank_fn(query, [doc["_source"] for doc in docs])
+        results += [
+            {**doc, "_type": "_doc", "_score": score} for doc, score in zip(docs, scores)
+        ]
+    return sorted(results, key=lambda r: r["_score"], reverse=True)
+
+
+def start_fake_elasticsearch(num_docs: int = 1000, latency: float = 0.02):
+    """Serve _search, _msearch and _mget of a synthetic email index, with `latency` per request."""
+    import json
+    import random
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    docs = {
+        str(i): {"subject": f"Subject {i}", "plain": f"Body of email {i} " * 20}
+        for i in range(num_docs)
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, obj):
+            data = json.dumps(obj).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.send_json({"version": {"number": "7.14.0", "build_flavor": "default"},
+                            "tagline": "You Know, for Search"})
+
+        def search(self, body):
+            rng = random.Random(json.dumps(body, sort_keys=True))
+            hits = [
+                {"_index": EMAIL_INDEX, "_id": i, "_score": rng.random(),
+                 "_source": {"subject": docs[i]["subject"]}}
+                for i in rng.sample(list(docs), body.get("size", 10))
+            ]
+            return {"took": 1, "timed_out": False,
+                    "hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits}}
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers["Content-Length"])).decode()
+            path = self.path.split("?")[0]
+            time.sleep(latency)
+            if path.endswith("_msearch"):
+                bodies = [json.loads(line) for line in data.splitlines()[1::2]]
+                return self.send_json({"responses": [self.search(b) for b in bodies]})
+            body = json.loads(data or "{}")
+            if path.endswith("_mget"):
+                return self.send_json({"docs": [
+                    {"_index": EMAIL_INDEX, "_id": i, "found": True, "_source": docs[i]}
+                    for i in body["ids"] if i in docs
+                ]})
+            self.send_json(self.search(body))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def benchmark(num_variants: int = 8, top_k: int = 20, latency: float = 0.02, rerank_secs: float = 0.03):
+    """Compare sync and async search_and_rerank against a fake ES with `latency` per request."""
+    from elasticsearch import Elasticsearch
+
+    server = start_fake_elasticsearch(latency=latency)
+    hosts = [f"http://127.0.0.1:{server.server_port}"]
+    variants = [f"flight confirmation {i}" for i in range(num_variants)]
+
+    def rerank_fn(query, docs):
+        time.sleep(rerank_secs)  # e.g. a cross-encoder or an API call
+        return [len(set(query.split()) & set(doc["subject"].split())) for doc in docs]
+
+    client = Elasticsearch(**elastic.get_client_settings(hosts=hosts))
+    start = time.time()
+    sync_results = search_and_rerank_sync(
+        "flight", variants, ["subject^2", "plain"], rerank_fn, client, top_k, ["subject"]
+    )
+    sync_secs = time.time() - start
+
+    async def run():
+        async_client = AsyncElasticsearch(**elastic.get_client_settings(hosts=hosts))
+        try:
+            start = time.time()
+            results = await search_and_rerank(
+                "flight", variants, ["subject^2", "plain"], rerank_fn, async_client,
+                top_k, retrieve_fields=["subject"],
+            )
+            return results, time.time() - start
+        finally:
+            await async_client.close()
+
+    async_results, async_secs = asyncio.run(run())
+    server.shutdown()
+    assert sorted(r["_id"] for r in sync_results) == sorted(r["_id"] for r in async_results)
+    print(
+        f"{num_variants} query variants, {latency * 1000:.0f} ms/request, "
+        f"{rerank_secs * 1000:.0f} ms/rerank: sync {sync_secs * 1000:.0f} ms, "
+        f"async {async_secs * 1000:.0f} ms ({sync_secs / async_secs:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark()
@@ -0,0 +1,417 @@
+"""Embedded BM25 full-text index, an offline stand-in for Elasticsearch.
+
+Documents are analyzed like the `snowball` analyzer of the Email mapping
+(lowercase, English stop words, Snowball English stemming) and stored in a single SQLite
+file as an inverted index:
+
+    docs: doc_id -> doc_num, digest and the (gzipped) _source JSON
+    postings: (field, term, segment) -> packed uint32 doc nums and uint16 term freqs
+    arrays: per-field document lengths and the live-docs mask
+
+Like Lucene, every `commit()` writes the buffered documents as a new segment,
+deletes and updates only clear the live-docs bit, and `optimize()` merges all
+segments, drops deleted documents and renumbers the remaining ones. Searches
+and the BM25 statistics only see committed changes. Queries load the postings of the query
+terms and score them with numpy, using Elasticsearch's BM25 defaults and
+`best_fields` multi-match semantics (the best boosted field score per doc).
+
+`search_query_string` has the same signature as the Elasticsearch version and
+returns hits that work with `dsl_hit_to_dict`.
+"""
+
+from collections import Counter, defaultdict
+import gzip
+import hashlib
+import json
+import math
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from higgins.nlp.stemming import stem
+
+
+QUERY_LIMIT = 1000
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Buffered documents are flushed as a new segment once this many are added
+SEGMENT_SIZE = 20000
+# Elasticsearch's _english_ stop words, used by the snowball analyzer
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in",
+    "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the",
+    "their", "then", "there", "these", "they", "this", "to", "was", "will", "with",
+}
+TOKEN = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = 255
+MAX_TF = np.iinfo(np.uint16).max
+
+
+def analyze(text: Optional[str]) -> List[str]:
+    """Tokenize, lowercase, drop stop words and stem."""
+    if not text:
+        return []
+    return [
+        stem(token)
+        for token in TOKEN.findall(text.lower())
+        if token not in STOP_WORDS and len(token) <= MAX_TOKEN_LENGTH
+    ]
+
+
+def parse_field_boosts(fields: List[str]) -> List[Tuple[str, float]]:
+    """["subject^2", "plain"] -> [("subject", 2.0), ("plain", 1.0)]"""
+    boosts = []
+    for field in fields:
+        name, _, boost = field.partition("^")
+        boosts.append((name, float(boost) if boost else 1.0))
+    return boosts
+
+
+class Hit:
+    """Search hit with the parts of an elasticsearch_dsl Hit that dsl_hit_to_dict uses."""
+
+    def __init__(self, doc_id: str, index: str, score: float, source: Dict):
+        self.meta = SimpleNamespace(id=doc_id, index=index, score=score)
+        self._source = source
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["_source"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self) -> Dict:
+        return dict(self._source)
+
+    def __repr__(self):
+        return f"Hit(id={self.meta.id!r}, score={self.meta.score:.3f})"
+
+
+class FullTextIndex:
+    def __init__(
+        self, path: str, fields: Iterable[str] = ("subject", "plain"), name: str = None
+    ):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.name = name or Path(path).stem  # _index of the hits
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Searches read from their own connection, which only sees committed data
+        self.read_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id TEXT PRIMARY KEY,
+                doc_num INTEGER NOT NULL UNIQUE,
+                digest TEXT NOT NULL,
+                source BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                field TEXT NOT NULL,
+                term TEXT NOT NULL,
+                segment INTEGER NOT NULL,
+                doc_nums BLOB NOT NULL,
+                tfs BLOB NOT NULL,
+                PRIMARY KEY (field, term, segment)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS arrays (name TEXT PRIMARY KEY, data BLOB NOT NULL);
+            """
+        )
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'fields'").fetchone()
+        if row is None:
+            self.fields = list(fields)
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('fields', ?)", (json.dumps(self.fields),)
+            )
+        else:
+            self.fields = json.loads(row[0])
+        self.lengths = {field: self._load_array(f"length:{field}", np.uint32) for field in self.fields}
+        self.live = self._load_array("live", np.bool_)
+        self.next_doc_num = len(self.live)
+        # What searches see, the live-docs mask as of the last commit
+        self._committed_live = self.live.copy()
+        self.next_segment = (
+            self.conn.execute("SELECT MAX(segment) FROM postings").fetchone()[0] or 0
+        ) + 1
+        self._buffer = {field: defaultdict(dict) for field in self.fields}
+        self._buffered_docs = 0
+        self._field_stats = None
+        self._all_live = True
+
+    def _load_array(self, name: str, dtype) -> np.ndarray:
+        row = self.conn.execute("SELECT data FROM arrays WHERE name = ?", (name,)).fetchone()
+        return np.frombuffer(row[0], dtype=dtype).copy() if row else np.zeros(0, dtype=dtype)
+
+    def _grow(self, size: int):
+        if size > len(self.live):
+            size = max(size, len(self.live) * 2, 1024)
+            self.live = np.concatenate([self.live, np.zeros(size - len(self.live), np.bool_)])
+            for field in self.fields:
+                lengths = self.lengths[field]
+                self.lengths[field] = np.concatenate(
+                    [lengths, np.zeros(size - len(lengths), np.uint32)]
+                )
+
+    def __len__(self) -> int:
+        """Number of committed documents."""
+        return int(self._committed_live.sum())
+
+    def add(self, doc_id: str, source: Dict) -> bool:
+        """Index or replace a document. Returns False if it is already indexed unchanged.
+
+        Changes are visible to searches once `commit()` is called.
+        """
+        data = json.dumps(source, sort_keys=True, default=str).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            existing = self.conn.execute(
+                "SELECT doc_num, digest FROM docs WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            if existing is not None and existing[1] == digest:
+                return False
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            doc_num = self.next_doc_num
+            self.next_doc_num += 1
+            self._grow(self.next_doc_num)
+            if existing is not None:
+                self.live[existing[0]] = False
+            self.conn.execute(
+                "INSERT OR REPLACE INTO docs (doc_id, doc_num, digest, source) VALUES (?, ?, ?, ?)",
+                (doc_id, doc_num, digest, gzip.compress(data, compresslevel=6)),
+            )
+            for field in self.fields:
+                terms = analyze(source.get(field))
+                self.lengths[field][doc_num] = len(terms)
+                postings = self._buffer[field]
+                for term, tf in Counter(terms).items():
+                    postings[term][doc_num] = tf
+            self.live[doc_num] = True
+            self._buffered_docs += 1
+            if self._buffered_docs >= SEGMENT_SIZE:
+                self._flush_segment()
+        return True
+
+    def delete(self, doc_id: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT doc_num FROM docs WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+            self.live[row[0]] = False
+        return True
+
+    def _flush_segment(self):
+        rows = []
+        for field, postings in self._buffer.items():
+            for term, tfs in postings.items():
+                doc_nums = np.fromiter(tfs.keys(), dtype=np.uint32, count=len(tfs))
+                freqs = np.fromiter(tfs.values(), dtype=np.int64, count=len(tfs))
+                freqs = np.minimum(freqs, MAX_TF).astype(np.uint16)
+                rows.append(
+                    (field, term, self.next_segment, doc_nums.tobytes(), freqs.tobytes())
+                )
+        if rows:
+            self.conn.executemany(
+                "INSERT INTO postings (field, term, segment, doc_nums, tfs) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.next_segment += 1
+        self._buffer = {field: defaultdict(dict) for field in self.fields}
+        self._buffered_docs = 0
+
+    def commit(self):
+        """Write buffered documents as a new segment and make all changes durable."""
+        with self.lock:
+            if not self.conn.in_transaction:
+                return
+            self._flush_segment()
+            size = self.next_doc_num
+            arrays = [("live", self.live[:size].tobytes())] + [
+                (f"length:{field}", self.lengths[field][:size].tobytes())
+                for field in self.fields
+            ]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO arrays (name, data) VALUES (?, ?)", arrays
+            )
+            self.conn.execute("COMMIT")
+            self._committed_live = self.live[:size].copy()
+            self._field_stats = None
+
+    def optimize(self):
+        """Merge every segment into one and renumber the live documents 0..n-1.
+
+        Postings, lengths and live-docs entries of deleted documents are dropped.
+        """
+        self.commit()
+        with self.lock:
+            live = self._committed_live
+            size = int(live.sum())
+            new_doc_nums = (np.cumsum(live) - 1).astype(np.uint32)
+            self.conn.execute("BEGIN")
+            rows = []
+            for field, term, doc_nums, tfs in self._iter_merged_postings():
+                keep = live[doc_nums]
+                if keep.any():
+                    rows.append(
+                        (
+                            field,
+                            term,
+                            0,
+                            new_doc_nums[doc_nums[keep]].tobytes(),
+                            tfs[keep].tobytes(),
+                        )
+                    )
+            self.conn.execute("DELETE FROM postings")
+            self.conn.executemany(
+                "INSERT INTO postings (field, term, segment, doc_nums, tfs) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            # Negate first so no two docs share a doc_num while renumbering
+            self.conn.execute("UPDATE docs SET doc_num = -1 - doc_num")
+            old_doc_nums = np.flatnonzero(live)
+            self.conn.executemany(
+                "UPDATE docs SET doc_num = ? WHERE doc_num = ?",
+                [(int(new_doc_nums[i]), -1 - int(i)) for i in old_doc_nums],
+            )
+            self.live = np.ones(size, np.bool_)
+            self.lengths = {
+                field: self.lengths[field][old_doc_nums] for field in self.fields
+            }
+            self.next_doc_num = size
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO arrays (name, data) VALUES (?, ?)",
+                [("live", self.live.tobytes())]
+                + [(f"length:{field}", self.lengths[field].tobytes()) for field in self.fields],
+            )
+            self.conn.execute("COMMIT")
+            self._committed_live = self.live.copy()
+            self._field_stats = None
+            self.next_segment = 1
+        self.conn.execute("VACUUM")
+
+    def _iter_merged_postings(self):
+        field_term, doc_nums, tfs = None, [], []
+        for field, term, nums, freqs in self.conn.execute(
+            "SELECT field, term, doc_nums, tfs FROM postings ORDER BY field, term, segment"
+        ):
+            if (field, term) != field_term:
+                if field_term is not None:
+                    yield (*field_term, np.concatenate(doc_nums), np.concatenate(tfs))
+                field_term, doc_nums, tfs = (field, term), [], []
+            doc_nums.append(np.frombuffer(nums, dtype=np.uint32))
+            tfs.append(np.frombuffer(freqs, dtype=np.uint16))
+        if field_term is not None:
+            yield (*field_term, np.concatenate(doc_nums), np.concatenate(tfs))
+
+    def _get_field_stats(self) -> Dict[str, Tuple[int, np.ndarray]]:
+        # (number of live docs with the field, BM25 length norm of every doc)
+        if self._field_stats is None:
+            self._field_stats = {}
+            live = self._committed_live
+            self._all_live = bool(live.all())
+            for field in self.fields:
+                lengths = self.lengths[field][: len(live)]
+                has_field = live & (lengths > 0)
+                doc_count = int(has_field.sum())
+                avg_length = float(lengths[has_field].sum()) / max(doc_count, 1)
+                norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(avg_length, 1e-6))
+                self._field_stats[field] = (doc_count, norms.astype(np.float32))
+        return self._field_stats
+
+    def _get_postings(self, field: str, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        rows = self.read_conn.execute(
+            "SELECT doc_nums, tfs FROM postings WHERE field = ? AND term = ?", (field, term)
+        ).fetchall()
+        if not rows:
+            return np.zeros(0, np.uint32), np.zeros(0, np.uint16)
+        doc_nums = np.concatenate([np.frombuffer(r[0], dtype=np.uint32) for r in rows])
+        tfs = np.concatenate([np.frombuffer(r[1], dtype=np.uint16) for r in rows])
+        if self._all_live:
+            return doc_nums, tfs
+        keep = self._committed_live[doc_nums]
+        return doc_nums[keep], tfs[keep]
+
+    def score(self, query: str, fields: List[str]) -> np.ndarray:
+        """BM25 best_fields score of every document (0 if it doesn't match), by doc num."""
+        terms = analyze(query)
+        with self.lock:
+            field_stats = self._get_field_stats()
+            best = np.zeros(len(self._committed_live), dtype=np.float32)
+            for field, boost in parse_field_boosts(fields):
+                if field not in self.lengths:
+                    raise ValueError(f"{field} is not indexed, indexed fields: {self.fields}")
+                doc_count, norms = field_stats[field]
+                field_scores = np.zeros(len(best), dtype=np.float32)
+                for term in terms:  # repeated query terms count again, as in ES
+                    doc_nums, tfs = self._get_postings(field, term)
+                    if not len(doc_nums):
+                        continue
+                    idf = math.log(1 + (doc_count - len(doc_nums) + 0.5) / (len(doc_nums) + 0.5))
+                    tfs = tfs.astype(np.float32)
+                    field_scores[doc_nums] += (boost * idf) * tfs / (tfs + norms[doc_nums])
+                np.maximum(best, field_scores, out=best)
+        return best
+
+    def search(
+        self, query: str, fields: List[str], start: int = 0, stop: int = QUERY_LIMIT
+    ) -> List[Hit]:
+        scores = self.score(query, fields)
+        matches = np.flatnonzero(scores)
+        if stop < len(matches):
+            # Only the top `stop` documents need sorting
+            top = np.argpartition(-scores[matches], stop - 1)[:stop]
+            matches = np.sort(matches[top])
+        # Highest score first, ties in indexing order
+        order = np.lexsort((matches, -scores[matches]))[start:stop]
+        ranked = [(int(matches[i]), float(scores[matches[i]])) for i in order]
+        return self.get_hits(ranked)
+
+    def get_hits(self, ranked: List[Tuple[int, float]]) -> List[Hit]:
+        if not ranked:
+            return []
+        with self.lock:
+            rows = self.read_conn.execute(
+                f"SELECT doc_num, doc_id, source FROM docs "
+                f"WHERE doc_num IN ({','.join('?' * len(ranked))})",
+                [doc_num for doc_num, _ in ranked],
+            ).fetchall()
+        docs = {doc_num: (doc_id, source) for doc_num, doc_id, source in rows}
+        return [
+            Hit(docs[doc_num][0], self.name, score, json.loads(gzip.decompress(docs[doc_num][1])))
+            for doc_num, score in ranked
+            if doc_num in docs
+        ]
+
+    def get(self, doc_id: str) -> Optional[Dict]:
+        row = self.read_conn.execute(
+            "SELECT source FROM docs WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+        return json.loads(gzip.decompress(row[0])) if row else None
+
+    def close(self):
+        self.commit()
+        self.read_conn.close()
+        self.conn.close()
+
+
+def search_query_string(
+    query_str: str,
+    fields: List,
+    client: FullTextIndex,
+    start: int = 0,
+    stop: int = QUERY_LIMIT,
+) -> List[Hit]:
+    """Drop-in for elastic.search_query_string, `client` is a FullTextIndex."""
+    return client.search(query_str, fields, start=start, stop=stop)
@@ -9,6 +9,15 @@ from higgins.nlp.openai import (
 )
 
 
+SHOW_THREAD_PHRASES = [
+    "show thread",
+    "show the thread",
+    "show whole thread",
+    "show the whole thread",
+    "show the full thread",
+]
+
+
 class SendEmail(IntentParser):
 
     @classmethod
@@ -89,6 +98,25 @@ class SearchEmail(IntentParser):
 class SearchEmailReplyHandler(IntentParser):
 
     def parse(cls, text: str, episode: Episode) -> List[Dict]:
+        data = episode.action_result.data
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        if (
+            nlp_utils.normalize_text(text) in SHOW_THREAD_PHRASES
+            and isinstance(data, dict)
+            and data.get("thread_id")
+        ):
+            params = {
+                "recipient": None,
+                "sender": None,
+                "subject": None,
+                "unread": None,
+                "labels": None,
+                "exact_phrase": None,
+                "newer_than": None,
+                "thread_id": data["thread_id"],
+            }
+            return [{"action": "SearchEmail", "params": params}]
         return [
             {
                 "action": "AnswerEmailQuestion",
@@ -19,10 +19,12 @@ return the closest questions in the corpus (questions in the corpus are mainly i
 """
 
 import csv
+import itertools
 import os
-from typing import Dict, List
+import sys
+from typing import Dict, Iterable, Iterator
 
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import helpers
 from sentence_transformers import SentenceTransformer, util
 import time
 import tqdm.autonotebook
@@ -30,8 +32,7 @@ import tqdm.autonotebook
 from higgins.database import elastic
 from higgins.automation.email import email_utils
 from higgins.nlp import nlp_utils
-
-es = Elasticsearch()
+from higgins.nlp.embeddings.vector_index import VectorIndex, get_index_path
 
 tokenizer = nlp_utils.get_tokenizer()
 
@@ -39,6 +40,7 @@ tokenizer = nlp_utils.get_tokenizer()
 def create_vector_index(
     index: str, text_field: str, vector_field: str, vector_dims: int
 ):
+    es = elastic.get_client()
     if not es.indices.exists(index=index):
         es_index = {
             "mappings": {
@@ -55,16 +57,27 @@ def create_vector_index(
 
 def create_and_upload_embeddings(
     model: SentenceTransformer,
-    rows: List[Dict],
+    rows: Iterable[Dict],
     index: str,
     text_field: str,
     vector_field: str,
     chunk_size: int = 500,
+    total: int = None,
+    vector_index: VectorIndex = None,
 ):
+    """Embed and index `rows` chunk by chunk, `rows` can be a generator.
+
+    The embeddings are also added to `vector_index`, if given.
+    """
     print("inside create and upload")
-    with tqdm.tqdm(total=len(rows)) as pbar:
-        for start_idx in range(0, len(rows), chunk_size):
-            row_slice = rows[start_idx : start_idx + chunk_size]
+    if total is None and hasattr(rows, "__len__"):
+        total = len(rows)
+    rows = iter(rows)
+    with tqdm.tqdm(total=total) as pbar:
+        while True:
+            row_slice = list(itertools.islice(rows, chunk_size))
+            if not row_slice:
+                break
             # print(
             #     "num tokens before encoding",
             #     nlp_utils.get_num_tokens(row_slice[0][text_field], tokenizer),
@@ -85,8 +98,36 @@ def create_and_upload_embeddings(
                 }
                 bulk_data.append(document)
 
-            helpers.bulk(es, bulk_data)
-            pbar.update(chunk_size)
+            helpers.bulk(elastic.get_client(), bulk_data)
+            if vector_index is not None:
+                vector_index.add([doc["_id"] for doc in bulk_data], embeddings)
+            pbar.update(len(row_slice))
+    if vector_index is not None:
+        vector_index.save()
+
+
+def sync_vector_index(
+    index: str, vector_field: str, vector_dims: int, chunk_size: int = 1000, **kwargs
+) -> VectorIndex:
+    """Update the local HNSW index of `vector_field` with the embeddings in Elasticsearch.
+
+    Documents deleted from `index` are deleted from the vector index, `kwargs`
+    are passed to VectorIndex (M, ef_construction, ef).
+    """
+    vector_index = VectorIndex(get_index_path(index, vector_field), vector_dims, **kwargs)
+    hits = elastic.iter_all(elastic.get_client(), index, source=[vector_field])
+    ids = set()
+    while True:
+        chunk = list(itertools.islice(hits, chunk_size))
+        if not chunk:
+            break
+        vectors = {hit.meta.id: hit.to_dict().get(vector_field) for hit in chunk}
+        vectors = {id_: vector for id_, vector in vectors.items() if vector is not None}
+        vector_index.add(list(vectors), list(vectors.values()))
+        ids.update(vectors)
+    vector_index.delete([id_ for id_ in vector_index.labels if id_ not in ids])
+    vector_index.save()
+    return vector_index
 
 
 def init_query_session(
@@ -96,8 +137,14 @@ def init_query_session(
     vector_field,
     max_results: int = 20,
     display_field: str = None,
+    vector_index: VectorIndex = None,
 ):
-    """Open interactive query session"""
+    """Open interactive query session
+
+    Semantic search uses `vector_index` (see sync_vector_index) if given, and
+    a brute force script_score query otherwise.
+    """
+    es = elastic.get_client()
     while True:
         inp_question = input("Please enter a question: ")
 
@@ -118,21 +165,37 @@ def init_query_session(
         # Sematic search
         # Example of searching multiple dense fields
         # "source": "cosineSimilarity(params.queryVector, doc['Text_Vector1']) + cosineSimilarity(params.queryVector, doc['Text_Vector2'])  + 2.0",
-        sem_search = es.search(
-            index=index,
-            body={
-                "size": max_results,
-                "query": {
-                    "script_score": {
-                        "query": {"match_all": {}},
-                        "script": {
-                            "source": f"cosineSimilarity(params.queryVector, doc['{vector_field}']) + 1.0",
-                            "params": {"queryVector": question_embedding},
-                        },
-                    }
+        if vector_index is not None:
+            sem_start_time = time.time()
+            neighbors = vector_index.search(question_embedding, k=max_results)
+            docs = es.mget(index=index, body={"ids": [id_ for id_, _ in neighbors]})
+            sem_search = {
+                "took": (time.time() - sem_start_time) * 1000,
+                "hits": {
+                    "total": {"value": len(neighbors), "relation": "eq"},
+                    "hits": [
+                        {**doc, "_score": score + 1.0}
+                        for doc, (_, score) in zip(docs["docs"], neighbors)
+                        if doc.get("found")
+                    ],
                 },
-            },
-        )
+            }
+        else:
+            sem_search = es.search(
+                index=index,
+                body={
+                    "size": max_results,
+                    "query": {
+                        "script_score": {
+                            "query": {"match_all": {}},
+                            "script": {
+                                "source": f"cosineSimilarity(params.queryVector, doc['{vector_field}']) + 1.0",
+                                "params": {"queryVector": question_embedding},
+                            },
+                        }
+                    },
+                },
+            )
         print(f"Sem Hits: {sem_search['hits']['total']}")
 
         print("Input question:", inp_question)
@@ -199,9 +262,17 @@ def create_quora_embeddings_index(model):
     create_and_upload_embeddings(model, questions, index, text_field, vector_field)
 
 
-def prepare_email_dataset(corpus_size):
-    hits = elastic.get_all(client=es, index="email", start=0, stop=corpus_size)
-    email_dicts = []
+def prepare_email_dataset(corpus_size: int = sys.maxsize) -> Iterator[Dict]:
+    """Stream emails from the email index with their extended body instead of html.
+
+    See elastic.iter_all.
+    """
+    hits = elastic.get_all(
+        client=elastic.get_client(),
+        index="email",
+        start=0,
+        stop=corpus_size,
+    )
     for hit in hits:
         dct = hit.to_dict()
         document = email_utils.get_email_body_extended(dct)
@@ -210,9 +281,10 @@ def prepare_email_dataset(corpus_size):
         # print("num tokens after", nlp_utils.get_num_tokens(document, tokenizer))
         document = nlp_utils.trim_tokens(document, 4000, tokenizer)
         dct["body_extended"] = document
+        # The largest field, and body_extended already has its text
+        dct.pop("html", None)
         dct["_id"] = hit.meta.id
-        email_dicts.append(dct)
-    return email_dicts
+        yield dct
 
 
 def create_email_subject_embeddings_index(model, vector_dims):
@@ -280,4 +352,4 @@ if __name__ == "__main__":
     # )
 
     # emails = prepare_email_dataset(corpus_size=10)
-    # print(emails[0])
+    # print(next(emails))
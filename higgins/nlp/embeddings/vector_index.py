@@ -0,0 +1,229 @@
+"""Persistent local HNSW index over email embeddings.
+
+Approximate nearest neighbor search with hnswlib, so semantic search doesn't
+have to compute the similarity to every document like the `script_score`
+query in `elastic_embeddings.init_query_session` does.
+
+Embeddings are keyed by email ID and can be added, updated and deleted
+incrementally. The index is saved to a directory:
+
+    <path>/index-<n>.bin  hnswlib graph, a new file for every save
+    <path>/labels.json    email ID -> hnswlib label, deleted IDs, parameters
+                          and the name of the graph file they belong to
+
+Replacing labels.json is the commit point of a save, so a crash leaves the
+previous graph and labels in place.
+
+`M` (graph degree) and `ef_construction` are fixed when the index is created,
+`ef` (search breadth) can be changed at any time to trade latency for recall.
+Run `python -m higgins.nlp.embeddings.vector_index benchmark` for recall and
+latency against exact search.
+"""
+
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Iterable, List, Tuple
+
+import hnswlib
+import numpy as np
+
+from higgins import const
+from higgins.automation.email.email_store import write_file_atomic
+
+INDEX_FILE_PATTERN = "index-*.bin"
+LABELS_FILE_NAME = "labels.json"
+DEFAULT_M = 16
+DEFAULT_EF_CONSTRUCTION = 200
+DEFAULT_EF = 100
+INITIAL_CAPACITY = 1024
+
+
+class VectorIndex:
+    """HNSW index of vectors keyed by string IDs, scores are cosine similarities."""
+
+    def __init__(
+        self,
+        path: str,
+        dim: int,
+        M: int = DEFAULT_M,
+        ef_construction: int = DEFAULT_EF_CONSTRUCTION,
+        ef: int = DEFAULT_EF,
+        space: str = "cosine",
+    ):
+        self.path = Path(path)
+        labels_path = self.path / LABELS_FILE_NAME
+        self.index_file = None
+        if labels_path.exists():
+            with open(labels_path) as f:
+                meta = json.load(f)
+            if meta["dim"] != dim:
+                raise ValueError(f"{path} has {meta['dim']} dimensions, not {dim}")
+            # The graph parameters are those the index was built with
+            M, ef_construction, space = meta["M"], meta["ef_construction"], meta["space"]
+            self.labels = meta["labels"]
+            self.deleted = set(meta["deleted"])
+            self.index_file = meta["index_file"]
+        else:
+            self.labels = {}
+            self.deleted = set()
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.space = space
+        self.ids = {label: id_ for id_, label in self.labels.items()}
+        self.index = hnswlib.Index(space=space, dim=dim)
+        if self.index_file is not None:
+            self.index.load_index(str(self.path / self.index_file), max_elements=0)
+        else:
+            self.index.init_index(
+                max_elements=INITIAL_CAPACITY, M=M, ef_construction=ef_construction
+            )
+        self.set_ef(ef)
+
+    def __len__(self) -> int:
+        return len(self.labels) - len(self.deleted)
+
+    def __contains__(self, id_: str) -> bool:
+        return id_ in self.labels and id_ not in self.deleted
+
+    def set_ef(self, ef: int):
+        """Candidates kept while searching, higher is slower and more accurate."""
+        self.ef = ef
+        self.index.set_ef(ef)
+
+    def add(self, ids: List[str], vectors: np.ndarray):
+        """Add or replace the vectors of `ids`.
+
+        IDs keep their label when updated or deleted and added again, so the
+        graph doesn't grow with every change.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        labels = []
+        for id_ in ids:
+            if id_ not in self.labels:
+                self.labels[id_] = len(self.labels)
+                self.ids[self.labels[id_]] = id_
+            self.deleted.discard(id_)
+            labels.append(self.labels[id_])
+        needed = len(self.labels)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, labels)
+
+    def delete(self, ids: Iterable[str]):
+        for id_ in ids:
+            if id_ in self:
+                self.index.mark_deleted(self.labels[id_])
+                self.deleted.add(id_)
+
+    def search(self, vector: np.ndarray, k: int = 10) -> List[Tuple[str, float]]:
+        """The `k` nearest IDs with their similarity, most similar first."""
+        k = min(k, len(self))
+        if k == 0:
+            return []
+        # hnswlib fails if it finds fewer than k results, which ef < k makes likely
+        if self.ef < k:
+            self.index.set_ef(k)
+        try:
+            labels, distances = self.index.knn_query(
+                np.asarray(vector, dtype=np.float32), k=k
+            )
+        finally:
+            self.index.set_ef(self.ef)
+        return [
+            (self.ids[label], 1.0 - float(distance))
+            for label, distance in zip(labels[0], distances[0])
+        ]
+
+    def save(self):
+        """Write the graph to a new file, then point labels.json at it."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        generation = 1
+        if self.index_file is not None:
+            generation = int(self.index_file[len("index-") : -len(".bin")]) + 1
+        index_file = f"index-{generation}.bin"
+        self.index.save_index(str(self.path / index_file))
+        meta = {
+            "dim": self.dim,
+            "M": self.M,
+            "ef_construction": self.ef_construction,
+            "space": self.space,
+            "index_file": index_file,
+            "labels": self.labels,
+            "deleted": sorted(self.deleted),
+        }
+        write_file_atomic(self.path / LABELS_FILE_NAME, json.dumps(meta))
+        self.index_file = index_file
+        # The previous graph, and any left by a save that crashed
+        for path in self.path.glob(INDEX_FILE_PATTERN):
+            if path.name != index_file:
+                path.unlink()
+
+
+def get_index_path(es_index: str, vector_field: str) -> str:
+    return os.path.join(const.VECTOR_INDEX_DIR, f"{es_index}.{vector_field}")
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int = 10) -> np.ndarray:
+    """Row numbers of the `k` vectors most cosine-similar to `query`, like script_score."""
+    scores = vectors @ (query / np.linalg.norm(query))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def benchmark(
+    num_vectors: int = 50000,
+    dim: int = 384,
+    num_queries: int = 200,
+    k: int = 10,
+    M: int = DEFAULT_M,
+    ef_values: List[int] = (10, 20, 50, 100, 200),
+):
+    """Recall@k and latency of the HNSW index against exact search."""
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    # Sentence embeddings lie near a low dimensional subspace, unlike uniform noise
+    projection = rng.normal(size=(32, dim))
+    vectors = rng.normal(size=(num_vectors, 32)) @ projection
+    vectors = (vectors + rng.normal(size=vectors.shape)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = rng.normal(size=(num_queries, 32)) @ projection
+    queries = (queries + rng.normal(size=queries.shape)).astype(np.float32)
+    ids = [str(i) for i in range(num_vectors)]
+
+    start = time.time()
+    exact = [exact_search(vectors, query, k) for query in queries]
+    exact_ms = (time.time() - start) / num_queries * 1000
+    print(f"{num_vectors} vectors, {dim} dims, top {k}")
+    print(f"exact:      {exact_ms:.2f} ms/query")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = VectorIndex(tmp, dim, M=M)
+        start = time.time()
+        for i in range(0, num_vectors, 10000):
+            index.add(ids[i : i + 10000], vectors[i : i + 10000])
+        print(f"Built index (M={M}) in {time.time() - start:.1f}s")
+        index.save()
+        index = VectorIndex(tmp, dim)
+        for ef in ef_values:
+            index.set_ef(ef)
+            start = time.time()
+            results = [index.search(query, k) for query in queries]
+            hnsw_ms = (time.time() - start) / num_queries * 1000
+            recall = np.mean([
+                len({int(id_) for id_, _ in result} & set(true.tolist())) / k
+                for result, true in zip(results, exact)
+            ])
+            print(
+                f"hnsw ef={ef:<4} {hnsw_ms:.2f} ms/query, recall@{k} {recall:.3f}, "
+                f"{exact_ms / hnsw_ms:.0f}x faster"
+            )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
@@ -0,0 +1,190 @@
+"""Persistent cache of HTML conversions keyed by HTML digest and converter version.
+
+Receipts, notifications and digests share identical HTML, and re-syncing or
+reprocessing the local corpus converts the same bodies over and over. Results of
+`html_converter.convert_html` are stored in SQLite under sha256(html) plus
+`CONVERTER_VERSION`, so bumping the version only recomputes what changed.
+
+The cache is bounded by the (compressed) size of its entries; once it grows past
+`max_bytes` the least recently used entries are evicted.
+"""
+
+import gzip
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from higgins import const
+from higgins.nlp import html_converter
+
+# Evict down to this fraction of max_bytes, so eviction doesn't run on every insert
+EVICT_TO_FRACTION = 0.9
+
+
+def get_cache_key(html: str, version: int = html_converter.CONVERTER_VERSION) -> str:
+    digest = hashlib.sha256(html.encode("utf-8", "surrogatepass")).hexdigest()
+    return f"{digest}:{version}"
+
+
+class HTMLConversionCache:
+    def __init__(
+        self,
+        db_path: str = const.HTML_CACHE_PATH,
+        max_bytes: int = const.HTML_CACHE_MAX_BYTES,
+        version: int = html_converter.CONVERTER_VERSION,
+    ):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.version = version
+        self.stats = Counter()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Losing the last few entries on a crash is fine for a cache
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.RLock()
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversions (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS conversions_last_used ON conversions (last_used)"
+        )
+        # Entries from other converter versions can never be hit again
+        self.conn.execute("DELETE FROM conversions WHERE version != ?", (version,))
+        self.total_bytes = self._get_total_bytes()
+
+    def _get_total_bytes(self) -> int:
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM conversions").fetchone()[0]
+
+    def get(self, html: str) -> Optional[Dict[str, str]]:
+        key = get_cache_key(html, self.version)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM conversions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.conn.execute(
+                "UPDATE conversions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        self.stats["hits"] += 1
+        return json.loads(gzip.decompress(row[0]))
+
+    def add(self, html: str, outputs: Dict[str, str]):
+        key = get_cache_key(html, self.version)
+        data = gzip.compress(json.dumps(outputs).encode("utf-8"), compresslevel=6)
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM conversions WHERE key = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO conversions (key, version, data, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, self.version, data, len(data), time.time()),
+            )
+            self.total_bytes += len(data) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self, target_bytes: int = None):
+        """Delete least recently used entries until the cache fits in target_bytes."""
+        if target_bytes is None:
+            target_bytes = int(self.max_bytes * EVICT_TO_FRACTION)
+        with self.lock:
+            # Other processes may share the file, so don't trust the running total
+            self.total_bytes = self._get_total_bytes()
+            excess = self.total_bytes - target_bytes
+            if excess <= 0:
+                return
+            # Oldest entries whose cumulative size covers the excess
+            cutoff = self.conn.execute(
+                """
+                SELECT last_used FROM (
+                    SELECT last_used, SUM(size) OVER (ORDER BY last_used, key) AS freed
+                    FROM conversions
+                ) WHERE freed >= ? ORDER BY last_used LIMIT 1
+                """,
+                (excess,),
+            ).fetchone()
+            if cutoff is None:
+                cursor = self.conn.execute("DELETE FROM conversions")
+            else:
+                cursor = self.conn.execute(
+                    "DELETE FROM conversions WHERE last_used <= ?", (cutoff[0],)
+                )
+            self.stats["evicted"] += cursor.rowcount
+            self.total_bytes = self._get_total_bytes()
+
+    def convert(
+        self, html: str, convert_fn: Callable = html_converter.convert_html
+    ) -> Dict[str, str]:
+        """Return convert_fn(html), from the cache if this HTML was converted before."""
+        if not html or not html.strip():
+            return convert_fn(html)
+        outputs = self.get(html)
+        if outputs is None:
+            outputs = convert_fn(html)
+            self.add(html, outputs)
+        return outputs
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM conversions")
+            self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM conversions").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+_cache = None
+
+
+def get_default_cache() -> HTMLConversionCache:
+    global _cache
+    if _cache is None:
+        _cache = HTMLConversionCache()
+    return _cache
+
+
+def convert_html(html: str) -> Dict[str, str]:
+    """Cached `html_converter.convert_html`."""
+    return get_default_cache().convert(html)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        import tempfile
+
+        from higgins.automation.email import email_store
+
+        # Synthetic corpus where most emails share a template
+        htmls = [e["html"] for e in email_store.generate_email_corpus(500)]
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = HTMLConversionCache(str(Path(tmp, "html_cache.db")))
+            for name in ["cold", "warm"]:
+                start = time.time()
+                for html in htmls:
+                    cache.convert(html)
+                elapsed = time.time() - start
+                print(f"{name}: {elapsed / len(htmls) * 1000:.2f} ms/email, {dict(cache.stats)}")
+            print(f"{len(cache)} entries, {cache.total_bytes / 1024:.0f} KB")
@@ -0,0 +1,304 @@
+"""Single-pass HTML to simplified HTML, plain text and Markdown converter.
+
+html2plain.parse_html minifies the HTML, runs readabilipy, converts to Markdown
+with html2text and parses the result again with BeautifulSoup, so every email is
+parsed four or more times. `convert_html` parses once with lxml and walks the
+tree a single time, producing all three outputs in memory:
+
+    simplified: HTML with layout tags/attributes stripped (links, lists, tables kept)
+    text: plain text, one line per block element
+    markdown: Markdown (headings, emphasis, links, lists)
+
+Run `python -m higgins.nlp.html_converter benchmark [path/to.mbox]` to compare
+it with the existing parsers on raw email HTML.
+"""
+
+import html as html_lib
+import re
+import sys
+import time
+import warnings
+from typing import Callable, Dict, List
+
+import lxml.html
+from lxml import etree
+
+# Bump when the output changes, so cached conversions are recomputed
+CONVERTER_VERSION = 2
+
+SKIP_TAGS = {
+    "head", "script", "style", "noscript", "template", "title", "meta", "link",
+    "img", "svg", "iframe", "object", "embed", "form", "input", "button", "select",
+    "textarea", "video", "audio", "canvas", "map",
+}
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "body", "center", "dd", "details",
+    "div", "dl", "dt", "fieldset", "figcaption", "figure", "footer", "header",
+    "hr", "html", "main", "nav", "ol", "p", "pre", "section", "summary", "table",
+    "tbody", "tfoot", "thead", "tr", "ul",
+    "h1", "h2", "h3", "h4", "h5", "h6", "li",
+}
+PARAGRAPH_TAGS = {"p", "blockquote", "pre", "table", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6"}
+# Tags kept in the simplified HTML, everything else is unwrapped
+SIMPLIFIED_TAGS = {
+    "a", "b", "blockquote", "br", "code", "div", "em", "h1", "h2", "h3", "h4", "h5",
+    "h6", "hr", "i", "li", "ol", "p", "pre", "strong", "table", "td", "th", "tr", "ul",
+}
+EMPHASIS = {"b": "**", "strong": "**", "i": "_", "em": "_"}
+HIDDEN_STYLE = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden", re.I)
+WHITESPACE = re.compile(r"\s+")
+PRE_BLOCK = re.compile(r"(<pre>.*?</pre>)", re.S)
+# Zero-width characters marketing emails use to pad preview text
+INVISIBLE = re.compile("[\u034f\u200b-\u200d\u2060\ufeff]")
+
+_START, _END = 0, 1
+
+
+class _Output:
+    """Text buffer that collapses whitespace and inserts pending line breaks."""
+
+    def __init__(self):
+        self.parts = []
+        self.breaks = 0
+        self.space = False
+
+    def block(self, breaks: int):
+        self.breaks = max(self.breaks, breaks)
+
+    def write(self, text: str, preformatted: bool = False):
+        trailing_space = False
+        if not preformatted:
+            text = INVISIBLE.sub("", text)
+            self.space = self.space or text[:1].isspace()
+            trailing_space = text[-1:].isspace()
+            text = WHITESPACE.sub(" ", text).strip()
+        if not text:
+            return
+        if self.parts:
+            if self.breaks:
+                self.parts.append("\n" * self.breaks)
+            elif self.space:
+                self.parts.append(" ")
+        self.parts.append(text)
+        self.breaks = 0
+        self.space = trailing_space
+
+    def mark(self, token: str):
+        # Markup (e.g. "**") glued to the next/previous word
+        if self.parts:
+            if self.breaks:
+                self.parts.append("\n" * self.breaks)
+            elif self.space:
+                self.parts.append(" ")
+        self.breaks = 0
+        self.space = False
+        self.parts.append(token)
+
+    def getvalue(self) -> str:
+        text = "".join(self.parts)
+        text = re.sub(r"[ \t]+\n", "\n", text)
+        return text.strip()
+
+
+def _is_hidden(el) -> bool:
+    return "hidden" in el.attrib or bool(HIDDEN_STYLE.search(el.get("style", "")))
+
+
+def _parse(html: str):
+    try:
+        return lxml.html.document_fromstring(html)
+    except ValueError:
+        # lxml refuses str input with an <?xml encoding="..."?> declaration
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+        return lxml.html.document_fromstring(html.encode("utf-8"), parser=parser)
+
+
+def convert_html(html: str) -> Dict[str, str]:
+    """Convert HTML into simplified HTML, plain text and Markdown in a single pass."""
+    empty = {"simplified": "", "text": "", "markdown": ""}
+    if not html or not html.strip():
+        return empty
+    try:
+        root = _parse(html)
+    except etree.ParserError:  # e.g. only comments
+        return empty
+
+    text, md, simplified = _Output(), _Output(), []
+    list_stack = []  # [tag, item_count] of enclosing lists
+    preformatted = 0
+
+    def write(value: str):
+        if not value:
+            return
+        text.write(value, preformatted > 0)
+        md.write(value, preformatted > 0)
+        simplified.append(html_lib.escape(value, quote=False))
+
+    # (phase, element or text, index of the Markdown link opened by the element)
+    stack = [(_START, root, None)]
+    while stack:
+        phase, el, link_start = stack.pop()
+        if phase is None:  # text/tail
+            write(el)
+            continue
+        tag = el.tag if isinstance(el.tag, str) else None
+        if phase == _START:
+            if tag is None or tag in SKIP_TAGS or _is_hidden(el):
+                # Comments, processing instructions and hidden/skipped elements
+                if el.tail:
+                    stack.append((None, el.tail, None))
+                continue
+            tag = tag.lower()
+            if tag in BLOCK_TAGS:
+                # Nested lists continue their parent list item
+                nested_list = tag in ("ul", "ol") and list_stack
+                breaks = 2 if tag in PARAGRAPH_TAGS and not nested_list else 1
+                text.block(breaks)
+                md.block(breaks)
+            if tag == "br":
+                text.block(1)
+                md.block(1)
+            elif tag == "hr":
+                md.block(2)
+                md.mark("---")
+                md.block(2)
+            elif tag in ("ul", "ol"):
+                list_stack.append([tag, 0])
+            elif tag == "li":
+                prefix = "- "
+                if list_stack:
+                    list_stack[-1][1] += 1
+                    if list_stack[-1][0] == "ol":
+                        prefix = f"{list_stack[-1][1]}. "
+                indent = "  " * max(len(list_stack) - 1, 0)
+                text.mark(indent + prefix)
+                md.mark(indent + prefix)
+            elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+                md.mark("#" * int(tag[1]) + " ")
+            elif tag in EMPHASIS:
+                md.mark(EMPHASIS[tag])
+            elif tag == "a" and el.get("href", "").startswith(("http", "mailto:")):
+                md.mark("[")
+                link_start = len(md.parts) - 1
+            elif tag in ("td", "th"):
+                # Cells are separated by a space, rows (tr) by a line break
+                text.write(" ")
+                md.write(" ")
+            elif tag == "pre":
+                preformatted += 1
+
+            if tag in SIMPLIFIED_TAGS:
+                href = el.get("href") if tag == "a" else None
+                attrs = f' href="{html_lib.escape(href)}"' if href else ""
+                simplified.append(f"<{tag}{attrs}>")
+
+            stack.append((_END, el, link_start))
+            for child in reversed(el):
+                stack.append((_START, child, None))
+            if el.text:
+                stack.append((None, el.text, None))
+        else:
+            tag = tag.lower()
+            if tag in ("ul", "ol") and list_stack:
+                list_stack.pop()
+            elif tag in EMPHASIS:
+                if md.parts and md.parts[-1] == EMPHASIS[tag]:
+                    md.parts.pop()  # nothing emphasized
+                else:
+                    md.parts.append(EMPHASIS[tag])
+            elif link_start is not None:
+                if "".join(md.parts[link_start + 1:]).strip():
+                    md.parts.append(f"]({el.get('href')})")
+                else:
+                    del md.parts[link_start:]  # e.g. image-only links
+            elif tag == "pre":
+                preformatted -= 1
+
+            if tag in BLOCK_TAGS:
+                breaks = 2 if tag in PARAGRAPH_TAGS and not list_stack else 1
+                text.block(breaks)
+                md.block(breaks)
+            if tag in SIMPLIFIED_TAGS and tag not in ("br", "hr"):
+                simplified.append(f"</{tag}>")
+            if el.tail:
+                stack.append((None, el.tail, None))
+
+    # Collapse whitespace, except in preformatted blocks
+    simplified_html = "".join(
+        part if part.startswith("<pre>") else WHITESPACE.sub(" ", part)
+        for part in PRE_BLOCK.split("".join(simplified))
+    )
+    # Drop elements left empty once layout and images are stripped
+    simplified_html = re.sub(r"<(\w+)[^>]*>\s*</\1>", "", simplified_html)
+    return {
+        "simplified": simplified_html.strip(),
+        "text": text.getvalue(),
+        "markdown": md.getvalue(),
+    }
+
+
+def benchmark_converters(htmls: List[str], converters: Dict[str, Callable] = None):
+    """Print ms/email and output size of each HTML converter on `htmls`."""
+    if converters is None:
+        from higgins.automation.email import email_utils
+        from higgins.nlp import html2plain
+
+        converters = {
+            "html2plain.parse_html": html2plain.parse_html,
+            "parse_html": email_utils.parse_html,
+            "parse_html_v2": email_utils.parse_html_v2,
+            "parse_html_v3": email_utils.parse_html_v3,
+            "parse_html_v4": email_utils.parse_html_v4,
+            "html2plain_fn": email_utils.html2plain_fn,
+            "convert_html": convert_html,
+        }
+    warnings.simplefilter("ignore")  # BeautifulSoup's GuessedAtParserWarning
+    total_mb = sum(len(html) for html in htmls) / 1024 / 1024
+    print(f"{len(htmls)} emails, {total_mb:.1f} MB of HTML")
+    for name, fn in converters.items():
+        start = time.time()
+        out_chars = 0
+        for html in htmls:
+            result = fn(html)
+            out_chars += len(result["text"] if isinstance(result, dict) else result)
+        elapsed = time.time() - start
+        print(
+            f"{name}: {elapsed / len(htmls) * 1000:.2f} ms/email, "
+            f"{total_mb / elapsed:.1f} MB/s, {out_chars / len(htmls):.0f} chars/email"
+        )
+
+
+def load_mbox_htmls(path: str, limit: int = 500) -> List[str]:
+    """The raw text/html part of the first `limit` HTML emails in an mbox export."""
+    from higgins.automation.email.mbox_reader import MBoxReader, parse_message
+
+    htmls = []
+    with MBoxReader(path) as reader:
+        for data in reader.iter_raw():
+            message = parse_message(data)
+            part = message.get_body(preferencelist=("html",))
+            if part is None:
+                continue
+            try:
+                htmls.append(part.get_content())
+            except (LookupError, UnicodeError):  # Unknown or wrong charset
+                continue
+            if len(htmls) == limit:
+                break
+    return htmls
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        from higgins.automation.email import email_store
+
+        # The store only keeps HTML already simplified by convert_html, so
+        # measure on the raw HTML of an mbox export (e.g. Google Takeout)
+        mbox_path = sys.argv[2] if len(sys.argv) > 2 else None
+        htmls = load_mbox_htmls(mbox_path) if mbox_path else []
+        if htmls:
+            print(f"Corpus: raw HTML of {len(htmls)} emails from {mbox_path}")
+        else:
+            print("Corpus: synthetic newsletter HTML (pass an mbox path for real emails)")
+            htmls = [e["html"] for e in email_store.generate_email_corpus(200)]
+        benchmark_converters(htmls)
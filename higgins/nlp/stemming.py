@@ -0,0 +1,25 @@
+"""Snowball English stemmer.
+
+Elasticsearch's `snowball` analyzer stems English with the Snowball English
+(Porter2) algorithm. The embedded full-text index uses the same algorithm,
+from the snowballstemmer package, so the same query terms match locally and
+in Elasticsearch.
+
+https://snowballstem.org/algorithms/english/stemmer.html
+"""
+
+from functools import lru_cache
+import threading
+
+import snowballstemmer
+
+# Stemmer objects keep per-word state, so each thread needs its own
+_local = threading.local()
+
+
+@lru_cache(maxsize=100_000)
+def stem(word: str) -> str:
+    """Stem a lowercase word, e.g. "meetings" -> "meet", "generously" -> "generous"."""
+    if not hasattr(_local, "stemmer"):
+        _local.stemmer = snowballstemmer.stemmer("english")
+    return _local.stemmer.stemWord(word)
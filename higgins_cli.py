@@ -7,6 +7,7 @@ import html
 import pprint
 import sys
 import traceback
+from typing import Dict
 
 import click
 from prompt_toolkit import print_formatted_text as print
@@ -14,10 +15,16 @@ from prompt_toolkit import HTML
 
 from higgins.nlp.text2speech import speak_text
 
-from higgins.automation.email import email_utils
+from higgins.automation.email import (
+    email_fulltext,
+    email_store,
+    email_utils,
+    reprocess_emails,
+)
 from higgins.automation.google import gmail
 from higgins import const
 from higgins.context import Context
+from higgins.database import elastic, fulltext
 from higgins.episode import Episode, save_episode
 from higgins.higgins import Higgins
 from higgins.intents.intent_resolver import OpenAIIntentResolver
@@ -26,6 +33,19 @@ from higgins.utils import prompt_utils
 pp = pprint.PrettyPrinter(indent=2)
 
 
+# Full-text hits checked for --exact-phrase
+PHRASE_CANDIDATES = 500
+
+
+def contains_phrase(email: Dict, phrase: str) -> bool:
+    """Whether the subject or body contains `phrase`, ignoring case and whitespace."""
+    phrase = " ".join(phrase.lower().split())
+    return any(
+        phrase in " ".join((email.get(field) or "").lower().split())
+        for field in ["subject", "plain"]
+    )
+
+
 # CLI commands
 
 
@@ -41,7 +61,10 @@ def cli(debug):
 @click.option("--recipient", type=str, help="Recipient name or email address")
 @click.option("--subject", type=str, help="Subject of the email")
 @click.option(
-    "--exact-phrase", type=str, help="Exact phrase found in email body"
+    "--exact-phrase",
+    type=str,
+    help="Exact phrase found in email body (with --source elastic/fulltext, "
+    "the best matches are filtered on the phrase)",
 )  # @click.option("--labels")
 @click.option(
     "--newer-than",
@@ -62,7 +85,7 @@ def cli(debug):
     help="Directory where saved emails are stored",
 )
 @click.option("--show-body", is_flag=True, help="Display body of email")
-@click.option("--source", default="gmail", help="elastic, local, or gmail")
+@click.option("--source", default="gmail", help="elastic, fulltext, local, or gmail")
 def search_email(**kwargs):
     """Search email inbox using Gmail API.
 
@@ -84,12 +107,36 @@ def search_email(**kwargs):
             query[key] = value
 
     if kwargs["source"] == "local":
+        categories = (kwargs["categories"] or "").split(",")
         emails = email_utils.search_local_emails(
-            kwargs.get("categories", "").split(",")
+            [c for c in categories if c],
+            newer_than=kwargs["newer_than"],
+            dataset_dir=kwargs["email_dir"],
         )
         kwargs["save"] = False
-    elif kwargs["source"] == "elastic":
-        # emails = email_utils.search_elastic_emails()
+    elif kwargs["source"] in ["elastic", "fulltext"]:
+        # Full-text query over subject/plain, with Elasticsearch or the local BM25 index
+        query_str = " ".join(
+            v for v in [kwargs["subject"], kwargs["exact_phrase"]] if v is not None
+        )
+        # The phrase only ranks hits as loose terms, fetch more to filter on it
+        stop = 50 if kwargs["exact_phrase"] is None else PHRASE_CANDIDATES
+        if kwargs["source"] == "elastic":
+            hits = elastic.search_query_string(
+                query_str, fields=["subject^2", "plain"], client=elastic.get_client(), stop=stop
+            )
+        else:
+            hits = fulltext.search_query_string(
+                query_str,
+                fields=["subject^2", "plain"],
+                client=email_fulltext.get_email_index(),
+                stop=stop,
+            )
+        emails = [elastic.dsl_hit_to_dict(hit)["_source"] for hit in hits]
+        if kwargs["exact_phrase"] is not None:
+            emails = [
+                e for e in emails if contains_phrase(e, kwargs["exact_phrase"])
+            ][:50]
         kwargs["save"] = False
     else:
         emails = gmail.search_emails(query_dicts=[query], limit=50, include_html=True)
@@ -100,6 +147,10 @@ def search_email(**kwargs):
             )
         )
 
+    if kwargs["save"]:
+        # Only touch the store when saving, it creates emails.db on first use
+        store = email_store.get_email_store(kwargs["email_dir"])
+        stats_before = store.stats.copy()
     for email in emails:
         if kwargs["save"]:
             model_labels = {}
@@ -115,6 +166,8 @@ def search_email(**kwargs):
                 )
             )
     print(f"Found {len(emails)} emails.")
+    if kwargs["save"]:
+        print(email_store.format_write_stats(store.stats - stats_before))
 
 
 @cli.command()
@@ -144,6 +197,109 @@ def get_email(email_id, google_id, categories, save, show_body):
     print(email_utils.remove_whitespace(preview))
 
 
+@cli.command()
+@click.option(
+    "--email-dir",
+    type=str,
+    default="data/emails",
+    help="Directory where saved emails are stored",
+)
+@click.option("--no-elastic", is_flag=True, help="Only sync the local email store")
+def sync_email(email_dir, no_elastic):
+    """Sync emails changed since the last sync from Gmail."""
+    gmail.sync_gmail(dataset_dir=email_dir, include_elastic=not no_elastic)
+
+
+@cli.command()
+@click.option(
+    "--email-dir",
+    type=str,
+    default="data/emails",
+    help="Directory where saved emails are stored",
+)
+@click.option(
+    "--remove-dirs", is_flag=True, help="Delete the per-email directories afterwards"
+)
+def migrate_email_store(email_dir, remove_dirs):
+    """Pack a directory-per-email dataset into a single emails.db file."""
+    count = email_store.migrate_dir_to_sqlite(email_dir, remove_dirs=remove_dirs)
+    print(f"Migrated {count} emails to {email_dir}/{email_store.EMAIL_DB_NAME}")
+    print(email_store.format_write_stats(email_store.get_email_store(email_dir).stats))
+
+
+@cli.command()
+@click.option(
+    "--email-dir",
+    type=str,
+    default="data/emails",
+    help="Directory where saved emails are stored",
+)
+@click.option(
+    "--codec",
+    type=click.Choice(email_store.BODY_CODECS),
+    default=email_store.DEFAULT_BODY_CODEC,
+    help="Compression for stored email bodies",
+)
+@click.option(
+    "--train-dict", is_flag=True, help="Train a zstd dictionary on the stored bodies"
+)
+def compress_email_store(email_dir, codec, train_dict):
+    """Recompress the bodies in an emails.db store."""
+    store = email_store.get_email_store(email_dir)
+    if isinstance(store, email_store.DirEmailStore):
+        raise click.ClickException(
+            f"{email_dir} holds one directory per email, "
+            "run `migrate-email-store` to pack it into emails.db first"
+        )
+    store.set_codec(codec)
+    if train_dict:
+        try:
+            store.train_zstd_dictionary()
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    size_before, size_after = store.recompress()
+    print(
+        f"Compressed bodies from {size_before / 1024 / 1024:.2f} MB "
+        f"to {size_after / 1024 / 1024:.2f} MB"
+    )
+
+
+@cli.command()
+@click.option(
+    "--email-dir",
+    type=str,
+    default="data/emails",
+    help="Directory where saved emails are stored",
+)
+@click.option("--workers", type=int, default=None, help="Worker processes (default: all CPUs)")
+@click.option("--chunk-size", type=int, default=100, help="Emails per worker task")
+@click.option("--no-cache", is_flag=True, help="Don't use the HTML conversion cache")
+def reprocess_email_store(email_dir, workers, chunk_size, no_cache):
+    """Rebuild plain text, Markdown and simplified HTML from the stored HTML."""
+    stats = reprocess_emails.reprocess_local_emails(
+        email_dir, workers=workers, chunk_size=chunk_size, use_cache=not no_cache
+    )
+    print(email_store.format_write_stats(stats))
+    print(f"{stats['no_html']} emails without HTML were left as is")
+
+
+@cli.command()
+@click.option(
+    "--email-dir",
+    type=str,
+    default="data/emails",
+    help="Directory where saved emails are stored",
+)
+@click.option("--optimize", is_flag=True, help="Merge all index segments afterwards")
+def index_email_fulltext(email_dir, optimize):
+    """Update the local full-text index used by `search-email --source fulltext`."""
+    stats = email_fulltext.update_email_index(email_dir, optimize=optimize)
+    print(
+        f"Indexed {stats['added']} emails ({stats['unchanged']} unchanged, "
+        f"{stats['deleted']} deleted) in {const.FULLTEXT_INDEX_PATH}"
+    )
+
+
 def question_prompt(session, style, chat_history, chat_history_path, speak):
     def prompt_func(question):
         nonlocal chat_history, chat_history_path
@@ -0,0 +1,116 @@
+"""Tests for choosing between the local email store and Gmail in SearchEmail."""
+
+import functools
+import json
+import os
+import time
+
+import pytest
+
+from higgins import const
+from higgins.actions import ActionParam
+from higgins.actions import email_actions
+from higgins.automation.google import gmail
+from higgins.automation.email import email_utils
+
+
+def make_search(**values):
+    specs = email_actions.SearchEmail.param_specs()
+    return email_actions.SearchEmail(
+        {name: ActionParam(value=values.get(name), spec=spec) for name, spec in specs.items()}
+    )
+
+
+def make_email(google_id, **fields):
+    return {"google_id": google_id, "sender": "bob@example.com", "subject": "Hi", **fields}
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    calls = {"gmail": 0}
+    local = [
+        make_email("g2", email_id="local-2"),
+        make_email("g9", email_id="local-9"),
+    ]
+
+    def search_gmail(query_dicts):
+        calls["gmail"] += 1
+        return [make_email(f"g{i}") for i in range(1, 4)]
+
+    monkeypatch.setattr(email_utils, "search_local_emails", lambda **kwargs: list(local))
+    monkeypatch.setattr(gmail, "search_emails", search_gmail)
+    return calls
+
+
+@pytest.fixture
+def sync_state(tmp_path, monkeypatch):
+    """Write the Gmail sync state `is_synced` reads, None for a never synced store."""
+    state_path = tmp_path / "sync.json"
+    monkeypatch.setattr(
+        gmail, "is_synced", functools.partial(gmail.is_synced, state_path=str(state_path))
+    )
+
+    def write(synced_after, dataset_dir=const.EMAIL_DATASET_DIR):
+        if synced_after is None:
+            return
+        state = {
+            "history_id": "100",
+            "dataset_dir": os.path.realpath(dataset_dir),
+            "synced_after": synced_after,
+        }
+        state_path.write_text(json.dumps(state))
+
+    return write
+
+
+def test_unsynced_store_merges_gmail_results(sources, sync_state):
+    sync_state(None)
+    result = make_search(sender="bob@example.com").run()
+
+    assert sources["gmail"] == 1
+    assert [e["google_id"] for e in result.data] == ["g1", "g2", "g3", "g9"]
+    assert result.data[1]["email_id"] == "local-2"
+
+
+def test_synced_store_answers_locally(sources, sync_state):
+    sync_state(time.time() - 365 * 86400)
+    result = make_search(sender="bob@example.com", newer_than=(3, "day")).run()
+
+    assert sources["gmail"] == 0
+    assert [e["email_id"] for e in result.data] == ["local-2", "local-9"]
+
+
+def test_query_outside_synced_window_merges_gmail_results(sources, sync_state):
+    # The sync only fetched the last year, older emails may be missing locally
+    sync_state(time.time() - 365 * 86400)
+    for values in [{}, {"newer_than": (2, "year")}]:
+        sources["gmail"] = 0
+        result = make_search(sender="bob@example.com", **values).run()
+
+        assert sources["gmail"] == 1
+        assert [e["google_id"] for e in result.data] == ["g1", "g2", "g3", "g9"]
+
+
+def test_store_synced_into_another_dataset_dir_merges_gmail_results(
+    sources, sync_state, tmp_path
+):
+    sync_state(0.0, dataset_dir=str(tmp_path / "other"))
+    make_search(sender="bob@example.com").run()
+
+    assert sources["gmail"] == 1
+
+
+def test_thread_lookup_is_local_only(sources, sync_state):
+    sync_state(None)
+    result = make_search(thread_id="t1").run()
+
+    assert sources["gmail"] == 0
+    assert len(result.data) == 2
+
+
+def test_gmail_only_params_skip_local_store(sources, sync_state):
+    sync_state(0.0)
+    result = make_search(sender="bob@example.com", unread=True).run()
+
+    assert sources["gmail"] == 1
+    assert [e["google_id"] for e in result.data] == ["g1", "g2", "g3"]
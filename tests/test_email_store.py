@@ -0,0 +1,90 @@
+"""Tests for the email store layouts and SQLite schema migrations."""
+
+import json
+import sqlite3
+
+import pytest
+
+from higgins.automation.email import email_utils
+from higgins.automation.email.email_store import (
+    EMAIL_DB_NAME,
+    SQLITE_MIGRATIONS,
+    DirEmailStore,
+    SQLiteEmailStore,
+    _execute_script,
+)
+
+
+def make_email(i, **fields):
+    return {
+        "google_id": f"g{i}",
+        "sender": f"Sender <s{i}@example.com>",
+        "subject": f"Subject {i}",
+        "plain": f"Body {i}",
+        "html": f"<p>Body {i}</p>",
+        "markdown": f"Body {i}",
+        **fields,
+    }
+
+
+@pytest.mark.parametrize("store_class", [DirEmailStore, SQLiteEmailStore])
+def test_second_save_skips_unchanged_emails(store_class, tmp_path):
+    store = store_class(str(tmp_path))
+    for i in range(3):
+        store.save(f"e{i}", make_email(i), {"categories": ["personal"]})
+    assert (store.stats["written"], store.stats["skipped"]) == (3, 0)
+
+    for i in range(3):
+        store.save(f"e{i}", make_email(i), {"categories": ["personal"]})
+    # Saving without labels keeps the stored ones
+    store.save("e0", make_email(0))
+    assert (store.stats["written"], store.stats["skipped"]) == (3, 4)
+
+    store.save("e1", make_email(1, subject="Changed"))
+    store.save("e2", make_email(2), {"categories": ["work"]})
+    assert (store.stats["written"], store.stats["skipped"]) == (5, 4)
+    assert store.load("e1")["subject"] == "Changed"
+    assert store.load("e1")["model_labels"] == {"categories": ["personal"]}
+    assert store.load("e2")["model_labels"] == {"categories": ["work"]}
+
+
+@pytest.mark.parametrize("version", [5, 6])
+def test_migration_backfills_sender_from_header(version, tmp_path):
+    conn = sqlite3.connect(tmp_path / EMAIL_DB_NAME, isolation_level=None)
+    for step in SQLITE_MIGRATIONS[:5]:
+        if callable(step):
+            step(conn)
+        else:
+            _execute_script(conn, step)
+    if version == 6:
+        # The sender columns, as the first version of migration 6 filled them
+        _execute_script(
+            conn,
+            """
+            ALTER TABLE emails ADD COLUMN sender_address TEXT;
+            ALTER TABLE emails ADD COLUMN sender_domain TEXT;
+            ALTER TABLE emails ADD COLUMN thread_id TEXT
+            """,
+        )
+    conn.execute(f"PRAGMA user_version = {version}")
+    metadata = {"email_id": "e0", "sender": "Bob <Bob@Example.com>", "date": "2021-09-01"}
+    conn.execute(
+        "INSERT INTO emails (email_id, metadata, date_ts) VALUES (?, ?, ?)",
+        ("e0", json.dumps(metadata), 1630454400.0),
+    )
+    conn.close()
+
+    store = SQLiteEmailStore(str(tmp_path))
+    assert store.search(match_all=True, sender="bob@example.com") == ["e0"]
+    assert store.search(match_all=True, sender="example.com") == ["e0"]
+    store.close()
+
+
+def test_reading_a_missing_dataset_creates_nothing(tmp_path):
+    dataset_dir = str(tmp_path / "emails")
+
+    assert email_utils.search_local_emails(sender="bob@example.com", dataset_dir=dataset_dir) == []
+    assert email_utils.get_local_email_ids_by_google_id(dataset_dir) == {}
+    with pytest.raises(FileNotFoundError):
+        email_utils.load_email("e0", dataset_dir=dataset_dir)
+    assert not (tmp_path / "emails").exists()
@@ -0,0 +1,62 @@
+"""Tests for the embedded BM25 full-text index."""
+
+import pytest
+
+from higgins.database.fulltext import FullTextIndex, analyze
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = FullTextIndex(str(tmp_path / "fulltext.db"))
+    yield index
+    index.close()
+
+
+def test_analyze_uses_snowball_english_stems():
+    # Porter2 results that the original Porter algorithm gets differently
+    assert analyze("Generously skies dying") == ["generous", "sky", "die"]
+
+
+def test_uncommitted_changes_are_invisible(index):
+    index.add("a", {"subject": "flight to boston"})
+    index.add("b", {"subject": "hotel in boston"})
+    index.commit()
+    scores = index.score("boston", ["subject"]).tolist()
+
+    index.add("c", {"subject": "boston boston"})
+    index.delete("a")
+    assert len(index) == 2
+    assert index.score("boston", ["subject"]).tolist() == scores
+    assert [hit.meta.id for hit in index.search("flight", ["subject"])] == ["a"]
+
+    index.commit()
+    assert len(index) == 2
+    assert [hit.meta.id for hit in index.search("boston", ["subject"])] == ["c", "b"]
+
+
+def test_optimize_renumbers_live_docs(tmp_path):
+    index = FullTextIndex(str(tmp_path / "fulltext.db"))
+    for i in range(10):
+        index.add(str(i), {"subject": f"email {i}", "plain": "flight" if i % 2 else "hotel"})
+    index.commit()
+    for i in range(0, 10, 3):
+        index.delete(str(i))
+    index.add("5", {"subject": "email 5", "plain": "flight changed"})
+    index.commit()
+    before = [(hit.meta.id, hit.meta.score) for hit in index.search("flight", ["plain"])]
+
+    index.optimize()
+
+    assert index.next_doc_num == len(index.live) == len(index) == 6
+    assert all(len(lengths) == 6 for lengths in index.lengths.values())
+    doc_nums = [row[0] for row in index.conn.execute("SELECT doc_num FROM docs ORDER BY doc_num")]
+    assert doc_nums == list(range(6))
+    assert [(hit.meta.id, hit.meta.score) for hit in index.search("flight", ["plain"])] == before
+    index.close()
+
+    reopened = FullTextIndex(str(tmp_path / "fulltext.db"))
+    assert [hit.meta.id for hit in reopened.search("flight", ["plain"])] == [i for i, _ in before]
+    reopened.add("10", {"subject": "email 10", "plain": "flight"})
+    reopened.commit()
+    assert len(reopened) == 7
+    reopened.close()
@@ -0,0 +1,285 @@
+"""Tests for gmail.iter_emails / fetch_emails / sync_gmail against a local Gmail API server.
+
+The real simplegmail clients and googleapiclient discovery client are used,
+their requests to gmail.googleapis.com are sent to an http.server instead.
+"""
+
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from oauth2client import client as oauth_client, file as oauth_file
+import pytest
+import simplegmail.gmail
+
+from higgins.automation.email import email_utils
+from higgins.automation.google import gmail
+from higgins.nlp import html_converter
+
+GMAIL_ROOT_URL = "https://gmail.googleapis.com"
+USER_PATH = "/gmail/v1/users/me/"
+
+
+def b64(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def make_message(google_id):
+    return {
+        "id": google_id,
+        "threadId": f"t-{google_id}",
+        "labelIds": ["INBOX"],
+        "snippet": f"Body {google_id}",
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "From", "value": f"Sender {google_id} <{google_id}@example.com>"},
+                {"name": "To", "value": "me@example.com"},
+                {"name": "Subject", "value": f"Subject {google_id}"},
+                {"name": "Date", "value": "Wed, 1 Sep 2021 10:00:00 -0700"},
+            ],
+            "body": {"size": 0},
+            "parts": [
+                {
+                    "mimeType": "text/plain",
+                    "headers": [],
+                    "body": {"data": b64(f"Body {google_id}")},
+                },
+                {
+                    "mimeType": "text/html",
+                    "headers": [],
+                    "body": {"data": b64(f"<html><body><p>Body {google_id}</p></body></html>")},
+                },
+            ],
+        },
+    }
+
+
+class FakeGmailServer:
+    """Canned Gmail API responses, and a log of the requests that asked for them."""
+
+    def __init__(self, num_messages):
+        self.ids = [f"m{i}" for i in range(num_messages)]
+        self.requests = []
+        self.failing_ids = set()
+        # Changes returned by history.list, None if the history id expired
+        self.history = None
+        # Threads that created an HTTP connection, i.e. a Gmail client
+        self.client_threads = []
+        self.lock = threading.Lock()
+
+    def list_calls(self):
+        return [params for path, params in self.requests if path == "messages"]
+
+    def fetched_ids(self):
+        return [path.split("/")[1] for path, _ in self.requests if path.startswith("messages/")]
+
+    def respond(self, path, params):
+        with self.lock:
+            self.requests.append((path, params))
+        if path == "messages":
+            start = int(params.get("pageToken", 0))
+            page_size = int(params["maxResults"])
+            refs = [{"id": i, "threadId": f"t-{i}"} for i in self.ids[start : start + page_size]]
+            response = {"messages": refs, "resultSizeEstimate": len(refs)}
+            if start + page_size < len(self.ids):
+                response["nextPageToken"] = str(start + page_size)
+            return 200, response
+        if path.startswith("messages/"):
+            google_id = path.split("/")[1]
+            # Random latency so downloads complete out of order
+            time.sleep(random.uniform(0, 0.005))
+            if google_id not in self.ids or google_id in self.failing_ids:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            return 200, make_message(google_id)
+        if path == "labels":
+            return 200, {"labels": [{"id": "INBOX", "name": "INBOX", "type": "system"}]}
+        if path == "profile":
+            return 200, {"emailAddress": "me@example.com", "historyId": "100"}
+        if path == "history":
+            if self.history is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            return 200, {"history": self.history, "historyId": "200"}
+        return 404, {"error": {"code": 404, "message": f"Unknown path {path}"}}
+
+
+@pytest.fixture
+def fake_gmail(monkeypatch, tmp_path):
+    server = FakeGmailServer(num_messages=23)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            assert url.path.startswith(USER_PATH)
+            assert self.headers["Authorization"] == "Bearer test-token"
+            params = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+            status, response = server.respond(url.path[len(USER_PATH) :], params)
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    local_url = f"http://127.0.0.1:{httpd.server_port}"
+
+    class LocalHttp(httplib2.Http):
+        """The Http each simplegmail client authorizes, pointed at the local server."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            with server.lock:
+                server.client_threads.append(threading.current_thread().name)
+
+        def request(self, uri, *args, **kwargs):
+            return super().request(uri.replace(GMAIL_ROOT_URL, local_url), *args, **kwargs)
+
+    monkeypatch.setattr(simplegmail.gmail, "Http", LocalHttp)
+    # Gmail() loads its credentials from gmail_token.json in the working directory
+    monkeypatch.chdir(tmp_path)
+    creds = oauth_client.AccessTokenCredentials("test-token", "higgins-tests")
+    oauth_file.Storage(str(tmp_path / "gmail_token.json")).put(creds)
+    # Don't write to the persistent conversion cache
+    monkeypatch.setattr(gmail.html_cache, "convert_html", html_converter.convert_html)
+    yield server
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_iter_emails_pages_and_keeps_order(fake_gmail):
+    emails = list(
+        gmail.iter_emails([{"sender": "a@example.com"}], page_size=5, include_html=True)
+    )
+
+    assert [e["google_id"] for e in emails] == fake_gmail.ids
+    list_calls = fake_gmail.list_calls()
+    assert [c.get("pageToken") for c in list_calls] == [None, "5", "10", "15", "20"]
+    assert all(c["q"] == "from:a@example.com" for c in list_calls)
+    assert all(c["maxResults"] == "5" for c in list_calls)
+    assert emails[0]["html"] is not None
+    assert emails[0]["plain"].strip() == "Body m0"
+    assert emails[0]["sender_address"] == "m0@example.com"
+    assert emails[0]["thread_id"] == "t-m0"
+    assert emails[0]["label_ids"] == ["INBOX"]
+
+
+def test_iter_emails_fans_out_to_bounded_workers(fake_gmail):
+    emails = list(gmail.iter_emails([{}], page_size=5, max_workers=4))
+
+    assert len(emails) == len(fake_gmail.ids)
+    assert sorted(fake_gmail.fetched_ids()) == sorted(fake_gmail.ids)
+    # One client for listing, plus one per worker thread
+    main_thread = threading.current_thread().name
+    fetch_threads = [t for t in fake_gmail.client_threads if t != main_thread]
+    assert fake_gmail.client_threads.count(main_thread) == 1
+    assert 1 < len(fetch_threads) == len(set(fetch_threads)) <= 4
+    # Workers reuse the labels listed once instead of listing them per message
+    assert [path for path, _ in fake_gmail.requests].count("labels") == 1
+    assert all(e["html"] is None for e in emails)
+
+
+def test_iter_emails_limit_stops_paging(fake_gmail):
+    emails = list(gmail.iter_emails([{}], limit=7, page_size=5))
+
+    assert [e["google_id"] for e in emails] == fake_gmail.ids[:7]
+    assert len(fake_gmail.list_calls()) == 2
+
+
+def test_fetch_emails_skips_failed_messages(fake_gmail):
+    fake_gmail.failing_ids = {"m3"}
+    client = gmail.Gmail()
+    refs = [{"id": i} for i in fake_gmail.ids[:6]]
+    emails = list(gmail.fetch_emails(client, iter(refs), client.list_labels()))
+
+    assert [e["google_id"] for e in emails] == ["m0", "m1", "m2", "m4", "m5"]
+
+
+def save_gmail_email(google_id, dataset_dir):
+    email = {
+        "google_id": google_id,
+        "sender": "old@example.com",
+        "recipient": "me@example.com",
+        "subject": google_id,
+        "plain": "",
+        "html": None,
+    }
+    return email_utils.save_email(email, dataset_dir=str(dataset_dir))
+
+
+def test_sync_gmail_expired_history_deletes_missing_emails(fake_gmail, tmp_path):
+    dataset_dir = tmp_path / "emails"
+    save_gmail_email("m0", dataset_dir)
+    save_gmail_email("deleted-in-gmail", dataset_dir)
+    state_path = tmp_path / "sync.json"
+    state_path.write_text(json.dumps({"history_id": "50"}))
+
+    gmail.sync_gmail(
+        dataset_dir=str(dataset_dir), include_elastic=False, state_path=str(state_path)
+    )
+
+    local_ids = email_utils.get_local_email_ids_by_google_id(str(dataset_dir))
+    assert sorted(local_ids) == sorted(fake_gmail.ids)
+    # The whole mailbox is listed, trash included, not just the resync query
+    full_listing = [c for c in fake_gmail.list_calls() if c["q"] == ""]
+    assert full_listing and all(c["includeSpamTrash"] == "true" for c in full_listing)
+    email = email_utils.load_email(local_ids["m1"][0], dataset_dir=str(dataset_dir))
+    assert email["html"] is not None
+    state = json.loads(state_path.read_text())
+    assert state["history_id"] == "100"
+    assert state["dataset_dir"] == str(dataset_dir.resolve())
+    # The default resync query fetches the last year
+    assert abs(state["synced_after"] - (time.time() - 365 * 86400)) < 60
+    assert gmail.is_synced(time.time() - 30 * 86400, str(dataset_dir), str(state_path))
+    assert not gmail.is_synced(0.0, str(dataset_dir), str(state_path))
+
+
+def test_sync_gmail_incremental_stores_html(fake_gmail, tmp_path):
+    dataset_dir = tmp_path / "emails"
+    state_path = tmp_path / "sync.json"
+    state_path.write_text(json.dumps({"history_id": "150"}))
+    fake_gmail.history = [{"messagesAdded": [{"message": {"id": "m5"}}]}]
+
+    gmail.sync_gmail(
+        dataset_dir=str(dataset_dir), include_elastic=False, state_path=str(state_path)
+    )
+
+    history_calls = [params for path, params in fake_gmail.requests if path == "history"]
+    assert [c["startHistoryId"] for c in history_calls] == ["150"]
+    local_ids = email_utils.get_local_email_ids_by_google_id(str(dataset_dir))
+    assert list(local_ids) == ["m5"]
+    email = email_utils.load_email(local_ids["m5"][0], dataset_dir=str(dataset_dir))
+    assert email["html"] is not None
+    # Without a recorded store the coverage of the first sync is unknown
+    assert json.loads(state_path.read_text()) == {
+        "history_id": "200",
+        "dataset_dir": str(dataset_dir.resolve()),
+        "synced_after": None,
+    }
+
+
+def test_sync_gmail_into_another_store_runs_full_resync(fake_gmail, tmp_path):
+    dataset_dir = tmp_path / "emails"
+    state_path = tmp_path / "sync.json"
+    state = {"history_id": "150", "dataset_dir": "/elsewhere", "synced_after": 0.0}
+    state_path.write_text(json.dumps(state))
+    fake_gmail.history = [{"messagesAdded": [{"message": {"id": "m5"}}]}]
+
+    gmail.sync_gmail(
+        dataset_dir=str(dataset_dir), include_elastic=False, state_path=str(state_path)
+    )
+
+    local_ids = email_utils.get_local_email_ids_by_google_id(str(dataset_dir))
+    assert sorted(local_ids) == sorted(fake_gmail.ids)
+    assert gmail.is_synced(time.time() - 86400, str(dataset_dir), str(state_path))
@@ -0,0 +1,21 @@
+"""Tests for the single-pass HTML converter."""
+
+from higgins.nlp.html_converter import convert_html
+
+
+def test_table_rows_on_one_line():
+    result = convert_html(
+        "<table><tr><th>Item</th><th>Price</th></tr>"
+        "<tr><td>Coffee</td><td>$3</td></tr></table>"
+    )
+
+    assert result["text"] == "Item Price\nCoffee $3"
+    assert result["markdown"] == "Item Price\nCoffee $3"
+
+
+def test_preformatted_whitespace_is_kept():
+    result = convert_html("<p>a   b</p><pre>def f():\n    return  1</pre>")
+
+    assert result["text"] == "a b\n\ndef f():\n    return  1"
+    assert "<pre>def f():\n    return  1</pre>" in result["simplified"]
+    assert "<p>a b</p>" in result["simplified"]
@@ -0,0 +1,238 @@
+"""Tests for BulkSink and checkpointed uploads against a fake `_bulk` endpoint."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import tornado.options
+
+from higgins.automation.email import index_emails
+from higgins.automation.email.index_emails import BulkSink, IngestCheckpoint
+from higgins.automation.email.mbox_reader import MBoxIndex
+
+
+class FakeBulk:
+    """Records bulk requests and answers them with `respond(request_number, ids)`.
+
+    `respond` returns an HTTP status for the whole request, a dict mapping ids
+    to item statuses (others get 201), or "close" to drop the connection.
+    """
+
+    def __init__(self, respond=lambda n, ids: {}, latency=0.0):
+        self.respond = respond
+        self.latency = latency
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def handle(self, body):
+        lines = body.decode().splitlines()
+        ids = [json.loads(line)["index"]["_id"] for line in lines[::2]]
+        with self.lock:
+            self.requests.append(ids)
+            n = len(self.requests)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+        response = self.respond(n, ids)
+        if not isinstance(response, dict):
+            return response, None
+        items = [
+            {"index": {"_id": i, "status": response.get(i, 201), "error": "rejected"}}
+            for i in ids
+        ]
+        errors = any(item["index"]["status"] >= 300 for item in items)
+        return 200, {"took": 1, "errors": errors, "items": items}
+
+
+@pytest.fixture
+def fake_bulk():
+    fake = FakeBulk()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            status, result = fake.handle(body)
+            if status == "close":
+                self.close_connection = True
+                return
+            data = json.dumps(result or {"error": "busy"}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake.url = f"http://127.0.0.1:{server.server_port}"
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record backoff delays instead of sleeping."""
+    delays = []
+    fake_time = SimpleNamespace(sleep=delays.append, time=time.time)
+    monkeypatch.setattr(index_emails, "time", fake_time)
+    return delays
+
+
+def make_items(n):
+    return [{"message-id": f"<m{i}@example.com>", "subject": f"Email {i}"} for i in range(n)]
+
+
+def test_retries_rejected_items_and_counts_failures(fake_bulk, sleeps):
+    def respond(n, ids):
+        if n == 1:
+            return 429
+        if n == 2:
+            return {"<m3@example.com>": 429, "<m5@example.com>": 400}
+        return {}
+
+    fake_bulk.respond = respond
+    sink = BulkSink(fake_bulk.url, "email", max_docs=10)
+    items = make_items(10)
+    futures = [sink.add(item) for item in items]
+    sink.close()
+
+    acked = futures[-1].result()
+    assert acked == {item["message-id"] for item in items} - {"<m5@example.com>"}
+    assert len(fake_bulk.requests) == 3
+    # Only the item rejected with a retryable status is resent
+    assert fake_bulk.requests[2] == ["<m3@example.com>"]
+    assert sleeps == [1, 2]
+    assert sink.total_uploaded == 9
+    assert sink.total_failed == 1
+
+
+def test_retries_dropped_connections(fake_bulk, sleeps):
+    fake_bulk.respond = lambda n, ids: "close" if n == 1 else {}
+    sink = BulkSink(fake_bulk.url, "email", max_docs=3)
+    futures = [sink.add(item) for item in make_items(3)]
+    sink.close()
+
+    assert len(futures[-1].result()) == 3
+    assert len(fake_bulk.requests) == 2
+    assert sink.total_uploaded == 3
+
+
+def test_gives_up_after_max_retries(fake_bulk, sleeps):
+    fake_bulk.respond = lambda n, ids: {ids[0]: 503}
+    sink = BulkSink(fake_bulk.url, "email", max_docs=2, max_retries=2)
+    futures = [sink.add(item) for item in make_items(2)]
+    sink.close()
+
+    assert futures[-1].result() == {"<m1@example.com>"}
+    assert len(fake_bulk.requests) == 3
+    assert (sink.total_uploaded, sink.total_failed) == (1, 1)
+
+
+def test_in_flight_requests_are_bounded(fake_bulk):
+    fake_bulk.latency = 0.1
+    sink = BulkSink(fake_bulk.url, "email", max_docs=1, max_in_flight=2)
+    start = time.time()
+    futures = [sink.add(item) for item in make_items(6)]
+    add_secs = time.time() - start
+    sink.close()
+
+    assert all(len(future.result()) == 1 for future in futures)
+    assert fake_bulk.max_in_flight == 2
+    # `add` blocks while both slots are busy: 6 requests, 2 at a time
+    assert add_secs >= 0.2
+
+
+@pytest.fixture
+def options(fake_bulk):
+    values = {
+        "es_url": fake_bulk.url,
+        "index_name": "email",
+        "bulk_bytes": 5 * 1024 * 1024,
+        "batch_size": 2,
+        "max_in_flight": 2,
+        "dry_run": False,
+        "index_bodies": False,
+        "text_only": False,
+        "index_x_headers": True,
+    }
+    for name, value in values.items():
+        if name in tornado.options.options:
+            setattr(tornado.options.options, name, value)
+        else:
+            tornado.options.define(name, default=value)
+
+
+def write_mbox(path, n):
+    with open(path, "w") as f:
+        for i in range(n):
+            f.write(
+                f"From sender@example.com Mon Sep  6 10:00:00 2021\n"
+                f"Message-ID: <m{i}@example.com>\n"
+                f"From: sender@example.com\n"
+                f"Subject: Email {i}\n\nBody {i}\n\n"
+            )
+
+
+def test_checkpoint_stops_at_first_failed_message(fake_bulk, options, sleeps, tmp_path):
+    fake_bulk.respond = lambda n, ids: {"<m3@example.com>": 400}
+    infile = str(tmp_path / "mail.mbox")
+    write_mbox(infile, 6)
+    index = MBoxIndex(infile)
+    checkpoint = IngestCheckpoint(infile + ".checkpoint")
+    items = index_emails.iter_converted_mbox(infile, index, list(range(len(index))))
+
+    stalled = index_emails.upload_items(items, checkpoint, index)
+
+    assert stalled
+    assert checkpoint.offset == index.offsets[3]
+    assert checkpoint.last_message_id == "<m2@example.com>"
+    indexed = {f"<m{i}@example.com>" for i in [0, 1, 2, 4, 5]}
+    assert checkpoint.message_ids == indexed
+    # A restart resumes at the failed message and skips the later ones by id
+    restarted = IngestCheckpoint(infile + ".checkpoint")
+    assert restarted.resume_position(index) == 3
+    assert restarted.message_ids == indexed
+
+
+def test_checkpoint_normalizes_folded_message_ids(tmp_path):
+    write_mbox(str(tmp_path / "mail.mbox"), 2)
+    index = MBoxIndex(str(tmp_path / "mail.mbox"))
+    checkpoint = IngestCheckpoint(str(tmp_path / "mail.mbox.checkpoint"))
+    checkpoint.commit(index, 1, ["\r\n <m0@example.com>", "<m1@exa\r\n\tmple.com> "])
+
+    restarted = IngestCheckpoint(str(tmp_path / "mail.mbox.checkpoint"))
+    assert (tmp_path / "mail.mbox.checkpoint.ids").read_text().count("\n") == 2
+    assert restarted.message_ids == {"<m0@example.com>", "<m1@example.com>"}
+    assert " <m1@example.com>\r\n" in restarted
+    assert restarted.resume_position(index) == 1
+
+
+def test_checkpoint_advances_past_unencodable_messages(fake_bulk, options, tmp_path):
+    infile = str(tmp_path / "mail.mbox")
+    write_mbox(infile, 5)
+    index = MBoxIndex(infile)
+    checkpoint = IngestCheckpoint(infile + ".checkpoint")
+    items = list(index_emails.iter_converted_mbox(infile, index, list(range(len(index)))))
+    # e.g. an undecoded header, which json.dumps rejects
+    items[1][1]["subject"] = b"\xff\xfe"
+    items[4][1]["subject"] = b"\xff\xfe"
+
+    stalled = index_emails.upload_items(iter(items), checkpoint, index)
+
+    assert not stalled
+    assert checkpoint.offset == index.end
+    assert checkpoint.message_ids == {f"<m{i}@example.com>" for i in [0, 2, 3]}
+    assert all("<m1@example.com>" not in ids for ids in fake_bulk.requests)
@@ -0,0 +1,45 @@
+"""Tests for closing a memory mapped MBoxReader while message views are alive."""
+
+import logging
+
+import pytest
+
+from higgins.automation.email.mbox_reader import MBoxReader
+
+
+@pytest.fixture
+def mbox_path(tmp_path):
+    path = tmp_path / "mail.mbox"
+    path.write_text(
+        "".join(
+            f"From sender@example.com Mon Sep  6 10:00:00 2021\n"
+            f"Message-ID: <m{i}@example.com>\n"
+            f"Subject: Email {i}\n\nBody {i}\n\n"
+            for i in range(5)
+        )
+    )
+    return str(path)
+
+
+def test_close_releases_outstanding_views(mbox_path):
+    with MBoxReader(mbox_path, use_mmap=True) as reader:
+        raw = reader.iter_raw()
+        first = next(raw)  # generator left suspended
+        second = reader.read_bytes(1)
+        assert b"Email 0" in bytes(first)
+
+    assert reader._mmap.closed
+    for view in [first, second]:
+        with pytest.raises(ValueError):
+            bytes(view)
+
+
+def test_close_logs_views_that_cannot_be_released(mbox_path, caplog):
+    with caplog.at_level(logging.WARNING):
+        with MBoxReader(mbox_path, use_mmap=True) as reader:
+            exported = memoryview(reader.read_bytes(0))
+
+    assert not reader._mmap.closed
+    assert "memory mapped" in caplog.text
+    assert b"Email 0" in bytes(exported)
+    exported.release()
@@ -0,0 +1,60 @@
+"""Tests for the persistent HNSW vector index."""
+
+import numpy as np
+import pytest
+
+from higgins.nlp.embeddings import vector_index
+from higgins.nlp.embeddings.vector_index import VectorIndex
+
+DIM = 16
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).normal(size=(200, DIM)).astype(np.float32)
+
+
+def test_add_delete_and_reload(vectors, tmp_path):
+    ids = [f"e{i}" for i in range(len(vectors))]
+    index = VectorIndex(tmp_path, DIM, M=8)
+    index.add(ids, vectors)
+    assert index.search(vectors[7], k=1)[0][0] == "e7"
+
+    index.delete(["e7"])
+    assert "e7" not in index
+    assert index.search(vectors[7], k=1)[0][0] != "e7"
+
+    # Re-adding a deleted id reuses its label
+    index.add(["e7"], vectors[7:8])
+    assert index.search(vectors[7], k=1)[0][0] == "e7"
+    assert index.labels["e7"] == 7
+
+    index.delete(["e8"])
+    index.save()
+    reloaded = VectorIndex(tmp_path, DIM, ef=20)
+    assert len(reloaded) == len(ids) - 1
+    assert reloaded.M == 8
+    assert reloaded.search(vectors[7], k=1)[0][0] == "e7"
+    assert "e8" not in reloaded
+
+
+def test_crashed_save_keeps_previous_state(vectors, tmp_path, monkeypatch):
+    index = VectorIndex(tmp_path, DIM)
+    index.add(["a", "b"], vectors[:2])
+    index.save()
+
+    def crash(path, text):
+        raise OSError("disk full")
+
+    index.add(["c"], vectors[2:3])
+    monkeypatch.setattr(vector_index, "write_file_atomic", crash)
+    with pytest.raises(OSError):
+        index.save()
+
+    reloaded = VectorIndex(tmp_path, DIM)
+    assert sorted(reloaded.labels) == ["a", "b"]
+    assert len(reloaded.search(vectors[2], k=3)) == 2
+
+    monkeypatch.undo()
+    reloaded.save()
+    assert [p.name for p in tmp_path.glob("index-*.bin")] == [reloaded.index_file]